@@ -81,6 +81,31 @@ def before_send_message(config: before_send_message_config):
             current=auth_level
         )
 
+def stats_show_check(config: utils.CommandConfig):
+    """
+        check if the user can see the statistics of the plugin
+
+        config name of database:
+            `namespace`: unity
+            `key`: auth_level
+    """
+    database = databaseAPI.get_DataAPI()
+    auth_level_required = confAPI.get_config().basic.stats_auth_level_required
+    auth_level = database.conf_database.get_user_config(
+        namespace="unity",
+        key="auth_level",
+        platform=config.user_info.platform,
+        user_id=config.user_info.user_id,
+        default_value=0
+    )
+    if auth_level is None:
+        auth_level = 0
+    if auth_level < auth_level_required:
+        raise exceptions.OlivaChatGPTAuditAuthLevelError(
+            required=auth_level_required,
+            current=auth_level
+        )
+
 def eco_after_receive_message(config: after_receive_message_config):
     """
         after a response from Chat GPT is received, calculate the reward and update the database
@@ -129,3 +154,4 @@ def init():
     crossHook.add_hook("session.new", session_new_check)
     crossHook.add_hook("remote.send", before_send_message)
     crossHook.add_hook("remote.recv", cb_model_count_after_receive_message)
+    crossHook.add_hook("stats.show", stats_show_check)
@@ -0,0 +1,50 @@
+"""
+    helpers shared by the scripts in `bench/`
+
+    bench/ 下的脚本不属于插件本身，OlivOS 不会加载它们
+    插件内部使用 `OlivaChatGPT` 作为包名导入，脚本会以该名称注册插件目录，运行环境中需要能够 import OlivOS
+"""
+import os
+import sys
+import tempfile
+import importlib.util
+import multiprocessing
+
+PLUGIN_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NAMESPACE = "OlivaChatGPT"
+
+gLogList: "list[tuple[int, str]]" = []
+
+def _import_plugin():
+    if NAMESPACE in sys.modules:
+        return sys.modules[NAMESPACE]
+    spec = importlib.util.spec_from_file_location(
+        NAMESPACE, os.path.join(PLUGIN_ROOT, "__init__.py"), submodule_search_locations=[PLUGIN_ROOT]
+    )
+    plugin = importlib.util.module_from_spec(spec)              # type: ignore
+    sys.modules[NAMESPACE] = plugin
+    spec.loader.exec_module(plugin)                             # type: ignore
+    return plugin
+
+if multiprocessing.current_process().name != "MainProcess":
+    # spawn 启动的子进程 (例如图片渲染进程) 需要能够反序列化插件中的函数
+    _import_plugin()
+
+def load_plugin(work_dir: "str|None" = None, log_level: int = 3):
+    """
+        import the plugin package and return it
+
+        插件使用相对于工作目录的数据路径，默认切换到一个临时目录，避免写入真实数据
+        日志写入 gLogList，不低于 log_level 的日志同时打印出来
+    """
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="OlivaChatGPT-bench-")
+    os.chdir(work_dir)
+    plugin = _import_plugin()
+
+    def proc_log(level: int, msg: str):
+        gLogList.append((level, msg))
+        if level >= log_level:
+            print(f"[log {level}] {msg}")
+    plugin.utils.get_logger(proc_log)
+    return plugin
@@ -0,0 +1,123 @@
+"""
+    benchmark concurrent writes to the log database (databaseAPI._DataBaseAPI)
+
+    多个线程同时向各自的会话写入日志，每 10 次写入读取一次最后 20 条日志，对比：
+    - legacy: 改动前的方式，线程池中每个线程各自持有一个 rollback journal 模式的连接，读写都在同一个线程池中
+    - current: WAL 模式，写操作由唯一的写线程执行，读操作在读线程池中并行
+    两者执行相同的 SQL (databaseAPI.SqlAll)，超时时间均为 1 秒，输出吞吐量、延迟分布与失败次数
+
+    usage: python bench/bench_db_concurrency.py [thread_num] [write_num]
+"""
+import os
+import sys
+import time
+import sqlite3
+import threading
+import concurrent.futures
+
+from _plugin import load_plugin
+
+TIMEOUT = 1
+MESSAGE = "hello world " * 20
+
+class LegacyDatabase:
+    def __init__(self, SqlAll, path: str):
+        self.SqlAll = SqlAll
+        self.path = path
+        self._local = threading.local()
+        self._pool = concurrent.futures.ThreadPoolExecutor(None, initializer=self.__init_thread)
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode = DELETE")
+        for script in (self.SqlAll.CREATE.TABLE.MASTER(), self.SqlAll.CREATE.TABLE.MESSAGE(), self.SqlAll.CREATE.INDEX.MESSAGE()):
+            conn.execute(*script.get())
+        conn.close()
+
+    def __init_thread(self):
+        self._local.conn = sqlite3.connect(self.path, timeout=TIMEOUT, check_same_thread=False)
+
+    def __exec(self, script):
+        conn = self._local.conn
+        with conn:
+            return conn.execute(*script.get()).fetchall()
+
+    def save_message(self, session_id: str):
+        self._pool.submit(self.__exec, self.SqlAll.INSERT.MESSAGE(session_id, "user", MESSAGE, 10002)).result(TIMEOUT)
+
+    def get_tail(self, session_id: str):
+        self._pool.submit(self.__exec, self.SqlAll.SELECT.SESSION(session_id, 20000, -20)).result(TIMEOUT)
+
+    def stop(self):
+        self._pool.shutdown()
+
+
+class CurrentDatabase:
+    def __init__(self, databaseAPI):
+        self._db = databaseAPI._DataBaseAPI(lambda level, msg: None, None, TIMEOUT)
+
+    def save_message(self, session_id: str):
+        self._db.save_message(session_id, "user", MESSAGE, 10002)
+
+    def get_tail(self, session_id: str):
+        self._db.get_session_message(session_id, 20000, -20)
+
+    def stop(self):
+        self._db.stop()
+
+
+def run(db, thread_num: int, write_num: int):
+    latency_list = []
+    fail_list = []
+    lock = threading.Lock()
+
+    def worker(session_id: str):
+        latency_this, fail_this = [], []
+        for idx in range(write_num):
+            time_start = time.perf_counter()
+            try:
+                db.save_message(session_id)
+                if idx % 10 == 0:
+                    db.get_tail(session_id)
+            except Exception as err:
+                fail_this.append(f"{err.__class__.__name__}: {err}")
+            latency_this.append(time.perf_counter() - time_start)
+        with lock:
+            latency_list.extend(latency_this)
+            fail_list.extend(fail_this)
+
+    thread_list = [threading.Thread(target=worker, args=(f"session{idx}",)) for idx in range(thread_num)]
+    time_start = time.perf_counter()
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+    time_used = time.perf_counter() - time_start
+    latency_list.sort()
+    return (
+        thread_num * write_num / time_used,
+        latency_list[len(latency_list) // 2],
+        latency_list[int(len(latency_list) * 0.99)],
+        latency_list[-1],
+        fail_list,
+    )
+
+def main():
+    thread_num = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    write_num = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    plugin = load_plugin()
+    print(f"{thread_num} threads x {write_num} writes")
+    print(f"{'mode':>8} {'writes/s':>9} {'p50':>9} {'p99':>9} {'max':>9} {'failed':>7}")
+    for name in ("legacy", "current"):
+        if name == "legacy":
+            db = LegacyDatabase(plugin.databaseAPI.SqlAll, os.path.abspath("legacy.db"))
+        else:
+            db = CurrentDatabase(plugin.databaseAPI)
+        try:
+            throughput, p50, p99, latency_max, fail_list = run(db, thread_num, write_num)
+        finally:
+            db.stop()
+        print(f"{name:>8} {throughput:>9.0f} {p50 * 1e3:>6.2f} ms {p99 * 1e3:>6.2f} ms {latency_max * 1e3:>6.1f} ms {len(fail_list):>7}")
+        if fail_list:
+            print(f"{'':>8} e.g. {fail_list[0]}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+    benchmark the log database layout (databaseAPI, DATABASE_SVN 3)
+
+    对比两种表结构在不同会话数量下的开销，直接使用 sqlite3 执行各自的 SQL，不经过线程池：
+    - legacy: SVN 2 及以前，每个会话一张 table_log_<session_id> 表和一个触发器
+    - current: SVN 3，所有会话的日志存储在 table_message 中 (databaseAPI.SqlAll)
+    输出每次调用的平均耗时 (ms)，打开新连接后第一次查询的耗时 (包括解析 schema) 与数据库文件大小
+
+    usage: python bench/bench_db_layout.py [session_num ...]
+"""
+import os
+import sys
+import time
+import uuid
+import sqlite3
+import tempfile
+
+from _plugin import load_plugin
+
+SAMPLE_NUM = 200
+MESSAGE_NUM = 10
+MESSAGE = "hello world " * 10
+
+class LegacyLayout:
+    name = "legacy"
+
+    def init(self, conn: sqlite3.Connection):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS table_master(
+                session_name TEXT, session_id TEXT PRIMARY KEY, hash_user_id TEXT, model_name TEXT,
+                time_create_time DATETIME DEFAULT CURRENT_TIMESTAMP, time_last_update DATETIME DEFAULT CURRENT_TIMESTAMP
+            )""")
+
+    def init_session(self, conn: sqlite3.Connection, session_id: str):
+        with conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS table_log_{session_id}(
+                    logline INTEGER PRIMARY KEY AUTOINCREMENT, role TEXT, message TEXT,
+                    time_record DATETIME DEFAULT CURRENT_TIMESTAMP, status INTEGER DEFAULT 0, token_num INTEGER DEFAULT NULL
+                )""")
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trigger_{session_id} BEFORE INSERT ON table_log_{session_id} FOR EACH ROW
+                BEGIN
+                    UPDATE OR IGNORE table_master SET time_last_update = CURRENT_TIMESTAMP WHERE session_id = "{session_id}";
+                END""")
+            conn.execute(
+                "INSERT OR REPLACE INTO table_master(session_name, session_id, hash_user_id, model_name) VALUES (?, ?, ?, ?)",
+                (session_id, session_id, "user", "MODEL_NAME"),
+            )
+
+    def save_message(self, conn: sqlite3.Connection, session_id: str):
+        with conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO table_log_{session_id}(role, message, status) VALUES (?, ?, ?)",
+                ("user", MESSAGE, 10002),
+            )
+
+    def get_message(self, conn: sqlite3.Connection, session_id: str):
+        return conn.execute(
+            f"SELECT logline, role, message, status, time_record FROM table_log_{session_id} WHERE status < ?", (40000,)
+        ).fetchall()
+
+
+class CurrentLayout:
+    name = "current"
+
+    def __init__(self, SqlAll):
+        self.SqlAll = SqlAll
+
+    def init(self, conn: sqlite3.Connection):
+        for script in (
+            self.SqlAll.CREATE.TABLE.MASTER(), self.SqlAll.CREATE.TABLE.MESSAGE(),
+            self.SqlAll.CREATE.INDEX.MESSAGE(), self.SqlAll.CREATE.INDEX.MESSAGE_SYSTEM(), self.SqlAll.CREATE.TRIGGER.MESSAGE(),
+        ):
+            conn.execute(*script.get())
+
+    def init_session(self, conn: sqlite3.Connection, session_id: str):
+        with conn:
+            conn.execute(*self.SqlAll.INSERT.SESSION(session_id, session_id, "user", "MODEL_NAME").get())
+
+    def save_message(self, conn: sqlite3.Connection, session_id: str):
+        with conn:
+            conn.execute(*self.SqlAll.INSERT.MESSAGE(session_id, "user", MESSAGE, 10002).get())
+
+    def get_message(self, conn: sqlite3.Connection, session_id: str):
+        return conn.execute(*self.SqlAll.SELECT.SESSION(session_id).get()).fetchall()
+
+
+def run(layout, session_num: int, work_dir: str):
+    path = os.path.join(work_dir, f"{layout.name}-{session_num}.db")
+    conn = sqlite3.connect(path, isolation_level=None)
+    layout.init(conn)
+    session_list = [uuid.uuid4().hex for _ in range(session_num)]
+
+    time_start = time.perf_counter()
+    for session_id in session_list:
+        layout.init_session(conn, session_id)
+    time_init = (time.perf_counter() - time_start) / session_num
+
+    sample_list = session_list[::max(session_num // SAMPLE_NUM, 1)]
+    time_start = time.perf_counter()
+    for session_id in sample_list:
+        for _ in range(MESSAGE_NUM):
+            layout.save_message(conn, session_id)
+    time_save = (time.perf_counter() - time_start) / (len(sample_list) * MESSAGE_NUM)
+    conn.close()
+
+    # 新连接第一次查询时需要解析整个 schema
+    time_start = time.perf_counter()
+    conn = sqlite3.connect(path, isolation_level=None)
+    layout.get_message(conn, sample_list[0])
+    time_open = time.perf_counter() - time_start
+    time_start = time.perf_counter()
+    for session_id in sample_list:
+        assert len(layout.get_message(conn, session_id)) == MESSAGE_NUM
+    time_get = (time.perf_counter() - time_start) / len(sample_list)
+    conn.close()
+    return time_init, time_save, time_open, time_get, os.path.getsize(path)
+
+def main():
+    session_num_list = [int(i) for i in sys.argv[1:]] or [1000, 10000]
+    plugin = load_plugin()
+    work_dir = tempfile.mkdtemp(prefix="OlivaChatGPT-bench-db-")
+    print(f"{'sessions':>9} {'layout':>8} {'init_session':>13} {'save_message':>13} {'first query':>12} {'get_message':>12} {'size':>9}")
+    for session_num in session_num_list:
+        for layout in (LegacyLayout(), CurrentLayout(plugin.databaseAPI.SqlAll)):
+            time_init, time_save, time_open, time_get, size = run(layout, session_num, work_dir)
+            print(
+                f"{session_num:>9} {layout.name:>8} {time_init * 1e3:>10.3f} ms {time_save * 1e3:>10.3f} ms"
+                f" {time_open * 1e3:>9.2f} ms {time_get * 1e3:>9.3f} ms {size / 1024 / 1024:>6.1f} MB"
+            )
+
+if __name__ == "__main__":
+    main()
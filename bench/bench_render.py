@@ -0,0 +1,81 @@
+"""
+    benchmark the text-to-image rendering in replyAPI
+
+    对比两种实现渲染同一段文本的耗时，两者都编码为内存中的 PNG，不写入文件：
+    - legacy: SVN 3 以前的 generate_image，每次调用加载字体，textwrap 按字符数换行，RGB 画布
+    - current: replyAPI._TextImageRender.render_png，字体只加载一次，按像素宽度换行，灰度画布
+    同时输出图片尺寸与 PNG 大小。legacy 的画布宽高是反的，且不会切分中日韩文本，行数与图片尺寸与 current 不同
+
+    usage: python bench/bench_render.py <font_path> [repeat]
+"""
+import io
+import sys
+import time
+import textwrap
+
+from PIL import Image, ImageDraw, ImageFont
+
+from _plugin import load_plugin
+
+SAMPLE_TEXT = {
+    "english": "The quick brown fox jumps over the lazy dog, again and again. " * 40,
+    "cjk": "敏捷的棕色狐狸跳过了懒狗，一次又一次地跳过去。" * 60,
+    "mixed": (
+        "下面是一个 Python 示例：\n"
+        "def fib(n):\n    return n if n < 2 else fib(n - 1) + fib(n - 2)\n"
+        "The function above is exponential, 可以使用 functools.lru_cache 优化。\n"
+    ) * 20,
+}
+
+
+def legacy_render_png(PIC_CONFIG, text: str) -> "tuple[bytes, tuple[int, int]]":
+    text_list = textwrap.wrap(text, width=PIC_CONFIG.WIDTH)
+    image_height = max(PIC_CONFIG.MARGIN * 2 + len(text_list) * (PIC_CONFIG.FONT_STZE + PIC_CONFIG.FONT_SPACING), 800)
+    text_print = "\n".join(text_list)
+    image = Image.new("RGB", (image_height, PIC_CONFIG.IMAGE_WIDTH), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.truetype(PIC_CONFIG.FONT_PATH, PIC_CONFIG.FONT_STZE)
+    draw.text((PIC_CONFIG.MARGIN, PIC_CONFIG.MARGIN), text_print, font=font, fill=(0, 0, 0))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue(), image.size
+
+
+def current_render_png(render, text: str) -> "tuple[bytes, tuple[int, int]]":
+    data = render.render_png(text)
+    return data, Image.open(io.BytesIO(data)).size
+
+
+def measure(func, repeat: int) -> "tuple[float, bytes, tuple[int, int]]":
+    data, size = func()
+    time_start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - time_start) / repeat * 1000, data, size
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(2)
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    plugin = load_plugin()
+    replyAPI = plugin.replyAPI
+    PIC_CONFIG = replyAPI.PIC_CONFIG
+    PIC_CONFIG.FONT_PATH = sys.argv[1]
+    render = replyAPI._TextImageRender(
+        PIC_CONFIG.FONT_PATH, PIC_CONFIG.FONT_STZE, PIC_CONFIG.FONT_SPACING, PIC_CONFIG.MARGIN, PIC_CONFIG.IMAGE_WIDTH
+    )
+
+    print(f"{'sample':>8} {'chars':>6} {'impl':>8} {'ms/call':>9} {'size':>11} {'png KiB':>8}")
+    for name, text in SAMPLE_TEXT.items():
+        for impl, func in (
+            ("legacy", lambda: legacy_render_png(PIC_CONFIG, text)),
+            ("current", lambda: current_render_png(render, text)),
+        ):
+            cost, data, size = measure(func, repeat)
+            print(f"{name:>8} {len(text):>6} {impl:>8} {cost:>9.2f} {size[0]:>5}x{size[1]:<5} {len(data) / 1024:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
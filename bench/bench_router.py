@@ -0,0 +1,185 @@
+"""
+    benchmark the command routing in eventRoute.msg_run
+
+    对比两种实现每秒能处理的消息事件数，子命令的处理函数替换为只记录调用的空函数：
+    - legacy: 复制消息列表，逐个前缀 startswith 检查，再用 if/elif 链分发子命令
+    - current: eventRoute.msg_run，预编译的 _CommandRouter 与 SUBCOMMAND_LIST
+    先检查两者在一组样例消息上的路由结果一致，再按不同的命令占比测量吞吐量
+
+    usage: python bench/bench_router.py [event_num]
+"""
+import sys
+import copy
+import time
+
+import OlivOS
+
+from _plugin import load_plugin
+
+P = OlivOS.messageAPI.PARA
+
+SAMPLE_TEXT = [
+    "", "   ", "hello", ".chat", "。chat help", "!chat new -n a", "！chat   start  x ", ".chat switch y",
+    ".chatshow", ". chat recall 2", ".chat send hi", ".chat 你好 ", ".chatter", "..chat", ".gpt x", "chat x",
+    " .chat\nmulti\nline ", ".chathelpme", ".Chat x",
+]
+COMMAND_TEXT = ".chat hello, how are you today?"
+CHAT_TEXT = "just chatting in the group, nothing to see here"
+
+
+class Event:
+    """
+        只实现 msg_run 用到的属性
+    """
+    def __init__(self, message_list: list):
+        class _Data:
+            pass
+        self.platform = {"platform": "qq"}
+        self.data = _Data()
+        self.data.user_id = "10001"
+        self.data.message = _Data()
+        self.data.message.data = message_list
+        self.bot_info = _Data()
+        self.bot_info.id = "bot"
+        self.blocked = False
+
+    def set_block(self):
+        self.blocked = True
+
+
+def make_legacy_msg_run(plugin, handler: dict):
+    """
+        SVN 3 以前的 msg_run，只把 commandAPI.cmd_xxx 换成 handler 中的函数
+    """
+    utils, confAPI, databaseAPI = plugin.utils, plugin.confAPI, plugin.databaseAPI
+
+    def call(name, plugin_event, Proc, message):
+        handler[name](
+            utils.CommandConfig(
+                plugin_event=plugin_event,
+                Proc=Proc,
+                message=message,
+                user_info=utils.UserInfo.from_event(plugin_event),
+                data=databaseAPI.get_DataAPI()
+            )
+        )
+
+    def msg_run(plugin_event, Proc):
+        config = confAPI.get_config()
+
+        message_list: list = plugin_event.data.message.data.copy()
+        if len(message_list) == 0:
+            return
+        if isinstance(message_list[0], OlivOS.messageAPI.PARA.at):
+            at_id = message_list[0].data["id"]
+            if at_id != plugin_event.bot_info.id:
+                return
+            message_list.pop(0)
+
+        message = ""
+        for this_message in message_list:
+            if isinstance(this_message, OlivOS.messageAPI.PARA.text):
+                message: str = this_message.data["text"].strip()
+                break
+        if message == "":
+            return
+
+        _flag_prefix = False
+        for i in config.basic.command_prefix:
+            if message.startswith(i):
+                message = message[len(i):].lstrip()
+                if message.startswith(config.basic.command_name):
+                    message = message[len(config.basic.command_name):].lstrip()
+                    _flag_prefix = True
+                break
+        if not _flag_prefix:
+            return
+        else:
+            plugin_event.set_block()
+
+        if message == "":
+            message = "help"
+
+        if message.startswith("help"):
+            call("cmd_help", plugin_event, Proc, message[len("help"):].lstrip())
+        elif message.startswith("new"):
+            call("cmd_new", plugin_event, Proc, message[len("new"):].lstrip())
+        elif message.startswith("start"):
+            call("cmd_start", plugin_event, Proc, message[len("start"):].lstrip())
+        elif message.startswith("switch"):
+            call("cmd_start", plugin_event, Proc, message[len("switch"):].lstrip())
+        elif message.startswith("show"):
+            call("cmd_show", plugin_event, Proc, message[len("show"):].lstrip())
+        elif message.startswith("recall"):
+            call("cmd_recall", plugin_event, Proc, message[len("recall"):].lstrip())
+        elif message.startswith("send"):
+            call("cmd_send", plugin_event, Proc, message[len("send"):].lstrip())
+        else:
+            call("cmd_send", plugin_event, Proc, message)
+
+    return msg_run
+
+
+def make_sample_event() -> "list[Event]":
+    event_list = []
+    for text in SAMPLE_TEXT:
+        event_list.append(Event([P.text(text)]))
+        event_list.append(Event([P.at("bot"), P.text(text)]))
+        event_list.append(Event([P.at("other"), P.text(text)]))
+        event_list.append(Event([P.image("x"), P.text(text), P.text(".chat z")]))
+    event_list.append(Event([]))
+    event_list.append(Event([P.at("bot")]))
+    return event_list
+
+
+def measure(msg_run, command_percent: int, event_num: int) -> float:
+    event_list = [
+        Event([P.text(COMMAND_TEXT if i % 100 < command_percent else CHAT_TEXT)])
+        for i in range(1000)
+    ]
+    time_start = time.perf_counter()
+    for i in range(event_num):
+        msg_run(event_list[i % 1000], None)
+    return event_num / (time.perf_counter() - time_start)
+
+
+def main():
+    event_num = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    plugin = load_plugin()
+    confAPI, databaseAPI, eventRoute = plugin.confAPI, plugin.databaseAPI, plugin.eventRoute
+
+    confAPI.gConf = confAPI.Config(copy.deepcopy(confAPI.DEFAULT_CONFIG))
+    # 只测量路由本身，不初始化数据库
+    databaseAPI.get_DataAPI = lambda: None
+
+    call_list = []
+    handler = {}
+    for name in ("cmd_help", "cmd_new", "cmd_start", "cmd_show", "cmd_recall", "cmd_send"):
+        handler[name] = (lambda name: lambda command_config: call_list.append((name, command_config.message)))(name)
+    eventRoute.SUBCOMMAND_LIST[:] = [(sub, handler[func.__name__]) for sub, func in eventRoute.SUBCOMMAND_LIST]
+    eventRoute.commandAPI.cmd_send = handler["cmd_send"]
+    legacy_msg_run = make_legacy_msg_run(plugin, handler)
+
+    diff_num = 0
+    sample_list = make_sample_event()
+    for event in sample_list:
+        result = []
+        for msg_run in (legacy_msg_run, eventRoute.msg_run):
+            call_list.clear()
+            event_this = Event(list(event.data.message.data))
+            msg_run(event_this, None)
+            result.append((list(call_list), event_this.blocked))
+        if result[0] != result[1]:
+            diff_num += 1
+            print(f"diff: {event.data.message.data} legacy={result[0]} current={result[1]}")
+    print(f"routing check: {len(sample_list)} events, {diff_num} differences")
+
+    print(f"{'command %':>10} {'legacy ev/s':>14} {'current ev/s':>14} {'speedup':>8}")
+    for command_percent in (0, 1, 50, 100):
+        legacy = measure(legacy_msg_run, command_percent, event_num)
+        current = measure(eventRoute.msg_run, command_percent, event_num)
+        print(f"{command_percent:>10} {legacy:>14,.0f} {current:>14,.0f} {current / legacy:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
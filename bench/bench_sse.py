@@ -0,0 +1,144 @@
+"""
+    check and benchmark the SSE parsing of stream responses (remoteAPI.SSEParser)
+
+    对比两种实现：
+    - legacy: 改动前的逐行解析 (iter_lines + 尝试 json.loads，失败时拼接下一行)
+    - SSEParser: 当前使用的增量解析器
+    SSEParser 是为了按规范解析而做的改动，并不比 legacy 快：
+    先在注释行、`event` 字段、`data:` 后无空格与多行 data 等样例上对比两者解析出的文本，
+    再构造一个 OpenAI 格式的 stream 回复，按不同大小切分为数据块，测量 SSEParser 带来的额外开销
+    数据块大小为 event 时每个事件为一个数据块
+    两者都包括 json.loads 与取出 delta 的时间，输出每 1k 个事件的 CPU 时间与解析失败的次数
+
+    usage: python bench/bench_sse.py [event_num]
+"""
+import sys
+import json
+import time
+
+from _plugin import load_plugin
+
+def _event_json(content: str) -> bytes:
+    return json.dumps({"choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]}).encode()
+
+# (名称, stream, 期望的文本)，均为规范允许、上游或代理可能发送的格式
+CHECK_STREAM = [
+    ("plain", b"data: " + _event_json("Hello") + b"\n\ndata: " + _event_json(" world") + b"\n\ndata: [DONE]\n\n", "Hello world"),
+    ("crlf", b"data: " + _event_json("Hello") + b"\r\n\r\ndata: " + _event_json(" world") + b"\r\n\r\ndata: [DONE]\r\n\r\n", "Hello world"),
+    ("comment", b": keep-alive\n\ndata: " + _event_json("Hello") + b"\n\n: ping\n\ndata: " + _event_json(" world") + b"\n\ndata: [DONE]\n\n", "Hello world"),
+    ("event", b"event: message\ndata: " + _event_json("Hello") + b"\n\nevent: message\nid: 2\ndata: " + _event_json(" world") + b"\n\ndata: [DONE]\n\n", "Hello world"),
+    ("no space", b"data:" + _event_json("Hello") + b"\n\ndata:" + _event_json(" world") + b"\n\ndata:[DONE]\n\n", "Hello world"),
+    ("multi-line", b"data: " + _event_json("Hello").replace(b", ", b",\ndata: ") + b"\n\ndata: " + _event_json(" world") + b"\n\ndata: [DONE]\n\n", "Hello world"),
+]
+
+def make_stream(event_num: int) -> bytes:
+    event_list = []
+    for idx in range(event_num):
+        event = {
+            "id": "chatcmpl-0123456789", "object": "chat.completion.chunk", "created": 1700000000, "model": "gpt-4-0613",
+            "choices": [{"index": 0, "delta": {"content": f" token{idx % 97}"}, "finish_reason": None}],
+        }
+        event_list.append(b"data: " + json.dumps(event).encode() + b"\n\n")
+    event_list.append(b"data: [DONE]\n\n")
+    return b"".join(event_list)
+
+def split_chunks(stream: bytes, chunk_size: int) -> "list[bytes]":
+    "chunk_size 为 0 时每个事件为一个数据块 (服务器逐个事件 flush 时的情况)"
+    if chunk_size <= 0:
+        return [item + b"\n\n" for item in stream.split(b"\n\n") if item]
+    return [stream[idx:idx + chunk_size] for idx in range(0, len(stream), chunk_size)]
+
+def iter_lines(chunks):
+    "与 requests.Response.iter_lines() 相同的切分方式"
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = pending + chunk
+        lines = chunk.splitlines()
+        if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+            pending = lines.pop()
+        else:
+            pending = None
+        yield from lines
+    if pending is not None:
+        yield pending
+
+def parse_legacy(chunks):
+    text_list, error_num = [], 0
+    tmp_data = b""
+    for chunk in iter_lines(chunks):
+        if not chunk:
+            continue
+        if chunk.startswith(b"data: "):
+            tmp_data = chunk[6:]
+        else:
+            tmp_data += chunk
+        try:
+            event = json.loads(tmp_data)
+        except json.JSONDecodeError:
+            if tmp_data == b"[DONE]":
+                break
+            error_num += 1
+            continue
+        delta = event["choices"][0]["delta"]
+        if "content" in delta:
+            text_list.append(delta["content"])
+    return "".join(text_list), error_num
+
+def parse_sse(parser_class, chunks):
+    text_list, error_num = [], 0
+    parser = parser_class()
+    for chunk in chunks:
+        for data in parser.feed(chunk):
+            if data == b"[DONE]":
+                return "".join(text_list), error_num
+            try:
+                event = json.loads(data)
+            except json.JSONDecodeError:
+                error_num += 1
+                continue
+            delta = event["choices"][0]["delta"]
+            if "content" in delta:
+                text_list.append(delta["content"])
+    return "".join(text_list), error_num
+
+def measure(func, repeat: int = 7):
+    time_best = float("inf")
+    for _ in range(repeat):
+        time_start = time.process_time()
+        result = func()
+        time_best = min(time_best, time.process_time() - time_start)
+    return time_best, result
+
+def main():
+    event_num = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    plugin = load_plugin()
+
+    print(f"{'stream':>10} {'legacy':>8} {'SSEParser':>10}")
+    for name, stream, text_expect in CHECK_STREAM:
+        chunks = split_chunks(stream, 7)
+        result = [
+            "ok" if func()[0] == text_expect else "wrong"
+            for func in (lambda: parse_legacy(chunks), lambda: parse_sse(plugin.remoteAPI.SSEParser, chunks))
+        ]
+        print(f"{name:>10} {result[0]:>8} {result[1]:>10}")
+    print()
+
+    stream = make_stream(event_num)
+    print(f"{event_num} events, {len(stream) / 1024:.0f} KiB")
+    print(f"{'chunk':>8} {'parser':>10} {'ms/1k events':>13} {'json errors':>12}")
+    for chunk_size in (16384, 1024, 100, 0):
+        chunks = split_chunks(stream, chunk_size)
+        text_expect = None
+        for name, func in (
+            ("legacy", lambda: parse_legacy(chunks)),
+            ("SSEParser", lambda: parse_sse(plugin.remoteAPI.SSEParser, chunks)),
+        ):
+            time_used, (text, error_num) = measure(func)
+            if text_expect is None:
+                text_expect = text
+            flag_same = "" if text == text_expect else "  (text differs)"
+            print(f"{chunk_size or 'event':>8} {name:>10} {time_used / event_num * 1e6:>13.2f} {error_num:>12}{flag_same}")
+
+if __name__ == "__main__":
+    main()
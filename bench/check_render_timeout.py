@@ -0,0 +1,36 @@
+"""
+    check the timeout path of `replyAPI._TextImageRenderPool`
+
+    使用一个极短的超时渲染长文本，渲染结果应为 None 并输出一条 warn 日志，而不是抛出异常；
+    之后使用正常的超时再次渲染，确认进程池仍然可用
+
+    usage: python bench/check_render_timeout.py <font_path>
+"""
+import sys
+
+from _plugin import load_plugin, gLogList
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(2)
+    plugin = load_plugin()
+    replyAPI = plugin.replyAPI
+    replyAPI.PIC_CONFIG.FONT_PATH = sys.argv[1]
+
+    text = ("The quick brown fox jumps over the lazy dog. 敏捷的棕色狐狸跳过了懒狗。" * 20 + "\n") * 10
+    pool = replyAPI._TextImageRenderPool(1, 0.001)
+    try:
+        result_list = pool.render_png_list([text, text])
+        assert result_list == [None, None], "rendering should time out"
+        assert any(level == 3 and "timed out" in msg for level, msg in gLogList), "timeout should be logged with warn"
+
+        pool.timeout = 60
+        result_list = pool.render_png_list(["hello"])
+        assert result_list[0] is not None and result_list[0].startswith(b"\x89PNG"), "pool should still render after a timeout"
+    finally:
+        pool.stop()
+    print("ok")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+    check the built-in token estimate in third_party/get_tocken_num against tiktoken
+
+    tiktoken 不可用时插件使用 estimate_token_from_string / estimate_token_from_message_list 估算 token 数量，
+    本脚本在英文、中文、日文、韩文、俄文、法/德文、中英混合、代码与 JSON 样例上对比估算值与 tiktoken 的计数，输出相对误差
+    估算以 cl100k_base 为准：cl100k_base 的相对误差超出 ±tolerance (默认 0.2)，
+    或其他编码低估超过 tolerance 时以状态码 1 退出 (o200k_base 对非英文文本更紧凑，高估是预期的)
+
+    需要安装 tiktoken，并且能够下载 BPE 文件或在 cache_dir 中已有缓存 (即 TIKTOKEN_CACHE_DIR)
+
+    usage: python bench/check_token_estimate.py [cache_dir] [tolerance]
+"""
+import os
+import sys
+
+from _plugin import load_plugin
+
+ENCODING_LIST = ["cl100k_base", "o200k_base"]
+# 估算所校准的编码，高估与低估都检查
+REFERENCE_ENCODING = "cl100k_base"
+
+SAMPLE_TEXT = {
+    "english": (
+        "Token counting is used to keep the context under the model limit. When the encoder is not available, the plugin falls back to a rough estimate that splits words, numbers, punctuation and whitespace the same way as the tokenizer does.\n"
+        "The committee met on Tuesday to discuss the budget for next year. After a long debate, they agreed to increase funding for public libraries by 12 percent, while cutting administrative costs.\n"
+        "I'm not sure whether we'll make it in time; the train leaves at 7:45 and it's already half past seven. Could you call a taxi, please? Thanks a lot!\n"
+        "Photosynthesis converts light energy into chemical energy, storing it in the bonds of glucose molecules. Chlorophyll absorbs mostly blue and red wavelengths and reflects green."
+    ),
+    "chinese": (
+        "当无法加载 tiktoken 编码器时，插件会使用内置方法粗略估算消息的 token 数量，用于裁剪上下文与速率限制的预算。估算值不会写入数据库，安装 tiktoken 后会重新计算。\n"
+        "今天早上下了一场大雨，路上的行人都撑着伞匆匆走过。街边的小店刚刚开门，老板正在把桌椅搬到门口，准备迎接第一批客人。\n"
+        "人工智能的发展给社会带来了深远的影响。一方面，它提高了生产效率，降低了成本；另一方面，它也引发了关于就业、隐私和伦理的讨论。\n"
+        "春眠不觉晓，处处闻啼鸟。夜来风雨声，花落知多少。床前明月光，疑是地上霜。举头望明月，低头思故乡。\n"
+        "请帮我把这段话翻译成英文，并检查一下语法是否有问题？谢谢！另外，明天下午三点的会议改到四点了，记得通知其他同事。"
+    ),
+    "japanese": (
+        "東京は日本の首都であり、多くの人々が暮らしています。今日はとても良い天気ですね。\n"
+        "昨日、友達と一緒に新しいレストランに行きました。料理はとても美味しかったですが、値段が少し高かったです。\n"
+        "この資料を明日までに確認していただけますか？修正が必要な箇所があれば、コメントを残してください。\n"
+        "桜の季節になると、公園は花見を楽しむ人でいっぱいになります。夜にはライトアップされ、幻想的な雰囲気に包まれます。"
+    ),
+    "korean": (
+        "오늘은 날씨가 정말 좋네요. 주말에 친구들과 함께 공원에 가서 산책을 하려고 합니다.\n"
+        "이 문서를 내일까지 검토해 주실 수 있나요? 수정이 필요한 부분이 있으면 댓글을 남겨 주세요.\n"
+        "서울은 대한민국의 수도이며 많은 사람들이 살고 있습니다."
+    ),
+    "russian": (
+        "Сегодня хорошая погода, и мы решили пойти в парк. Москва является столицей России и крупнейшим городом страны.\n"
+        "Не могли бы вы проверить этот документ до завтра? Если нужно что-то исправить, оставьте комментарий."
+    ),
+    "french": (
+        "Le comité s'est réuni mardi pour discuter du budget de l'année prochaine. Après un long débat, les membres ont décidé d'augmenter le financement des bibliothèques publiques de 12 %.\n"
+        "Könnten Sie dieses Dokument bis morgen überprüfen? Wenn etwas geändert werden muss, hinterlassen Sie bitte einen Kommentar. Grüße aus München!"
+    ),
+    "mixed": (
+        "请用 Python 写一个函数 fib(n)，要求时间复杂度为 O(n)。Then explain why the naive recursive version is O(2^n) 并给出 3 个测试用例。\n"
+        "我在用 Docker 部署 nginx 的时候遇到了 502 Bad Gateway 的错误，日志里显示 upstream timed out (110: Connection timed out)，应该怎么排查？\n"
+        "帮我看看这个 SQL：SELECT id, name FROM users WHERE created_at > '2023-01-01' ORDER BY id DESC LIMIT 10; 为什么很慢？\n"
+        "今天的 meeting 改到 3pm 了，记得带上 laptop 和 Q3 的 report。"
+    ),
+    "code": (
+        "def fib(n: int) -> int:\n"
+        "    a, b = 0, 1\n"
+        "    for _ in range(n):\n"
+        "        a, b = b, a + b\n"
+        "    return a\n"
+        "\n"
+        "if __name__ == \"__main__\":\n"
+        "    print([fib(i) for i in range(10)])  # [0, 1, 1, 2, 3, 5, 8, 13, 21, 34]\n"
+        "\n"
+        "class LRUCache:\n"
+        "    def __init__(self, capacity: int):\n"
+        "        self.capacity = capacity\n"
+        "        self.data = collections.OrderedDict()\n"
+        "\n"
+        "    def get(self, key):\n"
+        "        if key not in self.data:\n"
+        "            return -1\n"
+        "        self.data.move_to_end(key)\n"
+        "        return self.data[key]\n"
+        "\n"
+        "function debounce(fn, wait) {\n"
+        "    let timer = null;\n"
+        "    return (...args) => {\n"
+        "        clearTimeout(timer);\n"
+        "        timer = setTimeout(() => fn.apply(this, args), wait);\n"
+        "    };\n"
+        "}\n"
+    ),
+    "json": (
+        "{\"model\": \"gpt-3.5-turbo\", \"messages\": [{\"role\": \"user\", \"content\": \"hello\"}], \"max_tokens\": 1024, \"stream\": true}\n"
+        "{\"id\": \"chatcmpl-8abc123\", \"object\": \"chat.completion.chunk\", \"created\": 1700000000, \"choices\": [{\"index\": 0, \"delta\": {\"content\": \"Hi\"}, \"finish_reason\": null}]}\n"
+        "{\"users\": [{\"id\": 1, \"name\": \"Alice\", \"email\": \"alice@example.com\", \"tags\": [\"admin\", \"dev\"]}, {\"id\": 2, \"name\": \"Bob\", \"active\": false, \"score\": 98.5}]}"
+    ),
+}
+
+
+def main():
+    if len(sys.argv) > 1:
+        os.environ["TIKTOKEN_CACHE_DIR"] = os.path.abspath(sys.argv[1])
+    tolerance = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    plugin = load_plugin()
+    get_tocken_num = plugin.third_party.get_tocken_num
+    if not get_tocken_num.FLAG_TIKTOKEN_INSTALLED:
+        print("tiktoken is not installed")
+        sys.exit(2)
+    tiktoken = get_tocken_num.get_tiktoken()
+
+    encoding_dict = {}
+    for name in ENCODING_LIST:
+        try:
+            encoding_dict[name] = tiktoken.get_encoding(name)
+        except Exception as err:
+            print(f"skip {name}: {err.__class__.__name__}: {err}")
+    if len(encoding_dict) == 0:
+        print("no encoding is available, download the BPE files or pass a cache_dir")
+        sys.exit(2)
+
+    flag_fail = False
+    print(f"{'encoding':>12} {'sample':>10} {'chars':>6} {'tiktoken':>9} {'estimate':>9} {'error':>8}")
+    for name, encoding in encoding_dict.items():
+        for sample, text in SAMPLE_TEXT.items():
+            real = len(encoding.encode(text, disallowed_special=()))
+            estimate = get_tocken_num.estimate_token_from_string(text)
+            error = (estimate - real) / real
+            if name == REFERENCE_ENCODING:
+                flag_fail = flag_fail or abs(error) > tolerance
+            else:
+                flag_fail = flag_fail or error < -tolerance
+            print(f"{name:>12} {sample:>10} {len(text):>6} {real:>9} {estimate:>9} {error:>+8.1%}")
+    if flag_fail:
+        print(f"some samples are outside the tolerance of {tolerance:.0%}")
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 
 import OlivOS
 
-from OlivaChatGPT import utils, databaseAPI, replyAPI, confAPI, crossHook, exceptions, remoteAPI, audit
+from OlivaChatGPT import utils, databaseAPI, replyAPI, confAPI, crossHook, exceptions, remoteAPI, audit, schedulerAPI
 
 
 """
@@ -13,6 +13,7 @@ OlivaChatGPT help:
 .chat show: show all the sessions
 .chat switch <session id>: 切换到另一个会话
 .chat recall: 撤回当前会话中最后一轮的对话
+.chat stats: 查看请求队列、上游服务器等运行统计
 .chat export [-a|--all]: 导出当前会话的数据到 log 文件夹 (默认只输出状态码 20000 的消息)
 
 .chat <xxx>: 向API服务器发送消息
@@ -42,7 +43,7 @@ def cmd_new(config: utils.CommandConfig):
     """
         .chat new (-n, -m): 初始化一个新的聊天会话
     """
-    fmt_base = config.dict_format
+    fmt_base = config.dict_format_overlay()
     
     arg_list = config.message.strip().split(" ")
 
@@ -104,7 +105,7 @@ def cmd_start(config: utils.CommandConfig):
     """
         .chat start (<name>| -s <session>) 恢复一个会话
     """
-    fmt_base = config.dict_format
+    fmt_base = config.dict_format_overlay()
     
     arg_list = config.message.strip().split(" ")
 
@@ -202,9 +203,8 @@ def cmd_send(config: utils.CommandConfig):
         # check if the user can send message to the active session
         crossHook.run_hook("remote.send.before", config)
         # send the message
-        client = remoteAPI.get_remote_client(session_model_this)
-        message = config.message
-        client.send(config)
+        with remoteAPI.use_remote_client(session_model_this) as client:
+            queue_position = client.send(config)
 
     except exceptions.OlivaChatGPTAuditAuthLevelError as err:
         reply = replyAPI.Reply.send.fail()
@@ -220,6 +220,12 @@ def cmd_send(config: utils.CommandConfig):
         reply.add_data({
             "reason": "当前没有活动会话，请使用 .chat start <name> 或 .chat new -n <name> -m <model> 创建一个新的会话",
         })
+    except exceptions.OlivaChatGPTSchedulerFullError as err:
+        reply = replyAPI.Reply.send.fail()
+        reply.add_data(fmt_base)
+        reply.add_data({
+            "reason": str(err.msg),
+        })
     except exceptions.OlivaChatGPTError as err:
         reply = replyAPI.Reply.send.fail()
         reply.add_data(fmt_base)
@@ -233,7 +239,11 @@ def cmd_send(config: utils.CommandConfig):
             "reason": "未知错误：\n"+str(err),
         })
     else:
-        reply = replyAPI.Reply.send.success()
+        if queue_position > 0:
+            reply = replyAPI.Reply.send.queued()
+            reply.add_data({"queue_position": queue_position})
+        else:
+            reply = replyAPI.Reply.send.success()
         reply.add_data(fmt_base)
     config.plugin_event.reply(reply.to_message())
 
@@ -294,15 +304,42 @@ def cmd_recall(config: utils.CommandConfig):
         config.plugin_event.reply(reply.to_message())
         return
     
-    client = remoteAPI.get_remote_client(session_model_this)
-    client.recall(2)
-    msg_list = client.body["messages"]
+    with remoteAPI.use_remote_client(session_model_this) as client:
+        client.recall(2)
+        msg_list = client.get_messages()
     if len(msg_list) > 0:
         config.plugin_event.reply("撤回成功，当前最后一条消息为："+str(msg_list[-1]))
     else:
         config.plugin_event.reply("撤回完毕，当前会话没有消息了。")
 
 
+def cmd_stats(config: utils.CommandConfig):
+    """
+        .chat stats: 查看请求队列、上游服务器等运行统计
+    """
+    fmt_base = config.dict_format
+    try:
+        crossHook.run_hook("stats.show", config)
+        reply = replyAPI.Reply.stats.default()
+        reply.format_scheduler(schedulerAPI.get_scheduler().get_stats())
+        reply.format_upstream(remoteAPI.get_upstream_stats())
+        reply.format_session_pool(remoteAPI.get_session_pool_stats())
+        reply.format_session_cache(databaseAPI.get_DataAPI().get_session_cache_stats())
+        reply.format_client_cache(remoteAPI.get_remote_client_registry().get_stats())
+    except exceptions.OlivaChatGPTAuditAuthLevelError as err:
+        reply = replyAPI.Reply.stats.fail()
+        reply.add_data({
+            "reason": str(err.msg),
+        })
+    except Exception as err:
+        reply = replyAPI.Reply.stats.fail()
+        reply.add_data({
+            "reason": "未知错误：\n"+str(err),
+        })
+    reply.add_data(fmt_base)
+    config.plugin_event.reply(reply.to_message())
+
+
 def cmd_export(config: utils.CommandConfig):
     command_list = config.message.strip().split(" ")
     flag_all = False
@@ -43,8 +43,52 @@ CONF_README = r"""在 config.json 的配置项对应解释如下：
 
         // 命令前缀 和 命令名称
         // 例如：.gpt start
+        // 前缀中加入空字符串 "" 时，不带前缀的 gpt start 也会被识别为命令
         "command_prefix": [".", "。", "!", "！"],
         "command_name": "gpt",
+
+        // 请求调度器的工作线程数，即同时向 API 服务器发送请求的最大数量
+        "scheduler_workers": 8,
+
+        // 请求调度器的等待队列长度，队列已满时新的消息会直接发送失败
+        "scheduler_queue_size": 64,
+
+        // 日志数据库（WAL 模式）每个连接的 synchronous 参数，可选 OFF / NORMAL / FULL / EXTRA
+        // NORMAL 在断电时可能丢失最后几条日志，但不会损坏数据库
+        "database_synchronous": "NORMAL",
+
+        // 日志数据库每个连接的页缓存大小，正数为页数，负数为 KiB（默认约 16 MB）
+        "database_cache_size": -16000,
+
+        // 日志数据库每个连接的内存映射大小（字节），0 为不使用内存映射
+        "database_mmap_size": 0,
+
+        // 是否延迟批量写入聊天日志，开启后保存消息不再等待磁盘写入
+        // 插件异常退出时，尚未写入的最后几条日志会丢失
+        "database_write_behind": false,
+
+        // 延迟写入时，每累计多少条日志写入一次
+        "database_batch_size": 64,
+
+        // 延迟写入时，日志最多等待多少秒后写入
+        "database_batch_interval": 0.05,
+
+        // 在内存中缓存多少个用户当前激活的会话，0 为不缓存
+        "session_cache_size": 1024,
+
+        // 在内存中保留多少个会话的上下文，超出时淘汰最久未使用的空闲会话，-1 为不限制
+        // 被淘汰的会话再次使用时会从数据库重新读取上下文
+        "client_cache_size": 1024,
+
+        // 内存中所有会话上下文的总字节数上限，超出时淘汰最久未使用的空闲会话，-1 为不限制
+        "client_cache_bytes": 67108864,
+
+        // 会话超过多少秒未使用时从内存中淘汰，-1 为不淘汰
+        "client_idle_timeout": 3600,
+
+        // 使用 .chat stats 查看运行统计 (调度队列、上游状态等) 所需的权限等级 (默认 `0` 为所有人)
+        // 统计中包含上游服务器的主机名，不包含 API Key
+        "stats_auth_level_required": 0,
     },
 
     // 这里填写模型配置
@@ -73,6 +117,81 @@ CONF_README = r"""在 config.json 的配置项对应解释如下：
             // 每个会话的最大上下文长度 (默认 -1 为无限制)
             // 每个来自用户或 API 服务器的消息都将作为一个上下文
             "max_context": -1,
+
+            // 每个会话上下文的最大 token 数量 (默认 -1 为无限制)
+            // 超出时从最早的消息开始移除，system 消息始终保留
+            "max_context_tokens": -1,
+
+            // 在 max_context_tokens 中为回复预留的 token 数量
+            "reserved_completion_tokens": 1024,
+
+            // 是否使用 stream 模式接收回复
+            "stream": false,
+
+            // 该模型共享的 HTTP 连接池大小 (同一模型下的所有会话共用一个连接池)
+            "pool_size": 10,
+
+            // 是否保持 HTTP 长连接 (keep-alive)，关闭后每次请求都会重新建立连接
+            "keep_alive": true,
+
+            // 连接池空闲多久（秒）后关闭其中的连接 (默认 60，设为 -1 则不主动关闭)
+            "pool_idle_timeout": 60,
+
+            // 该模型同时进行中的请求数上限 (默认 -1 为仅受调度器工作线程数限制)
+            "max_concurrency": -1,
+
+            // 该模型每分钟的请求数 (RPM) 与 token 数 (TPM) 上限 (默认 -1 为不限制)
+            // 按 API Key 分别计算：upstreams 中每个不同的 api_key 各有一份额度，使用相同 api_key 的上游共用额度，
+            // 不同模型即使使用相同的 api_key 也分别计算 (与 OpenAI 按模型计算限额一致)
+            // 请求只会发送到仍有额度的 api_key 的上游，所有 api_key 都超出上限时留在调度器中等待，
+            // 预计等待超过 rate_limit_wait 秒时放弃发送 (-1 为一直等待)
+            // TPM 按估计的 prompt token 数量预扣，收到回复后按实际用量修正
+            "rate_limit_rpm": -1,
+            "rate_limit_tpm": -1,
+            "rate_limit_wait": 30,
+
+            // stream mode 下是否将已接收到的回复分段发送，而不是等待回复完全结束
+            // 已接收的文本超过 stream_flush_chars 个字符或距离上次发送超过 stream_flush_interval 秒时，
+            // 在段落或句子的边界处分段发送，最后一段仍会附带耗时与 token 统计
+            "stream_flush": false,
+            "stream_flush_chars": 200,
+            "stream_flush_interval": 1.5,
+
+            // stream mode 下是否请求服务器在最后返回 token 用量 (stream_options.include_usage)
+            // 服务器不支持时保持关闭，token 数量会在接收回复的同时逐段计算
+            "stream_include_usage": false,
+
+            // 多个上游服务器 (如多个中转站)，每项为 {"url": ..., "api_key": ..., "weight": 1}
+            // 请求按 weight 的比例分配到各个上游，为空时只使用上面的 url 与 api_key
+            "upstreams": [],
+
+            // 请求失败时的最大重试次数，重试会优先换用其他上游
+            // 第 n 次重试前等待 retry_backoff * 2^n 秒 (不超过 retry_backoff_max，并加入随机抖动)
+            // 服务器返回的 Retry-After 大于 retry_backoff_max 时不再重试
+            "retry_max": 2,
+            "retry_backoff": 0.5,
+            "retry_backoff_max": 8,
+
+            // 请求是不幂等的 POST，默认只重试请求尚未发出的情况：建立连接失败 (包括连接超时) 和下面的状态码
+            // 429 / 503 表示服务器没有处理该请求；408/409/500/502/504 时服务器可能已经处理 (并计费)，
+            // 加入 retry_status_codes 后重试可能导致重复请求
+            "retry_status_codes": [429, 503],
+            // 是否在已经发出请求、尚未收到响应头时 (读取超时、连接被断开) 重试，同样可能导致重复请求
+            // 开始接收回复内容后 (包括 stream mode) 任何情况下都不会重试
+            "retry_read_error": false,
+
+            // 上游连续失败 (连接失败或返回 401/403/408/5xx，429 限流不计入) circuit_breaker_threshold 次后暂时停用，
+            // circuit_breaker_timeout 秒后放行一个探测请求，成功则恢复使用
+            "circuit_breaker_threshold": 5,
+            "circuit_breaker_timeout": 30,
+
+            // 每个会话中最多排队等待发送的消息数 (默认 -1 为无限制)
+            // 同一会话中的消息会按顺序发送，上一条消息回复后才会发送下一条
+            "session_queue_size": 8,
+
+            // 请求的传输方式，可选 "requests" 或 "asyncio"
+            // "asyncio" 需要安装 aiohttp，所有请求在同一个事件循环线程中进行，适合大量并发的 stream mode 请求
+            "transport": "requests",
         }
     }
 }
@@ -84,6 +203,19 @@ DEFAULT_CONFIG = {
         "log_output": True,
         "command_prefix": [".", "。", "!", "！"],
         "command_name": "chat",
+        "scheduler_workers": 8,             # the number of worker threads sending requests to the API servers
+        "scheduler_queue_size": 64,         # the max number of requests waiting in the scheduler queue
+        "database_synchronous": "NORMAL",   # PRAGMA synchronous of the log database connections (OFF / NORMAL / FULL / EXTRA)
+        "database_cache_size": -16000,      # PRAGMA cache_size of the log database connections (negative for KiB)
+        "database_mmap_size": 0,            # PRAGMA mmap_size of the log database connections in bytes (0 for disabled)
+        "database_write_behind": False,     # queue the messages in memory and write them in batched transactions
+        "database_batch_size": 64,          # write the queued messages every N messages
+        "database_batch_interval": 0.05,    # write the queued messages every N seconds
+        "session_cache_size": 1024,         # the max number of users whose active session is cached in memory (0 for disabled)
+        "client_cache_size": 1024,          # the max number of sessions whose context is kept in memory (-1 for no limit)
+        "client_cache_bytes": 67108864,     # the max total bytes of the contexts kept in memory (-1 for no limit)
+        "client_idle_timeout": 3600,        # drop the context of a session from memory after being idle for N seconds (-1 for never)
+        "stats_auth_level_required": 0,     # auth level required by `.chat stats` (default `0` for everyone)
     },
     "models": {
         "MODEL_NAME": {
@@ -97,7 +229,30 @@ DEFAULT_CONFIG = {
                                             # key: "auth_level"
             "max_context": -1,              # the max context length (default: -1 for no limit)
                                             # each message from either the user or the API server will be a context
-            "stream": False
+            "max_context_tokens": -1,       # the max tokens of the context (default: -1 for no limit), system messages are always kept
+            "reserved_completion_tokens": 1024,     # the tokens reserved for the reply in max_context_tokens
+            "stream": False,
+            "pool_size": 10,                # the size of the HTTP connection pool shared by all sessions of this model
+            "keep_alive": True,             # keep the HTTP connections alive between requests
+            "pool_idle_timeout": 60,        # close the pooled connections after being idle for N seconds (-1 for never)
+            "max_concurrency": -1,          # the max number of in-flight requests of this model (default: -1 for no limit)
+            "rate_limit_rpm": -1,           # the max requests per minute of this model and each API key (default: -1 for no limit)
+            "rate_limit_tpm": -1,           # the max tokens per minute of this model and each API key (default: -1 for no limit)
+            "rate_limit_wait": 30,          # the max seconds a request waits for the rate limit before it is dropped
+            "stream_flush": False,          # send the partial reply in stream mode as separate messages
+            "stream_flush_chars": 200,      # flush the partial reply when it is longer than N characters
+            "stream_flush_interval": 1.5,   # flush the partial reply every N seconds (at a sentence or paragraph boundary)
+            "stream_include_usage": False,  # ask the server for the token usage at the end of the stream (stream_options.include_usage)
+            "upstreams": [],                # the upstream servers: [{"url": ..., "api_key": ..., "weight": 1}] (default: url and api_key above)
+            "retry_max": 2,                 # the max retries of a request, preferring another upstream
+            "retry_backoff": 0.5,           # the base delay of the jittered exponential backoff (seconds)
+            "retry_backoff_max": 8,         # the max delay of the backoff (seconds), do not retry if Retry-After is longer
+            "retry_status_codes": [429, 503],   # the status codes to retry on, the request may be processed twice on 408/409/5xx
+            "retry_read_error": False,      # also retry read timeouts / disconnects before the response headers (may duplicate the request)
+            "circuit_breaker_threshold": 5, # take an upstream out of rotation after N consecutive failures
+            "circuit_breaker_timeout": 30,  # probe a disabled upstream again after N seconds
+            "session_queue_size": 8,        # the max number of messages waiting in the queue of each session (default: -1 for no limit)
+            "transport": "requests",        # "requests" or "asyncio" (aiohttp is needed)
         }
     }
 }
@@ -109,6 +264,19 @@ class ConfigBasic:
     log_output: bool
     command_prefix: list
     command_name: str
+    scheduler_workers: int
+    scheduler_queue_size: int
+    database_synchronous: str
+    database_cache_size: int
+    database_mmap_size: int
+    database_write_behind: bool
+    database_batch_size: int
+    database_batch_interval: float
+    session_cache_size: int
+    client_cache_size: int
+    client_cache_bytes: int
+    client_idle_timeout: float
+    stats_auth_level_required: int
 
 @dataclasses.dataclass()
 class ConfigModel:
@@ -120,11 +288,36 @@ class ConfigModel:
     timeout: int
     auth_level_required: int
     max_context: int
+    max_context_tokens: int
+    reserved_completion_tokens: int
     stream: bool
+    pool_size: int
+    keep_alive: bool
+    pool_idle_timeout: float
+    max_concurrency: int
+    rate_limit_rpm: int
+    rate_limit_tpm: int
+    rate_limit_wait: float
+    stream_flush: bool
+    stream_flush_chars: int
+    stream_flush_interval: float
+    stream_include_usage: bool
+    upstreams: list
+    retry_max: int
+    retry_backoff: float
+    retry_backoff_max: float
+    retry_status_codes: list
+    retry_read_error: bool
+    circuit_breaker_threshold: int
+    circuit_breaker_timeout: float
+    session_queue_size: int
+    transport: str
 
 class Config:
     def __init__(self, dict_config: dict):
-        basic= ConfigBasic(**dict_config["basic"])
+        tmp_conf_basic = DEFAULT_CONFIG["basic"].copy()
+        tmp_conf_basic.update(dict_config["basic"])
+        basic= ConfigBasic(**tmp_conf_basic)
         models = {}
         for key, value in dict_config["models"].items():
             tmp_conf_this = DEFAULT_CONFIG["models"]["MODEL_NAME"].copy()
@@ -13,6 +13,9 @@ gHook: dict[str, list] = {
     # 从API服务器接收到一条消息时调用
     "remote.recv": [
     ],
+    # 查看运行统计时调用
+    "stats.show": [
+    ],
 }
 
 def get_hook(hook_name: str):
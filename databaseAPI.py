@@ -18,7 +18,7 @@ r"""
 
         every time an user send a message / a message is sent to the user, the log handler will be called
         the log handler will record the message and the user's id, 
-        and save into different tables in the database according to the session id
+        and save into the message table of the database together with the session id
 
         the session id is computed by the user's id and the time when the user send the message
         when a session is over, the log handler will save the session id and the log table into a file
@@ -35,6 +35,8 @@ import pickle
 import uuid
 import json
 import dataclasses
+import collections
+import time
 
 try:
     import OlivOS
@@ -47,7 +49,8 @@ from concurrent.futures import ThreadPoolExecutor as PoolExecutor
 
 from . import utils, confAPI, exceptions
 
-DATABASE_SVN = 1
+DATABASE_SVN = 3
+SQLITE_SYNCHRONOUS = ("OFF", "NORMAL", "FULL", "EXTRA")
 DATABASE_PATH = os.path.join(".","plugin","data", "OlivaChatGPT","dataAll.db")
 class _StatusCodeBase:
     _code = None
@@ -187,6 +190,8 @@ class StatusCode:
 
 class _SqlScriptBase:
     data_class = None
+    # 是否为写操作 (INSERT/UPDATE/DELETE/DDL)，写操作统一由唯一的写线程执行
+    is_write = True
     def __init__(self, sql: str = "", format: "None | Dict[str, str]"=None, param: "None | Dict[str, Any]"=None, *_, need_return=False, **__):
         self.sql = sql
         self.sql_this = self.sql
@@ -246,6 +251,7 @@ class SessionTable(_TableDataBase):
     message: str
     time_record: str | None  = None
     status: int = 0
+    token_num: int | None = None
 
 @dataclasses.dataclass(frozen=True)
 class SessionModel:
@@ -266,7 +272,7 @@ class SqlAll:
                 """
                     创建一个日志总表，记录所有保存日志的表信息
                     session_name 为用户自定义的会话名称，用于显示
-                    session_id 为表名，通过 uuid 生成
+                    session_id 为会话 id，通过 uuid 生成，同时也是日志表中的 session_id
                     hash_user_id 为用户的 id，基于用户 uid 和 平台 platform 基于 sha1 计算
                     model_name 为模型名称
                     time_create_time 为表创建时间，自动记录
@@ -285,14 +291,16 @@ class SqlAll:
                         """
                     super().__init__(self.sql, *args, **kwargs)
 
-            class SESSION(_SqlScriptBase):
+            class MESSAGE(_SqlScriptBase):
                 """
-                    创建单个 session 的日志表，用来存储某一次会话的日志内容
-                    logline 为日志行号，自增
+                    创建日志表，所有 session 的日志都存储在这一张表中
+                    session_id 为该条日志所属的 session，对应总表中的 session_id
+                    logline 为日志在该 session 中的行号，从 1 开始递增
                     role 为日志角色，分为 user 和 assistant
                     message 为日志内容（消息或错误信息）
                     time_record 为日志记录时间，自动记录
                     status 为日志状态
+                    token_num 为该条消息的 token 数量，在写入时计算一次，NULL 表示尚未计算或只有估计值
                     
                         状态码:
                         00000   未设置
@@ -324,35 +332,77 @@ class SqlAll:
                         60xxx   本地错误消息
                           000   默认错误
                 """
-                def __init__(self, session_id: str, *args, **kwargs):
+                def __init__(self, *args, **kwargs):
                     self.sql ="""\
-                        CREATE TABLE IF NOT EXISTS table_log_{session_id}(
-                            logline                   INTEGER   PRIMARY KEY AUTOINCREMENT,
+                        CREATE TABLE IF NOT EXISTS table_message(
+                            session_id                TEXT      NOT NULL,
+                            logline                   INTEGER   NOT NULL,
                             role                      TEXT,
                             message                   TEXT,
                             time_record               DATETIME  DEFAULT CURRENT_TIMESTAMP,
-                            status                    INTEGER   DEFAULT 0
+                            status                    INTEGER   DEFAULT 0,
+                            token_num                 INTEGER   DEFAULT NULL,
+                            PRIMARY KEY (session_id, logline)
                             );
                         """
-                    format = {"session_id": session_id}
-                    super().__init__(self.sql, format=format, *args, **kwargs)
+                    super().__init__(self.sql, *args, **kwargs)
+
+        class INDEX:
+            class MESSAGE(_SqlScriptBase):
+                """
+                    为日志表创建 (session_id, status, logline) 索引，用于按状态读取某个 session 的日志
+                """
+                def __init__(self, *args, **kwargs):
+                    self.sql ="""\
+                        CREATE INDEX IF NOT EXISTS index_message_status
+                        ON table_message(session_id, status, logline);
+                        """
+                    super().__init__(self.sql, *args, **kwargs)
+
+            class MESSAGE_SYSTEM(_SqlScriptBase):
+                """
+                    为日志表中的 system 消息创建部分索引，用于重建上下文时单独读取固定保留的 system 消息
+                """
+                def __init__(self, *args, **kwargs):
+                    self.sql ="""\
+                        CREATE INDEX IF NOT EXISTS index_message_system
+                        ON table_message(session_id, logline)
+                        WHERE role = 'system';
+                        """
+                    super().__init__(self.sql, *args, **kwargs)
 
         class TRIGGER:
-            class SESSION(_SqlScriptBase):
+            class MESSAGE(_SqlScriptBase):
                 """
-                    创建一个触发器，当某个 session 的日志表被更新时，更新总表的最后更新时间
+                    创建一个触发器，当日志表中插入新日志时，更新总表中对应 session 的最后更新时间
                 """
-                def __init__(self, session_id: str, *args, **kwargs):
+                def __init__(self, *args, **kwargs):
                     self.sql ="""\
-                        CREATE TRIGGER IF NOT EXISTS trigger_{session_id}
-                        BEFORE INSERT ON table_log_{session_id}
+                        CREATE TRIGGER IF NOT EXISTS trigger_message
+                        AFTER INSERT ON table_message
                         FOR EACH ROW
                         BEGIN
                             UPDATE OR IGNORE table_master
                             SET time_last_update = CURRENT_TIMESTAMP
-                            WHERE session_id = "{session_id}";
+                            WHERE session_id = NEW.session_id;
                         END;
                         """
+                    super().__init__(self.sql, *args, **kwargs)
+
+    class ALTER:
+        """
+            数据库版本迁移时修改表结构的 sql 指令
+        """
+        class TABLE:
+            class SESSION_TOKEN_NUM(_SqlScriptBase):
+                """
+                    (SVN 1 -> 2) 为单个 session 的日志表添加 token_num 列
+                """
+                def __init__(self, session_id: str, *args, **kwargs):
+                    self.sql ="""\
+                        ALTER TABLE table_log_{session_id}
+                        ADD COLUMN token_num INTEGER DEFAULT NULL;
+                        """
                     format = {"session_id": session_id}
                     super().__init__(self.sql, format=format, *args, **kwargs)
 
@@ -360,39 +410,60 @@ class SqlAll:
         class MESSAGE(_SqlScriptBase):
             """
                 更新日志的信息
-                session_id 为表名，通过 uuid 生成
+                session_id 为日志所属的 session，通过 uuid 生成
                 linenum 为日志行号，为负数时表示从最后一行开始计数
                 role 为日志角色，分为 user 和 assistant
                 message 为日志内容
                 status 为日志状态
+                token_num 为消息的 token 数量
             """
-            def __init__(self, session_id: str, linenum: int, role: str|None=None, message: str|None=None, status: int|None=None, line_status_max=None,*args, **kwargs):
-                if role is None and message is None and status is None:
+            def __init__(self, session_id: str, linenum: int, role: str|None=None, message: str|None=None, status: int|None=None, line_status_max=None, token_num: int|None=None, *args, **kwargs):
+                if role is None and message is None and status is None and token_num is None:
                     raise exceptions.OlivaChatGPTDatabseError("No update information")
                 self.sql ="""\
-                    UPDATE table_log_{session_id}
+                    UPDATE table_message
                     SET {set_str}
-                    WHERE {where_str};
+                    WHERE session_id = :session_id AND {where_str};
                     """
-                param = {"linenum": linenum, "role": role, "message": message, "status": status}
-                set_str = ", ".join([f"{k} = :{k}" for k in ["role", "message", "status"] if param.get(k, None) is not None])
+                param = {"session_id": session_id, "linenum": linenum, "role": role, "message": message, "status": status, "token_num": token_num}
+                set_str = ", ".join([f"{k} = :{k}" for k in ["role", "message", "status", "token_num"] if param.get(k, None) is not None])
                 
                 if linenum >= 0:
                     where_str = "logline = :linenum"
                 else:
                     if line_status_max is None:
-                        where_str = f"logline = (SELECT MAX(logline) FROM table_log_{session_id}) + :linenum + 1"
+                        where_str = "logline = (SELECT MAX(logline) FROM table_message WHERE session_id = :session_id) + :linenum + 1"
                     else:
-                        where_str = f"logline = (SELECT MAX(logline) FROM table_log_{session_id} WHERE status < {line_status_max}) + :linenum + 1"
-                format = {"session_id": session_id, "set_str": set_str, "where_str": where_str}
+                        where_str = f"logline = (SELECT MAX(logline) FROM table_message WHERE session_id = :session_id AND status < {line_status_max}) + :linenum + 1"
+                format = {"set_str": set_str, "where_str": where_str}
                 super().__init__(self.sql, format=format, param=param, *args, **kwargs)
 
+        class RECALL(_SqlScriptBase):
+            """
+                撤回某个 session 最后 num 条状态码小于 status_max 的日志，将其状态码加上 target_add
+                session_id 为日志所属的 session，通过 uuid 生成
+            """
+            def __init__(self, session_id: str, num: int, target_add: int = 20000, status_max: int = 20000, *args, **kwargs):
+                # +status 使子查询沿主键 (session_id, logline) 倒序扫描，只读取最后几行
+                self.sql ="""\
+                    UPDATE table_message
+                    SET status = status + :target_add
+                    WHERE session_id = :session_id AND logline IN (
+                        SELECT logline FROM table_message
+                        WHERE session_id = :session_id AND +status < :status
+                        ORDER BY logline DESC
+                        LIMIT :num
+                    );
+                    """
+                param = {"session_id": session_id, "num": num, "target_add": target_add, "status": status_max}
+                super().__init__(self.sql, param=param, *args, **kwargs)
+
     class INSERT:
         class SESSION(_SqlScriptBase):
             """
                 插入一条 session 信息，如果 session 已存在则替换
                 session_name 为用户自定义的会话名称，用于显示
-                session_id 为表名，通过 uuid 生成
+                session_id 为会话 id，通过 uuid 生成
                 hash_user_id 为用户的 id，基于用户 uid 和 平台 platform 基于 sha1 计算
                 model_name 为模型名称
             """
@@ -408,27 +479,46 @@ class SqlAll:
 
         class MESSAGE(_SqlScriptBase):
             """
-                插入一条日志信息，如果日志已存在则替换
-                session_id 为表名，通过 uuid 生成
+                插入一条日志信息，行号为该 session 当前最大行号 + 1
+                session_id 为日志所属的 session，通过 uuid 生成
                 role 为日志角色，分为 user 和 assistant
                 message 为日志内容
+                token_num 为消息的 token 数量，None 表示未计算
             """
-            def __init__(self, session_id: str, role: str, message: str, status: int=10000,*args, **kwargs):
+            def __init__(self, session_id: str, role: str, message: str, status: int=10000, token_num: int|None=None, *args, **kwargs):
                 self.sql ="""\
-                    INSERT OR REPLACE INTO table_log_{session_id}(
-                        "role", "message", "status"
+                    INSERT INTO table_message(
+                        "session_id", "logline", "role", "message", "status", "token_num"
                     )
-                    VALUES (:role, :message, :status);
+                    VALUES (
+                        :session_id,
+                        (SELECT COALESCE(MAX(logline), 0) + 1 FROM table_message WHERE session_id = :session_id),
+                        :role, :message, :status, :token_num
+                    );
+                    """
+                param = {"session_id": session_id, "role": role, "message": message, "status": status, "token_num": token_num}
+                super().__init__(self.sql, param=param, *args, **kwargs)
+
+        class MESSAGE_FROM_TABLE_LOG(_SqlScriptBase):
+            """
+                (SVN 2 -> 3) 将旧版单个 session 的日志表整体复制到日志表中
+            """
+            def __init__(self, session_id: str, *args, **kwargs):
+                self.sql ="""\
+                    INSERT INTO table_message(
+                        "session_id", "logline", "role", "message", "time_record", "status", "token_num"
+                    )
+                    SELECT :session_id, logline, role, message, time_record, status, token_num FROM table_log_{session_id};
                     """
                 format = {"session_id": session_id}
-                param = {"role": role, "message": message, "status": status}
+                param = {"session_id": session_id}
                 super().__init__(self.sql, format=format, param=param, *args, **kwargs)
 
     class DELETE:
         class SESSION(_SqlScriptBase):
             """
                 删除 session 信息
-                session_id 为表名，通过 uuid 生成
+                session_id 为会话 id，通过 uuid 生成
             """
             def __init__(self, session_id: str, *args, **kwargs):
                 self.sql ="""\
@@ -440,7 +530,19 @@ class SqlAll:
 
         class MESSAGE(_SqlScriptBase):
             """
-                删除 session 日志表
+                删除某个 session 的所有日志
+            """
+            def __init__(self, session_id: str, *args, **kwargs):
+                self.sql ="""\
+                    DELETE FROM table_message
+                    WHERE session_id = :session_id;
+                    """
+                param = {"session_id": session_id}
+                super().__init__(self.sql, param=param, *args, **kwargs)
+
+        class TABLE_LOG(_SqlScriptBase):
+            """
+                (SVN 2 -> 3) 删除旧版单个 session 的日志表
             """
             def __init__(self, session_id: str, *args, **kwargs):
                 self.sql ="""\
@@ -451,7 +553,7 @@ class SqlAll:
 
         class TRIGGER(_SqlScriptBase):
             """
-                删除 session 触发器
+                (SVN 2 -> 3) 删除旧版单个 session 的触发器
             """
             def __init__(self, session_id: str, *args, **kwargs):
                 self.sql ="""\
@@ -467,6 +569,7 @@ class SqlAll:
                 hash_user_id 为用户的 id，基于用户 uid 和 平台 platform 基于 sha1 计算
             """
             data_class = MasterTable
+            is_write = False
             def __init__(self, hash_user_id: str, *, need_return=True, **kwargs):
                 self.sql ="""\
                     SELECT session_name, session_id, hash_user_id, time_create_time, model_name, time_last_update FROM table_master
@@ -477,29 +580,93 @@ class SqlAll:
 
         class SESSION(_SqlScriptBase):
             """
-                查询某个 session 的所有日志信息
-                session_id 为表名，通过 uuid 生成
+                查询某个 session 的日志信息，按行号排序
+                session_id 为日志所属的 session，通过 uuid 生成
                 status_max 为输出日志状态码的最大值
+                num 为 0 时返回所有日志，为正数时返回最前面 num 条，为负数时返回最后 -num 条
             """
             data_class = SessionTable
-            def __init__(self, session_id: str, status_max = 40000, *, need_return=True, **kwargs):
+            is_write = False
+            def __init__(self, session_id: str, status_max = 40000, num: int = 0, *, need_return=True, **kwargs):
+                if num >= 0:
+                    self.sql ="""\
+                        SELECT logline, role, message, status, time_record, token_num FROM table_message
+                        WHERE session_id = :session_id AND status < :status
+                        ORDER BY logline
+                        LIMIT :limit;
+                        """
+                else:
+                    # 先沿主键倒序取出最后几行，再恢复正序；+status 避免使用状态索引后对全部日志排序
+                    self.sql ="""\
+                        SELECT * FROM (
+                            SELECT logline, role, message, status, time_record, token_num FROM table_message
+                            WHERE session_id = :session_id AND +status < :status
+                            ORDER BY logline DESC
+                            LIMIT :limit
+                        )
+                        ORDER BY logline;
+                        """
+                # sqlite 中 LIMIT -1 表示不限制
+                param = {"session_id": session_id, "status": status_max, "limit": abs(num) if num != 0 else -1}
+                super().__init__(self.sql, param=param, need_return=need_return, **kwargs)
+
+        class SESSION_SYSTEM(_SqlScriptBase):
+            """
+                查询某个 session 中所有状态码小于 status_max 的 system 日志，按行号排序
+            """
+            data_class = SessionTable
+            is_write = False
+            def __init__(self, session_id: str, status_max = 20000, *, need_return=True, **kwargs):
                 self.sql ="""\
-                    SELECT logline, role, message, status, time_record FROM table_log_{session_id}
-                    WHERE status < :status;
+                    SELECT logline, role, message, status, time_record, token_num FROM table_message
+                    WHERE session_id = :session_id AND role = 'system' AND status < :status
+                    ORDER BY logline;
                     """
-                format = {"session_id": session_id}
-                param = {"status": status_max}
-                super().__init__(self.sql, format=format, param=param, need_return=need_return, **kwargs)
+                param = {"session_id": session_id, "status": status_max}
+                super().__init__(self.sql, param=param, need_return=need_return, **kwargs)
+
+        class SESSION_BEFORE(_SqlScriptBase):
+            """
+                从 logline_max (不含) 开始倒序查询某个 session 中最多 num 条状态码小于 status_max 的非 system 日志
+                logline_max 为 None 时从最后一行开始
+                用于重建上下文时分页读取最近的日志
+            """
+            data_class = SessionTable
+            is_write = False
+            def __init__(self, session_id: str, num: int, logline_max: "int|None" = None, status_max = 20000, *, need_return=True, **kwargs):
+                self.sql ="""\
+                    SELECT logline, role, message, status, time_record, token_num FROM table_message
+                    WHERE session_id = :session_id AND logline < :logline_max AND +status < :status AND role != 'system'
+                    ORDER BY logline DESC
+                    LIMIT :limit;
+                    """
+                if logline_max is None:
+                    logline_max = 2 ** 63 - 1
+                param = {"session_id": session_id, "logline_max": logline_max, "status": status_max, "limit": num}
+                super().__init__(self.sql, param=param, need_return=need_return, **kwargs)
+
+        class TABLE_LOG(_SqlScriptBase):
+            """
+                查询数据库中所有旧版单个 session 的日志表名
+            """
+            is_write = False
+            def __init__(self, *, need_return=True, **kwargs):
+                self.sql ="""\
+                    SELECT name FROM sqlite_master
+                    WHERE type = 'table' AND name LIKE 'table_log_%';
+                    """
+                super().__init__(self.sql, need_return=need_return, **kwargs)
 
     class PRAGMA:
         """
-            pragma 元数据（数据库自身的版本号）
+            pragma 元数据（数据库自身的版本号）与连接参数
         """
         class GET:
             class VERSION(_SqlScriptBase):
                 """
                 获取数据库 user_version 元数据
                 """
+                is_write = False
                 def __init__(self, *args, **kwargs):
                     self.sql ="""PRAGMA user_version ;"""
                     super().__init__(self.sql, *args, **kwargs)
@@ -514,6 +681,42 @@ class SqlAll:
                     format = {"ver": str(ver)}
                     super().__init__(self.sql, format=format, *args, **kwargs)
 
+            class JOURNAL_MODE(_SqlScriptBase):
+                """
+                设置数据库日志模式 (WAL 模式会持久保存在数据库文件中)
+                """
+                def __init__(self, mode: str = "WAL", *args, **kwargs):
+                    self.sql ="""PRAGMA journal_mode = {mode} ;"""
+                    format = {"mode": mode}
+                    super().__init__(self.sql, format=format, *args, **kwargs)
+
+            class SYNCHRONOUS(_SqlScriptBase):
+                """
+                设置当前连接的 synchronous 参数 (OFF / NORMAL / FULL / EXTRA)
+                """
+                def __init__(self, mode: str = "NORMAL", *args, **kwargs):
+                    self.sql ="""PRAGMA synchronous = {mode} ;"""
+                    format = {"mode": mode}
+                    super().__init__(self.sql, format=format, *args, **kwargs)
+
+            class CACHE_SIZE(_SqlScriptBase):
+                """
+                设置当前连接的页缓存大小，正数为页数，负数为 KiB
+                """
+                def __init__(self, size: int = -16000, *args, **kwargs):
+                    self.sql ="""PRAGMA cache_size = {size} ;"""
+                    format = {"size": str(int(size))}
+                    super().__init__(self.sql, format=format, *args, **kwargs)
+
+            class MMAP_SIZE(_SqlScriptBase):
+                """
+                设置当前连接的内存映射大小 (字节)，0 为不使用内存映射
+                """
+                def __init__(self, size: int = 0, *args, **kwargs):
+                    self.sql ="""PRAGMA mmap_size = {size} ;"""
+                    format = {"size": str(int(size))}
+                    super().__init__(self.sql, format=format, *args, **kwargs)
+
 # function
 def get_session_id_new(*_, **__):
     """
@@ -545,6 +748,12 @@ class _DataBaseAPI:
     默认情况下，数据库连接池中的连接会在插件被卸载时自动关闭，如果需要手动关闭，请调用 stop() 函数
 
     数据库默认存储在 `plugin/data/OlivaChatGPT/` 目录下，文件名为 `dataAll.db`
+
+    数据库使用 WAL 模式，所有写操作由唯一的写线程 (独立连接) 依次执行，读操作由读线程池并行执行
+
+    开启 write_behind 后，save_message 只将日志放入内存队列并立即返回，
+    由后台线程每 batch_size 条或每 batch_interval 秒在同一个事务中批量写入；
+    读取、更新、撤回、删除某个 session 前会先等待该 session 尚未写入的日志写入完成
     """
     class _sqlscript:
         """
@@ -594,31 +803,69 @@ class _DataBaseAPI:
             self.conn.commit()
             self.cur.close()
 
-    def __init__(self, proc_log = None, max_thread: "int | None" = None, timeout: float = 1):
+    def __init__(self, proc_log = None, max_thread: "int | None" = None, timeout: float = 1, synchronous: str = "NORMAL", cache_size: int = -16000, mmap_size: int = 0, write_behind: bool = False, batch_size: int = 64, batch_interval: float = 0.05):
         """
         初始化数据库连接池
 
         `proc_log`: 日志处理函数，默认为 print
-        `max_thread`: 最大线程数，默认为 None，即不限制
+        `max_thread`: 读线程池的最大线程数，默认为 None，即不限制
         `timeout`: 数据库操作超时时间，默认为 1 秒
+        `synchronous`: 每个连接的 synchronous 参数，WAL 模式下 NORMAL 即可保证数据库不会损坏
+        `cache_size`: 每个连接的页缓存大小，正数为页数，负数为 KiB
+        `mmap_size`: 每个连接的内存映射大小 (字节)，0 为不使用内存映射
+        `write_behind`: 是否延迟批量写入 save_message 的日志
+        `batch_size`: 延迟写入时每个事务最多写入的日志条数
+        `batch_interval`: 延迟写入时日志在队列中最多等待的时间 (秒)
         """
         if proc_log is None:
             proc_log = print
+        synchronous = str(synchronous).upper()
+        if synchronous not in SQLITE_SYNCHRONOUS:
+            raise exceptions.OlivaChatGPTDatabseError(f"synchronous should be one of {SQLITE_SYNCHRONOUS}, got {synchronous}")
 
         os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
         self.proc_log = proc_log
         self.timeout = timeout
         self.namespace_list = []
-        self._thread_pool = PoolExecutor(max_thread, initializer=self.__init_thread)
+        self._pragma_list: "List[_SqlScriptBase]" = [
+            SqlAll.PRAGMA.SET.SYNCHRONOUS(synchronous),
+            SqlAll.PRAGMA.SET.CACHE_SIZE(cache_size),
+            SqlAll.PRAGMA.SET.MMAP_SIZE(mmap_size),
+        ]
         self.__conn_all = {}
+        self._thread_pool = PoolExecutor(max_thread, thread_name_prefix="OlivaChatGPT-db-read", initializer=self.__init_thread)
+        self._thread_writer = PoolExecutor(1, thread_name_prefix="OlivaChatGPT-db-write", initializer=self.__init_thread, initargs=(True,))
         self._init_database()
 
-    def __init_thread(self):
+        self.write_behind = write_behind
+        self.batch_size = max(batch_size, 1)
+        self.batch_interval = max(batch_interval, 0)
+        self._write_cond = threading.Condition()
+        # 队列元素为 (序号, session_id, sql 指令, 入队时间)
+        self._write_queue: "collections.deque[Tuple[int, str, _SqlScriptBase, float]]" = collections.deque()
+        self._write_seq = 0                                 # 最后一条入队日志的序号
+        self._write_done = 0                                # 最后一条写入完成 (或写入失败) 日志的序号
+        self._write_seq_session: "Dict[str, int]" = {}      # 每个 session 最后一条尚未写入日志的序号
+        self._write_flush_waiting = 0
+        self._flag_stop = False
+        self._thread_write_behind = None
+        if self.write_behind:
+            self._thread_write_behind = threading.Thread(
+                target=self.__run_write_behind, name="OlivaChatGPT-db-write-behind", daemon=True
+            )
+            self._thread_write_behind.start()
+
+    def __init_thread(self, flag_writer: bool = False):
         "线程池中每个线程的初始化过程，进行数据库连接"
         name = threading.current_thread().name
         # 为方便在主线程一并关闭所有连接 check_same_thread 设为 False
         conn= sqlite3.connect(database=DATABASE_PATH, timeout=self.timeout, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        if flag_writer:
+            # journal_mode 会持久保存在数据库文件中，由写线程设置一次即可
+            conn.execute(*SqlAll.PRAGMA.SET.JOURNAL_MODE("WAL").get())
+        for script in self._pragma_list:
+            conn.execute(*script.get())
         self.__conn_all[name] = conn
         # self.proc_log(0, f"thread init <{name}>")
 
@@ -637,6 +884,59 @@ class _DataBaseAPI:
                     res[data] = []
         return res
 
+    def __run_write_behind(self):
+        "延迟写入线程，将队列中的日志按批次交给写线程，每个批次为一个事务"
+        while True:
+            with self._write_cond:
+                while len(self._write_queue) == 0 and not self._flag_stop:
+                    self._write_cond.wait()
+                if len(self._write_queue) == 0:
+                    return
+                # 凑满一个批次，或等待最早入队的日志超过 batch_interval，有 flush 请求或停止时立即写入
+                deadline = self._write_queue[0][3] + self.batch_interval
+                while len(self._write_queue) < self.batch_size and self._write_flush_waiting == 0 and not self._flag_stop:
+                    time_remain = deadline - time.monotonic()
+                    if time_remain <= 0:
+                        break
+                    self._write_cond.wait(time_remain)
+                batch = [self._write_queue.popleft() for _ in range(min(self.batch_size, len(self._write_queue)))]
+            try:
+                self._thread_writer.submit(self.__run_sql_thread, [i[2] for i in batch]).result()
+            except Exception as err:
+                # 事务已回滚，具体错误已由 _sqlconn 记录
+                self.proc_log(4, f"OlivaChatGPT DataBaseAPI: {len(batch)} messages dropped in write-behind: {err.__class__.__name__}: {err}")
+            with self._write_cond:
+                self._write_done = batch[-1][0]
+                for seq, session_id, _, _ in batch:
+                    if self._write_seq_session.get(session_id) == seq:
+                        del self._write_seq_session[session_id]
+                self._write_cond.notify_all()
+
+    def flush(self, session_id: "str|SessionModel|None" = None, timeout: "float|None" = None) -> bool:
+        """
+        等待延迟写入的日志写入完成
+
+        `session_id`: 只等待该 session 的日志，None 为等待所有日志
+        `timeout`: 最长等待时间，None 为一直等待
+
+        返回是否在超时前写入完成
+        """
+        if isinstance(session_id, SessionModel):
+            session_id = session_id.session_id
+        with self._write_cond:
+            if session_id is None:
+                target = self._write_seq
+            else:
+                target = self._write_seq_session.get(session_id, 0)
+            if self._write_done >= target:
+                return True
+            self._write_flush_waiting += 1
+            self._write_cond.notify_all()
+            try:
+                return self._write_cond.wait_for(lambda: self._write_done >= target, timeout)
+            finally:
+                self._write_flush_waiting -= 1
+
     def _init_database(self):
         "对数据库进行总体初始化"
         sql_list = [
@@ -650,9 +950,58 @@ class _DataBaseAPI:
             if svn == 0:
                 # svn 不存在，为新建的sqlite数据库
                 self._exec(SqlAll.PRAGMA.SET.VERSION(DATABASE_SVN))
+            elif svn < DATABASE_SVN:
+                self._migrate(svn)
             else:
                 self.proc_log(3, "数据库版本不符合，数据库版本为{0}，所需版本为{1}".format(svn, DATABASE_SVN))
                 raise exceptions.OlivaChatGPTDatabseError("数据库版本不符合，数据库版本为{0}，所需版本为{1}".format(svn, DATABASE_SVN))
+
+        # 触发器需要在迁移完成后再创建，否则复制旧日志时会刷新所有 session 的最后更新时间
+        self._execmany(self._create_message_table() + [SqlAll.CREATE.TRIGGER.MESSAGE()])
+
+    def _create_message_table(self) -> "List[_SqlScriptBase]":
+        "创建日志表及其索引"
+        return [
+            SqlAll.CREATE.TABLE.MESSAGE(),
+            SqlAll.CREATE.INDEX.MESSAGE(),
+            SqlAll.CREATE.INDEX.MESSAGE_SYSTEM(),
+        ]
+
+    def _migrate(self, svn: int):
+        """
+        将数据库从 svn 版本逐级迁移到 DATABASE_SVN 版本
+        每一级迁移与版本号的修改在同一个事务中完成
+        """
+        migration = {
+            1: self._migrate_1_to_2,
+            2: self._migrate_2_to_3,
+        }
+        while svn < DATABASE_SVN:
+            self.proc_log(2, "数据库版本迁移：{0} -> {1}".format(svn, svn + 1))
+            sql_list = migration[svn]()
+            sql_list.append(SqlAll.PRAGMA.SET.VERSION(svn + 1))
+            self._execmany(sql_list, timeout=None)
+            svn += 1
+
+    def _get_session_table_list(self) -> "List[str]":
+        "获取数据库中所有 session 日志表对应的 session_id"
+        res = self._exec(SqlAll.SELECT.TABLE_LOG())
+        return [i[0][len("table_log_"):] for i in res]
+
+    def _migrate_1_to_2(self) -> "List[_SqlScriptBase]":
+        "SVN 1 -> 2: 日志表添加 token_num 列"
+        return [SqlAll.ALTER.TABLE.SESSION_TOKEN_NUM(i) for i in self._get_session_table_list()]
+
+    def _migrate_2_to_3(self) -> "List[_SqlScriptBase]":
+        "SVN 2 -> 3: 所有 session 的日志表合并为一张日志表，删除旧的日志表与触发器"
+        sql_list = self._create_message_table()
+        for session_id in self._get_session_table_list():
+            sql_list.extend([
+                SqlAll.INSERT.MESSAGE_FROM_TABLE_LOG(session_id),
+                SqlAll.DELETE.TABLE_LOG(session_id),
+                SqlAll.DELETE.TRIGGER(session_id),
+            ])
+        return sql_list
     
     def init_session(self, platform: "str",  user_id: "str| int", session_name: str|None = None, model_name: "str|None"=None, *_, **__) -> SessionModel:
         """
@@ -664,22 +1013,28 @@ class _DataBaseAPI:
         if session_name is None:
             session_name = session_id
         hash_user_id = get_user_hash(platform, user_id)
-        sql_list = [
-            SqlAll.CREATE.TABLE.SESSION(session_id),
-            SqlAll.CREATE.TRIGGER.SESSION(session_id),
-            SqlAll.INSERT.SESSION(session_name, session_id, hash_user_id, model_name),
-        ]
-        self._execmany(sql_list)
+        self._exec(SqlAll.INSERT.SESSION(session_name, session_id, hash_user_id, model_name))
         session_model = SessionModel(session_id, model_name, session_name)
         return session_model
 
-    def save_message(self, session_id: "str|SessionModel", role: "str", message: "str", status: "int"=0,*_, **__):
+    def save_message(self, session_id: "str|SessionModel", role: "str", message: "str", status: "int"=0, token_num: "int|None"=None, *_, **__):
         """
         保存一条日志信息
         """
         if isinstance(session_id, SessionModel):
             session_id = session_id.session_id
-        sql_list = SqlAll.INSERT.MESSAGE(session_id, role, message, status)
+        sql_list = SqlAll.INSERT.MESSAGE(session_id, role, message, status, token_num)
+        if self.write_behind:
+            with self._write_cond:
+                if self._flag_stop:
+                    raise exceptions.OlivaChatGPTDatabseError("DataBaseAPI has been stopped")
+                self._write_seq += 1
+                self._write_queue.append((self._write_seq, session_id, sql_list, time.monotonic()))
+                self._write_seq_session[session_id] = self._write_seq
+                # 队列由空变为非空 (开始计时) 或凑满一个批次时唤醒延迟写入线程
+                if len(self._write_queue) == 1 or len(self._write_queue) >= self.batch_size:
+                    self._write_cond.notify_all()
+            return True
         self._exec(sql_list)
         return True
     
@@ -687,7 +1042,7 @@ class _DataBaseAPI:
         """
         更新一条日志信息
 
-            session_id 为表名，通过 uuid 生成
+            session_id 为会话 id，通过 uuid 生成
             linenum 为日志行号，为负数时表示从最后一行开始计数
             role 为日志角色
             message 为日志内容
@@ -695,9 +1050,25 @@ class _DataBaseAPI:
         """
         if isinstance(session_id, SessionModel):
             session_id = session_id.session_id
+        self.flush(session_id)
         sql_list = SqlAll.UPDATE.MESSAGE(session_id, linenum, role, message, status)
         self._exec(sql_list)
         return True
+
+    def update_token_num(self, session_id: "str|SessionModel", token_list: "Sequence[Tuple[int, int]]", *_, **__):
+        """
+        批量回填日志的 token 数量
+
+            token_list 为 (logline, token_num) 的列表
+        """
+        if isinstance(session_id, SessionModel):
+            session_id = session_id.session_id
+        self.flush(session_id)
+        if len(token_list) == 0:
+            return True
+        sql_list = [SqlAll.UPDATE.MESSAGE(session_id, logline, token_num=token_num) for logline, token_num in token_list]
+        self._execmany(sql_list)
+        return True
     
     def get_session_list(self, platform: "str",  user_id: "str| int", *_, **__) -> "List[MasterTable]":
         """
@@ -709,9 +1080,10 @@ class _DataBaseAPI:
         data = [MasterTable.init_by_row(i) for i in res]
         return data
     
-    def get_session_message(self, session_id: "str|SessionModel", status_max: "int" = 40000, *_, **__) -> "List[SessionTable]":
+    def get_session_message(self, session_id: "str|SessionModel", status_max: "int" = 40000, num: "int" = 0, *_, **__) -> "List[SessionTable]":
         """
-        获取一个 session 的所有日志信息
+        获取一个 session 的日志信息
+        num 为 0 时返回所有日志，为正数时返回最前面 num 条，为负数时返回最后 -num 条
         
         输出一个列表, 格式如下:
         [
@@ -732,10 +1104,41 @@ class _DataBaseAPI:
         """
         if isinstance(session_id, SessionModel):
             session_id = session_id.session_id
-        sql_list = SqlAll.SELECT.SESSION(session_id, status_max)
+        self.flush(session_id)
+        sql_list = SqlAll.SELECT.SESSION(session_id, status_max, num)
         res = self._exec(sql_list)
         data = [SessionTable.init_by_row(i) for i in res]
         return data
+
+    def get_session_system_message(self, session_id: "str|SessionModel", status_max: "int" = 20000, *_, **__) -> "List[SessionTable]":
+        """
+        获取一个 session 的所有 system 日志
+        """
+        if isinstance(session_id, SessionModel):
+            session_id = session_id.session_id
+        self.flush(session_id)
+        res = self._exec(SqlAll.SELECT.SESSION_SYSTEM(session_id, status_max))
+        return [SessionTable.init_by_row(i) for i in res]
+
+    def get_session_message_before(self, session_id: "str|SessionModel", num: "int", logline_max: "int|None" = None, status_max: "int" = 20000, *_, **__) -> "List[SessionTable]":
+        """
+        获取一个 session 中行号小于 logline_max 的最后 num 条非 system 日志，按行号倒序排列
+        """
+        if isinstance(session_id, SessionModel):
+            session_id = session_id.session_id
+        self.flush(session_id)
+        res = self._exec(SqlAll.SELECT.SESSION_BEFORE(session_id, num, logline_max, status_max))
+        return [SessionTable.init_by_row(i) for i in res]
+
+    def recall_message(self, session_id: "str|SessionModel", num: "int", target_add: "int" = 20000, status_max: "int" = 20000, *_, **__):
+        """
+        撤回一个 session 最后 num 条状态码小于 status_max 的日志 (在同一条 sql 指令中完成)
+        """
+        if isinstance(session_id, SessionModel):
+            session_id = session_id.session_id
+        self.flush(session_id)
+        self._exec(SqlAll.UPDATE.RECALL(session_id, num, target_add, status_max))
+        return True
     
     def delete_session(self, session_id: "str|SessionModel", *_, **__):
         """
@@ -743,34 +1146,107 @@ class _DataBaseAPI:
         """
         if isinstance(session_id, SessionModel):
             session_id = session_id.session_id
+        self.flush(session_id)
         sql_list = [
             SqlAll.DELETE.SESSION(session_id),
             SqlAll.DELETE.MESSAGE(session_id),
-            SqlAll.DELETE.TRIGGER(session_id),
         ]
         self._execmany(sql_list)
         return True
 
-    def _execmany(self, sql_list: "List[_SqlScriptBase]"):
+    def _get_pool(self, sql_list: "List[_SqlScriptBase]") -> PoolExecutor:
+        "包含写操作的指令队列交给写线程，只读的指令队列交给读线程池"
+        if any(i.is_write for i in sql_list):
+            return self._thread_writer
+        return self._thread_pool
+
+    def _execmany(self, sql_list: "List[_SqlScriptBase]", timeout: "float|None|Literal[-1]" = -1):
         """
-        低层次接口函数，一次性运行多个 sql 指令
+        低层次接口函数，一次性运行多个 sql 指令 (在同一个事务中)
+
+        `timeout`: 等待结果的超时时间，默认使用初始化时的 timeout，None 为一直等待
         """
-        r = self._thread_pool.submit(self.__run_sql_thread, sql_list)
-        return r.result(self.timeout)
+        if timeout == -1:
+            timeout = self.timeout
+        r = self._get_pool(sql_list).submit(self.__run_sql_thread, sql_list)
+        return r.result(timeout)
 
     def _exec(self, sql: "_SqlScriptBase"):
         """
         低层次接口函数，直接运行对应的 sql 指令，完成数据库操作
         """
-        r = self._thread_pool.submit(self.__run_sql_thread, [sql,])
+        r = self._get_pool([sql,]).submit(self.__run_sql_thread, [sql,])
         return r.result(self.timeout)[sql]
 
     def stop(self):
+        with self._write_cond:
+            self._flag_stop = True
+            self._write_cond.notify_all()
+        if self._thread_write_behind is not None:
+            # 停止前写入队列中剩余的所有日志
+            self._thread_write_behind.join()
+        self._thread_writer.shutdown()
         self._thread_pool.shutdown()
         for conn in self.__conn_all.values():
             conn.close()
         self.__conn_all = {}
 
+class _SessionModelCache:
+    """
+        用户当前激活的 session model 的内存缓存 (LRU)
+
+        键为 (platform, user_id)，值为 SessionModel 或 None (用户当前没有激活的会话)
+        写入配置项数据库的同时更新缓存，缓存未命中时才读取配置项数据库
+    """
+    _MISS = object()
+
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self._lock = threading.Lock()
+        self._cache: "collections.OrderedDict[Tuple[str, str], SessionModel|None]" = collections.OrderedDict()
+        self.hit = 0
+        self.miss = 0
+
+    def get(self, platform: "str", user_id: "str|int") -> "SessionModel|None|object":
+        "获取缓存的 session model，未命中时返回 _SessionModelCache._MISS"
+        key = (platform, str(user_id))
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hit += 1
+                return self._cache[key]
+            self.miss += 1
+            return self._MISS
+
+    def set(self, platform: "str", user_id: "str|int", session_model: "SessionModel|None", flag_overwrite: bool = True):
+        """
+            写入缓存
+            flag_overwrite 为 False 时 (未命中后回填)，不覆盖期间由 set_active_session_model 写入的新值
+        """
+        if self.size <= 0:
+            return
+        key = (platform, str(user_id))
+        with self._lock:
+            if not flag_overwrite and key in self._cache:
+                return
+            self._cache[key] = session_model
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+    def pop(self, platform: "str", user_id: "str|int"):
+        with self._lock:
+            self._cache.pop((platform, str(user_id)), None)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "cached": len(self._cache),
+                "hit": self.hit,
+                "miss": self.miss,
+            }
+
 class DataAPI:
     """
         日志处理类，用于进行日志操作的封装
@@ -798,15 +1274,28 @@ class DataAPI:
             raise exceptions.OlivOSVersionError(135)
 
         self.conf_database = conf_database
-        self.log_database = _DataBaseAPI(olivos_proc.log, max_thread, timeout)
+        conf_basic = confAPI.get_config().basic
+        self.log_database = _DataBaseAPI(
+            olivos_proc.log, max_thread, timeout,
+            synchronous=conf_basic.database_synchronous,
+            cache_size=conf_basic.database_cache_size,
+            mmap_size=conf_basic.database_mmap_size,
+            write_behind=conf_basic.database_write_behind,
+            batch_size=conf_basic.database_batch_size,
+            batch_interval=conf_basic.database_batch_interval,
+        )
+        self._session_cache = _SessionModelCache(conf_basic.session_cache_size)
 
     def get_user_session_this(self, platform: "str",  user_id: "str| int", *_, **__) -> "SessionModel | None":
         """
             获取一个用户的当前激活的 session id
             如果当前该用户当前未激活任何会话，则返回 None
         """
+        user_session_model = self._session_cache.get(platform, user_id)
+        if user_session_model is not _SessionModelCache._MISS:
+            return user_session_model               # type: ignore
 
-        user_session_model:"SessionModel | None" = self.conf_database.get_user_config(      # type: ignore
+        user_session_model = self.conf_database.get_user_config(      # type: ignore
             namespace=NAMESPACE,                            # type error WILL BE RAISED
             key="pkl_session_model_active",
             platform=platform,
@@ -814,6 +1303,7 @@ class DataAPI:
             default_value=None,
             pkl=True,                                       # we use pickle to store the tuple in sqlite
         )
+        self._session_cache.set(platform, user_id, user_session_model, flag_overwrite=False)
         return user_session_model
 
     def init_user_session_this(self, platform: "str",  user_id: "str| int", session_name: str|None = None, model_name: "str|None"=None, *_, **__) -> "SessionModel":
@@ -830,6 +1320,8 @@ class DataAPI:
             设置一个用户的当前激活的 session model
             请使用 init_user_session_this() 函数进行初始化
         """
+        # 先移除缓存，避免写入失败时缓存与配置项数据库不一致
+        self._session_cache.pop(platform, user_id)
         self.conf_database.set_user_config(
             namespace=NAMESPACE,
             key="pkl_session_model_active",
@@ -838,6 +1330,13 @@ class DataAPI:
             value=session_model,
             pkl=True,
         )
+        self._session_cache.set(platform, user_id, session_model)
+
+    def get_session_cache_stats(self):
+        """
+            获取激活 session 缓存的统计信息 (容量、已缓存数量、命中与未命中次数)
+        """
+        return self._session_cache.get_stats()
 
     def get_user_session(self, platform: "str",  user_id: "str| int", flag_session_model=False, *_, **__) -> "List[MasterTable]|List[SessionModel]":
         """
@@ -853,23 +1352,38 @@ class DataAPI:
         else:
             return master_list
 
-    def _save_log(self, session_id, role: "str" = "user", message: "str" = "", status: "int" = 0, *_, **__):
+    def _save_log(self, session_id, role: "str" = "user", message: "str" = "", status: "int" = 0, token_num: "int|None" = None, *_, **__):
         """
             底层操作：保存一条日志信息
         """
         # session_id = self.get_user_session_this(platform, user_id)      # 配置项数据库中自带 cache 功能，不需要再次缓存
         if session_id is None:
             raise exceptions.OlivaChatGPTRuntimeError("session_id is None, please use init_user_session_this() to initialize the session")
-        self.log_database.save_message(session_id, role, message, status)
+        self.log_database.save_message(session_id, role, message, status, token_num)
         return True
     
-    def save_message(self, session_id, message: "str", role: Literal["unknown", "system", "user", "assistant"] = "unknown", base_status: "int"=10000):
+    def save_message(self, session_id, message: "str", role: Literal["unknown", "system", "user", "assistant"] = "unknown", base_status: "int"=10000, token_num: "int|None" = None):
         """
             保存一条消息
+            token_num 为该消息的 token 数量，用于重建上下文时避免重新计算
         """
         status = base_status
         status += ["unknown", "system", "user", "assistant"].index(role)
-        return self._save_log(session_id, role, message, status)
+        return self._save_log(session_id, role, message, status, token_num)
+
+    def flush(self, session_id=None, timeout: "float|None" = None):
+        """
+            等待延迟写入的日志写入完成，session_id 为 None 时等待所有 session
+        """
+        return self.log_database.flush(session_id, timeout)
+
+    def update_token_num(self, session_id, token_list: "Sequence[Tuple[int, int]]"):
+        """
+            回填已有消息的 token 数量，token_list 为 (logline, token_num) 的列表
+        """
+        if session_id is None:
+            raise exceptions.OlivaChatGPTRuntimeError("session_id is None, please use init_user_session_this() to initialize the session")
+        return self.log_database.update_token_num(session_id, token_list)
     
     def save_error(self, session_id, error_msg, status):
         """
@@ -892,25 +1406,41 @@ class DataAPI:
             num 为撤回的消息条数
             status_max 为日志状态码的最大值，只能撤回小于 status_max 的日志 (默认为 20000, 即只能撤回 10000-19999 的日志)
         """
-        message_list = self.get_message(session_id, linenum=-num, status_max=status_max)
-        for i in message_list:
-            self._update_log(session_id, i.logline, status=i.status+target_add)   # 撤回的消息状态码为原状态码 + 20000 (即 30000-39999)
+        if session_id is None:
+            raise exceptions.OlivaChatGPTRuntimeError("session_id is None, please use init_user_session_this() to initialize the session")
+        if num <= 0:
+            return True
+        # 撤回的消息状态码为原状态码 + 20000 (即 30000-39999)
+        self.log_database.recall_message(session_id, num, target_add=target_add, status_max=status_max)
         return True
 
     def get_message(self, session_id, num: "int" = -1, status_max=20000, *_, **__):
         """
-            获取一条消息
-            如果 num 为负数，此时 status_max 为日志状态码的最大值，返回倒数 num 条状态小于 status_max 的日志
+            获取消息，只返回状态码小于 status_max 的日志
+            num 为 0 时返回所有日志，为正数时返回最前面 num+1 条，为负数时返回倒数 -num 条
         """
         if session_id is None:
             raise exceptions.OlivaChatGPTRuntimeError("session_id is None, please use init_user_session_this() to initialize the session")
-        session_table = self.log_database.get_session_message(session_id, status_max=status_max)
         if num > 0:
-            return session_table[:num+1]
-        elif num == 0:
-            return session_table
-        else:
-            return session_table[num:]
+            num += 1
+        return self.log_database.get_session_message(session_id, status_max=status_max, num=num)
+
+    def get_system_message(self, session_id, status_max=20000, *_, **__) -> "List[SessionTable]":
+        """
+            获取所有 system 消息
+        """
+        if session_id is None:
+            raise exceptions.OlivaChatGPTRuntimeError("session_id is None, please use init_user_session_this() to initialize the session")
+        return self.log_database.get_session_system_message(session_id, status_max=status_max)
+
+    def get_message_before(self, session_id, num: "int", logline_max: "int|None" = None, status_max=20000, *_, **__) -> "List[SessionTable]":
+        """
+            获取行号小于 logline_max 的最后 num 条非 system 消息 (按行号倒序)，logline_max 为 None 时从最后一条开始
+            用于从最新的消息开始分页读取上下文
+        """
+        if session_id is None:
+            raise exceptions.OlivaChatGPTRuntimeError("session_id is None, please use init_user_session_this() to initialize the session")
+        return self.log_database.get_session_message_before(session_id, num, logline_max=logline_max, status_max=status_max)
 
     def delete_session(self, platform: "str",  user_id: "str| int", session_model: SessionModel|None=None, *_, **__):
         """
@@ -1,7 +1,75 @@
 # -*- coding: utf-8 -*-
 import OlivOS
+import re
+import itertools
 
 from . import utils, confAPI, databaseAPI, commandAPI, audit
+from .third_party import get_tocken_num
+
+_PARA_AT = OlivOS.messageAPI.PARA.at
+_PARA_TEXT = OlivOS.messageAPI.PARA.text
+
+# 子命令表，按顺序匹配消息开头，未匹配任何子命令的消息作为 send 处理
+SUBCOMMAND_LIST = [
+    ("help", commandAPI.cmd_help),
+    ("new", commandAPI.cmd_new),
+    ("start", commandAPI.cmd_start),
+    ("switch", commandAPI.cmd_start),
+    ("show", commandAPI.cmd_show),
+    ("recall", commandAPI.cmd_recall),
+    ("stats", commandAPI.cmd_stats),
+    ("send", commandAPI.cmd_send),
+]
+
+
+class _CommandRouter:
+    """
+        command router
+
+        根据 `command_prefix` 与 `command_name` 预先编译一个正则表达式，
+        不是命令的消息只需一次匹配即可被拒绝，不会复制消息列表
+        前缀列表中的空字符串 "" 作为一个空的分支保留，即不带前缀的命令名也能匹配
+    """
+    def __init__(self, conf_basic: confAPI.ConfigBasic):
+        prefix_list = [re.escape(i) for i in conf_basic.command_prefix]
+        self._pattern = None
+        if len(prefix_list) > 0:
+            self._pattern = re.compile(r"\s*(?:{0})\s*{1}".format("|".join(prefix_list), re.escape(conf_basic.command_name)))
+
+    def match(self, text: str) -> "str|None":
+        """
+            如果 text 是本插件的命令，返回去掉前缀与命令名后的内容，否则返回 None
+        """
+        if self._pattern is None:
+            return None
+        match = self._pattern.match(text)
+        if match is None:
+            return None
+        return text[match.end():].strip()
+
+    @staticmethod
+    def dispatch(message: str):
+        """
+            返回子命令对应的处理函数与去掉子命令后的内容
+        """
+        if message == "":
+            message = "help"
+        for name, func in SUBCOMMAND_LIST:
+            if message.startswith(name):
+                return func, message[len(name):].lstrip()
+        return commandAPI.cmd_send, message
+
+
+gCommandRouter: _CommandRouter|None = None
+
+def get_command_router() -> _CommandRouter:
+    """
+        get the command router, create one with the basic config if not exists
+    """
+    global gCommandRouter
+    if gCommandRouter is None:
+        gCommandRouter = _CommandRouter(confAPI.get_config().basic)
+    return gCommandRouter
 
 def init(plugin_event: "OlivOS.API.Event", Proc: "OlivOS.pluginAPI.shallow") -> None:
     """
@@ -16,6 +84,9 @@ def init(plugin_event: "OlivOS.API.Event", Proc: "OlivOS.pluginAPI.shallow") ->
     utils._LogProcWrapper(Proc.log)
     utils.gLogProc.debug("Initializing plugin...")
     conf = confAPI.get_config()
+    get_command_router()
+    # 在后台加载 tiktoken 编码器，避免第一次回复时阻塞
+    get_tocken_num.warm_up([model_conf.model_type for model_conf in conf.models.values()])
     databaseAPI.DataAPI(olivos_proc=Proc)
     utils.gLogProc.debug("Loading hooks...")
     audit.init()
@@ -31,136 +102,42 @@ def msg_run(plugin_event: OlivOS.API.Event, Proc: "OlivOS.pluginAPI.shallow"):
         4. send the response to the user
     """
 
-    config = confAPI.get_config()
-
-    message_list: list = plugin_event.data.message.data.copy()      # type: ignore
+    message_list: list = plugin_event.data.message.data             # type: ignore
     if len(message_list) == 0:
         return
-    if isinstance(message_list[0], OlivOS.messageAPI.PARA.at):
+    message_iter = message_list
+    if isinstance(message_list[0], _PARA_AT):
         at_id = message_list[0].data["id"]
         if at_id != plugin_event.bot_info.id:                       # type: ignore
             return
-        message_list.pop(0)
-    
-    message = ""
+        # 跳过开头的 at，不复制消息列表
+        message_iter = itertools.islice(message_list, 1, None)
+
     # find the first text message
-    for this_message in message_list:
-        if isinstance(this_message, OlivOS.messageAPI.PARA.text):
-            message: str = this_message.data["text"].strip()        # type: ignore
+    text = None
+    for this_message in message_iter:
+        if isinstance(this_message, _PARA_TEXT):
+            text: str = this_message.data["text"]                   # type: ignore
             break
     # if no text message, return
-    if message == "":
+    if text is None:
         return
 
-    # check the prefix of the message and remove it
-    _flag_prefix = False
-    for i in config.basic.command_prefix:
-        if message.startswith(i):
-            message = message[len(i):].lstrip()
-            if message.startswith(config.basic.command_name):
-                message = message[len(config.basic.command_name):].lstrip()
-                _flag_prefix = True
-            break
-    if not _flag_prefix:
+    # check the prefix and the command name, and remove them
+    message = get_command_router().match(text)
+    if message is None:
         return
-    else:
-        # the message is a command, block the plugins after this one
-        plugin_event.set_block()
+    # the message is a command, block the plugins after this one
+    plugin_event.set_block()
 
     # check the command
-    if message == "":
-        message = "help"
-
-    if message.startswith("help"):
-        message = message[len("help"):].lstrip()
-        commandAPI.cmd_help(
-            utils.CommandConfig(
-                plugin_event=plugin_event,
-                Proc=Proc,
-                message=message,
-                user_info=utils.UserInfo.from_event(plugin_event),
-                data=databaseAPI.get_DataAPI()
-            )
-        )
-    elif message.startswith("new"):
-        message = message[len("new"):].lstrip()
-        commandAPI.cmd_new(
-            utils.CommandConfig(
-                plugin_event=plugin_event,
-                Proc=Proc,
-                message=message,
-                user_info=utils.UserInfo.from_event(plugin_event),
-                data=databaseAPI.get_DataAPI()
-            )
-        )
-    
-    elif message.startswith("start"):
-        message = message[len("start"):].lstrip()
-        commandAPI.cmd_start(
-            utils.CommandConfig(
-                plugin_event=plugin_event,
-                Proc=Proc,
-                message=message,
-                user_info=utils.UserInfo.from_event(plugin_event),
-                data=databaseAPI.get_DataAPI()
-            )
-        )
-    
-    elif message.startswith("switch"):
-        message = message[len("switch"):].lstrip()
-        commandAPI.cmd_start(
-            utils.CommandConfig(
-                plugin_event=plugin_event,
-                Proc=Proc,
-                message=message,
-                user_info=utils.UserInfo.from_event(plugin_event),
-                data=databaseAPI.get_DataAPI()
-            )
-        )
-
-    elif message.startswith("show"):
-        message = message[len("show"):].lstrip()
-        commandAPI.cmd_show(
-            utils.CommandConfig(
-                plugin_event=plugin_event,
-                Proc=Proc,
-                message=message,
-                user_info=utils.UserInfo.from_event(plugin_event),
-                data=databaseAPI.get_DataAPI()
-            )
-        )
-
-
-    elif message.startswith("recall"):
-        message = message[len("recall"):].lstrip()
-        commandAPI.cmd_recall(
-            utils.CommandConfig(
-                plugin_event=plugin_event,
-                Proc=Proc,
-                message=message,
-                user_info=utils.UserInfo.from_event(plugin_event),
-                data=databaseAPI.get_DataAPI()
-            )
-        )
-    elif message.startswith("send"):
-        message = message[len("send"):].lstrip()
-        commandAPI.cmd_send(
-            utils.CommandConfig(
-                plugin_event=plugin_event,
-                Proc=Proc,
-                message=message,
-                user_info=utils.UserInfo.from_event(plugin_event),
-                data=databaseAPI.get_DataAPI()
-            )
-        )
-
-    else:
-        commandAPI.cmd_send(
-            utils.CommandConfig(
-                plugin_event=plugin_event,
-                Proc=Proc,
-                message=message,
-                user_info=utils.UserInfo.from_event(plugin_event),
-                data=databaseAPI.get_DataAPI()
-            )
+    func, message = _CommandRouter.dispatch(message)
+    func(
+        utils.CommandConfig(
+            plugin_event=plugin_event,
+            Proc=Proc,
+            message=message,
+            user_info=utils.UserInfo.from_event(plugin_event),
+            data=databaseAPI.get_DataAPI()
         )
+    )
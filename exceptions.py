@@ -81,6 +81,48 @@ class OlivaChatGPTHTTPResponseInvalidError(OlivaChatGPTHTTPError):
         self.msg = msg
         super().__init__(msg)
 
+class OlivaChatGPTUpstreamUnavailableError(OlivaChatGPTHTTPError):
+    """
+        the exception for all the upstreams of a model are out of rotation
+    """
+    def __init__(self, model_name: str, msg: str = ""):
+        if msg == "":
+            msg = f"模型 {model_name} 的所有上游暂时不可用，正在等待探测请求的结果，请稍后再试"
+        self.model_name = model_name
+        self.msg = msg
+        super().__init__(msg)
+
+class OlivaChatGPTSchedulerFullError(OlivaChatGPTRuntimeError):
+    """
+        the exception for the request scheduler queue is full
+    """
+    def __init__(self, queue_size: int, msg: str = ""):
+        if msg == "":
+            msg = f"请求队列已满 ({queue_size})，请稍后再试"
+        self.msg = msg
+        self.queue_size = queue_size
+        super().__init__(msg)
+
+class OlivaChatGPTSessionQueueFullError(OlivaChatGPTSchedulerFullError):
+    """
+        the exception for the message queue of a session is full
+    """
+    def __init__(self, queue_size: int, msg: str = ""):
+        if msg == "":
+            msg = f"当前会话中排队的消息过多 ({queue_size})，请等待之前的消息回复后再试"
+        super().__init__(queue_size, msg)
+
+class OlivaChatGPTRateLimitError(OlivaChatGPTSchedulerFullError):
+    """
+        the exception for the request waited too long for the rate limit of the model
+    """
+    def __init__(self, model_name: str, max_wait: float, msg: str = ""):
+        if msg == "":
+            msg = f"模型 {model_name} 的请求过于频繁，{max_wait:.0f} 秒内无法发送，请稍后再试"
+        self.model_name = model_name
+        self.max_wait = max_wait
+        super().__init__(0, msg)
+
 class OlivaChatGPTHookError(OlivaChatGPTRuntimeError):
     """
         the exception for the plugin hook
@@ -3,21 +3,866 @@ the remote API is used to communicate with the API server of ChatGPT
 """
 
 import requests
+import urllib3
 import json
+import re
 import OlivOS
 import time
+import random
+import hashlib
 import threading
-from urllib.parse import urljoin
+import contextlib
+import collections
+import asyncio
+import concurrent.futures
+from urllib.parse import urljoin, urlsplit
 import dataclasses
 
 from typing import Literal
 
 
-from . import databaseAPI, exceptions, replyAPI, utils, confAPI, crossHook
+from . import databaseAPI, exceptions, replyAPI, utils, confAPI, crossHook, schedulerAPI
 from .audit import after_receive_message_config
-from .third_party.get_tocken_num import get_token_from_message_list, get_token_from_string 
+from .third_party.get_tocken_num import get_token_from_message, get_token_from_string, estimate_token_from_message_list
+
+try:
+    import aiohttp as _aiohttp
+    FLAG_AIOHTTP_INSTALLED = True
+except ImportError:
+    _aiohttp = None
+    FLAG_AIOHTTP_INSTALLED = False
 
 STREAM_TIME_OUT = 120
+# 说明上游不可用 (而不是请求本身有误) 的 HTTP 状态码，计入熔断的失败次数
+# 429 只说明上游正在限流，不计入失败：停用后只会让其余上游 (或唯一的上游恢复前的所有请求) 承担更多负载，按 Retry-After 退避重试即可
+UPSTREAM_FAILURE_STATUS_CODE = frozenset({401, 403, 408, 500, 502, 503, 504})
+# 每个上游记录的最近延迟样本数
+UPSTREAM_LATENCY_SAMPLE = 200
+# stream mode 下逐段计算 token 数量时，没有空白的文本最多积累的字符数
+STREAM_COUNT_CHARS = 64
+# 按 token 数量重建上下文时，每次从数据库读取的消息条数
+CONTEXT_PAGE_SIZE = 64
+
+
+class SSEParser:
+    """
+        incremental parser for Server-Sent Events
+
+        将接收到的数据块依次传入 `feed`，返回其中已经完整的事件的 data 字段 (bytes)
+        - 多行 `data:` 字段按规范以 `\n` 连接为一个事件
+        - 以 `:` 开头的注释行与 `event` / `id` / `retry` 字段会被忽略
+        - 支持 `\n` 与 `\r\n` 换行
+        数据块按行切分，只有最后一个不完整的行会留到下一次 feed
+    """
+    def __init__(self):
+        self._pending = b""
+        self._data_lines: list[bytes] = []
+
+    def feed(self, chunk: bytes) -> list[bytes]:
+        data = self._pending + chunk
+        if b"\r" in data:
+            data = data.replace(b"\r\n", b"\n")
+        lines = data.split(b"\n")
+        self._pending = lines.pop()
+        events = []
+        for line in lines:
+            if not line:
+                # 空行，分发当前事件
+                if self._data_lines:
+                    events.append(b"\n".join(self._data_lines))
+                    self._data_lines = []
+            elif line.startswith(b"data:"):
+                # 去掉冒号后的一个空格
+                self._data_lines.append(line[6:] if line.startswith(b"data: ") else line[5:])
+        return events
+
+    def finish(self) -> list[bytes]:
+        """
+            数据流结束，分发尚未以空行结尾的最后一个事件
+        """
+        events = []
+        if self._pending:
+            events = self.feed(b"\n")
+        if self._data_lines:
+            events.append(b"\n".join(self._data_lines))
+            self._data_lines = []
+        return events
+
+
+class _ContextWindow:
+    """
+        the context messages of a session
+
+        system 消息固定保留，其余消息按顺序保存在 deque 中，超出限制时从最早的消息开始移除
+        - `max_context` 限制消息条数 (包括 system 消息)
+        - `max_context_tokens` 限制 token 数量，其中 `reserved_completion_tokens` 预留给回复
+        每条消息的 token 数量只在加入时计算一次 (或直接使用数据库中记录的值)，总数随加入与移除同步增减
+        无法使用 tiktoken 计算时使用 estimate_token_from_message_list 内置估算，估计值不会写入数据库
+        `total_bytes` 为所有消息内容的 utf-8 字节数，用于估计会话占用的内存
+    """
+    def __init__(self, model_conf: confAPI.ConfigModel):
+        self.model_type = model_conf.model_type
+        self.max_context = model_conf.max_context
+        self.max_tokens = -1
+        if model_conf.max_context_tokens > 0:
+            self.max_tokens = max(model_conf.max_context_tokens - max(model_conf.reserved_completion_tokens, 0), 1)
+        self._pinned: list[dict] = []
+        self._pinned_tokens: list[tuple[int, bool]] = []
+        self._messages: "collections.deque[dict]" = collections.deque()
+        self._tokens: "collections.deque[tuple[int, bool]]" = collections.deque()
+        self.total_tokens = 0
+        self.estimated_num = 0              # 当前上下文中使用估计值的消息数
+        self.total_bytes = 0
+
+    def count_token(self, message: dict) -> "tuple[int, bool]":
+        """
+            计算消息的 token 数量，返回 (token 数量, 是否为估计值)
+        """
+        try:
+            return get_token_from_message(message, self.model_type, flag_estimate=True)                # type: ignore
+        except Exception as err:
+            utils.get_logger().error(f"计算 token 数量失败: {err.__class__.__name__}: {err}")
+            return estimate_token_from_message_list([message]) - 3, True
+
+    def append(self, role: str, content: str, token: "int|None" = None) -> "int|None":
+        """
+            加入一条消息，返回该消息的 token 数量，如果为估计值则返回 None
+        """
+        message = {
+            "role": role,
+            "content": content
+        }
+        if token is None:
+            token_this = self.count_token(message)
+        else:
+            token_this = (token, False)
+        if role == "system":
+            self._pinned.append(message)
+            self._pinned_tokens.append(token_this)
+        else:
+            self._messages.append(message)
+            self._tokens.append(token_this)
+        self.__add(message, token_this, 1)
+        self.trim()
+        return None if token_this[1] else token_this[0]
+
+    def load(self, message_list: "list[tuple[str, str, tuple[int, bool]]]"):
+        """
+            按顺序加入多条已经计算过 token 数量的非 system 消息，全部加入后统一移除超出限制的消息
+
+            message_list 中的元素为 (role, content, (token 数量, 是否为估计值))
+        """
+        for role, content, token_this in message_list:
+            message = {
+                "role": role,
+                "content": content
+            }
+            self._messages.append(message)
+            self._tokens.append(token_this)
+            self.__add(message, token_this, 1)
+        self.trim()
+
+    def __add(self, message: dict, token_this: "tuple[int, bool]", sign: int):
+        self.total_tokens += sign * token_this[0]
+        if token_this[1]:
+            self.estimated_num += sign
+        self.total_bytes += sign * len(message["content"].encode("utf-8"))
+
+    def trim(self):
+        """
+            移除最早的非 system 消息直到满足限制，最新的一条消息总是会被保留
+        """
+        while len(self._messages) > 1 and (
+            (self.max_context > 0 and len(self) > self.max_context)
+            or (self.max_tokens > 0 and self.total_tokens > self.max_tokens)
+        ):
+            self.__add(self._messages.popleft(), self._tokens.popleft(), -1)
+
+    def pop(self):
+        """
+            移除最后一条消息
+        """
+        if len(self._messages) > 0:
+            self.__add(self._messages.pop(), self._tokens.pop(), -1)
+        elif len(self._pinned) > 0:
+            self.__add(self._pinned.pop(), self._pinned_tokens.pop(), -1)
+
+    def prompt_tokens(self, flag_estimate: bool = False):
+        """
+            当前上下文作为请求发送时的 token 数量，包含估计值时返回 None
+            flag_estimate 为 True 时返回 (token 数量, 是否包含估计值)
+        """
+        # every reply is primed with <|start|>assistant<|message|>
+        if flag_estimate:
+            return self.total_tokens + 3, self.estimated_num > 0
+        if self.estimated_num > 0:
+            return None
+        return self.total_tokens + 3
+
+    def to_list(self) -> list[dict]:
+        return self._pinned + list(self._messages)
+
+    def __len__(self):
+        return len(self._pinned) + len(self._messages)
+
+
+class _StreamFlusher:
+    """
+        split the streamed reply into partial chat messages
+
+        已接收的文本超过 `flush_chars` 个字符，或距离上次发送超过 `flush_interval` 秒时，
+        在最后一个段落或句子的边界处切分，切分出的部分作为单独的消息发送
+        如果没有找到边界，则在文本超过两倍 `flush_chars` 个字符后于最后一个空白处切分
+    """
+    _BOUNDARY = re.compile(r"\n|[。！？；…]|[.!?;](?=\s)")
+
+    def __init__(self, flush_chars: int = 200, flush_interval: float = 1.5):
+        self.flush_chars = flush_chars
+        self.flush_interval = flush_interval
+        self.flushed_length = 0
+        self._buffer: list[str] = []
+        self._length = 0
+        self._output: list[str] = []
+        self._time_last = time.time()
+
+    def feed(self, text: str):
+        self._buffer.append(text)
+        self._length += len(text)
+        flag_chars = self.flush_chars > 0 and self._length >= self.flush_chars
+        flag_time = self.flush_interval > 0 and time.time() - self._time_last >= self.flush_interval
+        if not flag_chars and not flag_time:
+            return
+        text_all = "".join(self._buffer)
+        cut = 0
+        for match in self._BOUNDARY.finditer(text_all):
+            cut = match.end()
+        if cut == 0:
+            # 没有句子边界时，等待文本达到两倍长度后在最后一个空白处切分，避免截断单词
+            if not flag_chars or self._length < self.flush_chars * 2:
+                return
+            cut = max(text_all.rfind(" "), text_all.rfind("\t")) + 1
+            if cut == 0:
+                cut = len(text_all)
+        text_out = text_all[:cut].strip()
+        text_rest = text_all[cut:]
+        self._buffer = [text_rest] if text_rest else []
+        self._length = len(text_rest)
+        self._time_last = time.time()
+        self.flushed_length += cut
+        if text_out != "":
+            self._output.append(text_out)
+
+    def has_output(self) -> bool:
+        return len(self._output) > 0
+
+    def pop_output(self) -> list[str]:
+        output = self._output
+        self._output = []
+        return output
+
+
+class _StreamResponse:
+    """
+        collect the chat completion chunks of a stream response
+    """
+    def __init__(self, flusher: "_StreamFlusher | None" = None, model_type: str = "gpt-3.5-turbo-0613"):
+        self.event_list = []
+        self.text_list: list[str] = []
+        self.finish_reason = None
+        self.flusher = flusher
+        self.model_type = model_type
+        # 服务器返回的 token 用量 (stream_options.include_usage)
+        self.usage: "dict|None" = None
+        # 每收到一段回复就计算其 token 数量，[DONE] 时不需要再对全文计算一次
+        self.completion_tokens = 0
+        self.flag_estimated = False
+        # 尚未计算的文本，只在空白处切分，避免把一个单词拆开计算
+        self._text_pending = ""
+
+    def feed(self, data: bytes) -> bool:
+        """
+            处理一个 SSE 事件，收到 `[DONE]` 时返回 True
+        """
+        log = utils.get_logger()
+        if data == b"[DONE]":
+            log.trace("chunk [DONE]")
+            return True
+        try:
+            event_this = json.loads(data)
+        except json.JSONDecodeError:
+            log.error(f"JSONDecodeError: {data}")
+            return False
+        self.event_list.append(event_this)
+        usage = event_this.get("usage", None)
+        if usage:
+            self.usage = usage
+        choices = event_this.get("choices", None)
+        if not choices:
+            return False
+        choice = choices[0]
+        content = choice.get("delta", {}).get("content", None)
+        if content:
+            self.text_list.append(content)
+            if self.usage is None:
+                self.__count(content)
+            if self.flusher is not None:
+                self.flusher.feed(content)
+        finish_reason = choice.get("finish_reason", None)
+        if finish_reason is not None:
+            self.finish_reason = finish_reason
+            if finish_reason != "stop":
+                log.warn(f"gpt returns with stop reason: {finish_reason}")
+        return False
+
+    def text(self) -> str:
+        return "".join(self.text_list)
+
+    def result(self):
+        return self.text(), self.event_list
+
+    def __count(self, content: str, flag_finish: bool = False):
+        "计算新收到的文本的 token 数量，最后一个空白之后的部分留到下次计算"
+        text = self._text_pending + content
+        if flag_finish:
+            idx = len(text)
+        else:
+            idx = max(text.rfind(" "), text.rfind("\n"))
+            if idx <= 0 and len(text) > STREAM_COUNT_CHARS:
+                # 中日韩文本中没有空格，积累过长时直接计算
+                idx = len(text)
+        if idx <= 0:
+            self._text_pending = text
+            return
+        self._text_pending = text[idx:]
+        token_this, flag_estimated = get_token_from_string(text[:idx], self.model_type, flag_estimate=True)      # type: ignore
+        self.completion_tokens += token_this
+        self.flag_estimated = self.flag_estimated or flag_estimated
+
+    def token_usage(self) -> "tuple[dict|None, int, bool]":
+        """
+            返回 (服务器返回的 token 用量, 逐段计算的回复 token 数量, 是否为估计值)
+        """
+        if self._text_pending:
+            self.__count("", flag_finish=True)
+        return self.usage, self.completion_tokens, self.flag_estimated
+
+
+def _iter_upstream_conf(model_conf: confAPI.ConfigModel):
+    "依次返回模型配置中每个上游的 (url, api_key, weight)，未配置 upstreams 时返回 url 与 api_key"
+    flag_empty = True
+    for item in model_conf.upstreams:
+        if isinstance(item, dict):
+            url, api_key, weight = item["url"], item.get("api_key", model_conf.api_key), item.get("weight", 1)
+        else:
+            url, api_key, weight = (list(item) + [1])[:3]
+        flag_empty = False
+        yield url, api_key, weight
+    if flag_empty:
+        yield model_conf.url, model_conf.api_key, 1
+
+def _get_upstream_host_num(model_conf: confAPI.ConfigModel) -> int:
+    "模型的上游涉及的主机数 (scheme + host + port 不同即视为不同主机)"
+    host_set = set()
+    for url, _, _ in _iter_upstream_conf(model_conf):
+        url_split = urlsplit(urljoin(url, model_conf.endpoint))
+        host_set.add((url_split.scheme, url_split.netloc.lower()))
+    return max(len(host_set), 1)
+
+
+class _ModelSessionPool:
+    """
+        HTTP connection pool shared by all the `RemoteClient` of the same model
+
+        每个 `ConfigModel` 维护一个 `requests.Session`，同一模型下的所有会话共用其中的连接，
+        避免每次请求都重新进行 TCP / TLS 握手
+        连接池空闲超过 `pool_idle_timeout` 秒后会被关闭，下次请求时重新建立
+        urllib3 为每个主机维护一个连接池，pool_connections 不小于上游主机数，
+        否则在多个上游之间切换时会不断关闭并重建连接池
+    """
+    def __init__(self, model_conf: confAPI.ConfigModel):
+        self.model_name = model_conf.model_name
+        self.pool_size = max(model_conf.pool_size, 1)
+        self.host_num = _get_upstream_host_num(model_conf)
+        self.keep_alive = model_conf.keep_alive
+        self.idle_timeout = model_conf.pool_idle_timeout
+        self._lock = threading.Lock()
+        self._session: requests.Session|None = None
+        self._in_flight = 0
+        self._time_last_use = time.time()
+        # 已关闭的 session 的统计数据，避免关闭后计数丢失
+        self._count_closed = {"connections": 0, "requests": 0}
+        self._count_session_created = 0
+        self._count_session_evicted = 0
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.host_num, pool_maxsize=self.pool_size, pool_block=False
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+        self._count_session_created += 1
+        return session
+
+    def _close_session(self):
+        "关闭当前 session，需要在持有 self._lock 时调用"
+        if self._session is None:
+            return
+        count = self._count_connection(self._session)
+        self._count_closed["connections"] += count["connections"]
+        self._count_closed["requests"] += count["requests"]
+        self._session.close()
+        self._session = None
+
+    def resize(self, host_num: int):
+        """
+            上游主机数变化时关闭当前 session，下次请求时按新的主机数重建
+        """
+        with self._lock:
+            if host_num == self.host_num:
+                return
+            self.host_num = host_num
+            self._close_session()
+
+    def evict_idle(self):
+        """
+            如果连接池空闲时间超过 idle_timeout，则关闭其中的连接
+        """
+        if self.idle_timeout is None or self.idle_timeout < 0:
+            return False
+        with self._lock:
+            if self._session is None or self._in_flight > 0:
+                return False
+            if time.time() - self._time_last_use < self.idle_timeout:
+                return False
+            self._close_session()
+            self._count_session_evicted += 1
+        log = utils.get_logger()
+        log.debug(f"HTTP connection pool of model <{self.model_name}> evicted after being idle")
+        return True
+
+    @contextlib.contextmanager
+    def request(self, method: str, url: str, **kwargs):
+        """
+            send a request with the pooled session
+
+            用法与 `requests.request` 相同，需要配合 with 语句使用，
+            退出时会关闭 response，将连接归还连接池
+        """
+        self.evict_idle()
+        with self._lock:
+            if self._session is None:
+                self._session = self._new_session()
+            session = self._session
+            self._in_flight += 1
+        response = None
+        try:
+            response = session.request(method=method, url=url, **kwargs)
+            yield response
+        finally:
+            if response is not None:
+                response.close()
+            with self._lock:
+                self._in_flight -= 1
+                self._time_last_use = time.time()
+
+    @staticmethod
+    def _count_connection(session: requests.Session):
+        "统计 session 中 urllib3 连接池新建的连接数与发送的请求数"
+        count = {"connections": 0, "requests": 0}
+        for adapter in set(session.adapters.values()):
+            pool_manager = getattr(adapter, "poolmanager", None)
+            if pool_manager is None:
+                continue
+            for key in list(pool_manager.pools.keys()):
+                pool = pool_manager.pools.get(key)
+                if pool is None:
+                    continue
+                count["connections"] += pool.num_connections
+                count["requests"] += pool.num_requests
+        return count
+
+    def get_stats(self):
+        """
+            get the statistics of the pool
+
+            connections: 新建立的连接数
+            requests: 发送的请求数
+            reused: 复用已有连接发送的请求数
+        """
+        with self._lock:
+            count = self._count_closed.copy()
+            if self._session is not None:
+                count_this = self._count_connection(self._session)
+                count["connections"] += count_this["connections"]
+                count["requests"] += count_this["requests"]
+            return {
+                "model_name": self.model_name,
+                "pool_size": self.pool_size,
+                "hosts": self.host_num,
+                "in_flight": self._in_flight,
+                "connections": count["connections"],
+                "requests": count["requests"],
+                "reused": max(count["requests"] - count["connections"], 0),
+                "session_created": self._count_session_created,
+                "session_evicted": self._count_session_evicted,
+            }
+
+    def close(self):
+        with self._lock:
+            self._close_session()
+
+
+gSessionPool: dict[str, _ModelSessionPool] = {}
+_gSessionPoolLock = threading.Lock()
+
+def get_session_pool(model_conf: confAPI.ConfigModel) -> _ModelSessionPool:
+    """
+        get the HTTP connection pool of the model, create one if not exists
+    """
+    global gSessionPool
+    with _gSessionPoolLock:
+        pool = gSessionPool.get(model_conf.model_name, None)
+        if pool is None:
+            pool = _ModelSessionPool(model_conf)
+            gSessionPool[model_conf.model_name] = pool
+        pool_list = list(gSessionPool.values())
+    pool.resize(_get_upstream_host_num(model_conf))
+    # 顺便检查其他模型的连接池是否空闲过久
+    for pool_this in pool_list:
+        if pool_this is not pool:
+            pool_this.evict_idle()
+    return pool
+
+def get_session_pool_stats():
+    """
+        get the statistics of all the HTTP connection pools
+    """
+    with _gSessionPoolLock:
+        pool_list = list(gSessionPool.values())
+    return {pool.model_name: pool.get_stats() for pool in pool_list}
+
+class _Upstream:
+    """
+        an upstream server of a model, with a circuit breaker
+
+        closed: 正常使用
+        open: 连续失败次数达到阈值后停用
+        half_open: 停用超过 circuit_breaker_timeout 秒后，放行一个探测请求，成功则恢复为 closed，失败则重新停用
+    """
+    def __init__(self, url: str, api_key: str, weight: float, endpoint: str):
+        self.url = urljoin(url, endpoint)
+        self.weight = max(float(weight), 0.0)
+        # 调度器按 API Key 分别计算 RPM / TPM，使用摘要而不是 API Key 本身，避免在统计中泄露
+        self.rate_limit_key = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+        self.header = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}",
+            'Accept': 'application/json',
+        }
+        self.state = "closed"
+        self.fail_count = 0                 # 连续失败次数
+        self.time_open = 0.0
+        self.flag_probing = False
+        self.count_request = 0
+        self.count_failure = 0
+        self.count_circuit_open = 0
+        self.latency: "collections.deque[float]" = collections.deque(maxlen=UPSTREAM_LATENCY_SAMPLE)
+
+    def is_available(self, now: float, circuit_timeout: float) -> bool:
+        if self.state == "closed":
+            return True
+        if self.flag_probing:
+            return False
+        return now - self.time_open >= circuit_timeout
+
+    def get_stats(self):
+        latency = sorted(self.latency)
+        stats = {
+            "url": self.url,
+            "host": urlsplit(self.url).netloc.rpartition("@")[2],  # 不含 URL 中可能存在的用户名与密码
+            "weight": self.weight,
+            "state": self.state,
+            "fail_count": self.fail_count,
+            "requests": self.count_request,
+            "failures": self.count_failure,
+            "circuit_open": self.count_circuit_open,
+        }
+        if len(latency) > 0:
+            stats["latency_avg"] = sum(latency) / len(latency)
+            stats["latency_p50"] = latency[len(latency) // 2]
+            stats["latency_p99"] = latency[min(int(len(latency) * 0.99), len(latency) - 1)]
+        else:
+            stats["latency_avg"] = stats["latency_p50"] = stats["latency_p99"] = 0.0
+        return stats
+
+
+class _UpstreamGroup:
+    """
+        the upstream servers of a model
+
+        请求按权重随机分配到可用的上游，重试时优先选择尚未尝试过的上游
+        所有上游都被停用时，选择停用最久且没有探测请求的一个，而不是直接失败；
+        所有上游都在等待探测请求的结果时直接失败，不再向其发送请求
+        延迟为发出请求到收到响应头的时间 (秒)
+    """
+    def __init__(self, model_conf: confAPI.ConfigModel):
+        self.model_name = model_conf.model_name
+        self.param = self.get_param(model_conf)
+        self.circuit_threshold = model_conf.circuit_breaker_threshold
+        self.circuit_timeout = model_conf.circuit_breaker_timeout
+        self._lock = threading.Lock()
+        self._upstreams = [
+            _Upstream(url, api_key, weight, model_conf.endpoint) for url, api_key, weight in _iter_upstream_conf(model_conf)
+        ]
+
+    @staticmethod
+    def get_param(model_conf: confAPI.ConfigModel):
+        "影响上游列表的配置，配置变化时需要重新创建"
+        return (
+            json.dumps(model_conf.upstreams, sort_keys=True), model_conf.url, model_conf.api_key, model_conf.endpoint,
+            model_conf.circuit_breaker_threshold, model_conf.circuit_breaker_timeout,
+        )
+
+    def rate_limit_keys(self) -> "list[str]":
+        """
+            可以发送请求的上游的 rate limit key，按权重随机排列 (不重复)
+            调度器按此顺序选择第一个仍有 RPM / TPM 余量的 key，再由 pick 在该 key 的上游中选择
+            所有上游都被停用时，只返回 pick 会选择的那一个上游的 key
+        """
+        now = time.time()
+        with self._lock:
+            candidate = [item for item in self._upstreams if item.is_available(now, self.circuit_timeout)]
+            if len(candidate) == 0:
+                idle = [item for item in self._upstreams if not item.flag_probing]
+                if len(idle) == 0:
+                    return []
+                return [min(idle, key=lambda item: item.time_open).rate_limit_key]
+        key_list = []
+        while len(candidate) > 0:
+            weight = [item.weight for item in candidate]
+            key = random.choices(candidate, weights=weight if sum(weight) > 0 else None)[0].rate_limit_key
+            key_list.append(key)
+            candidate = [item for item in candidate if item.rate_limit_key != key]
+        return key_list
+
+    def pick(self, exclude: "set[_Upstream]", rate_limit_key: "str|None" = None) -> _Upstream:
+        """
+            按权重选择一个上游，exclude 为本次请求中已经尝试过的上游
+            rate_limit_key 不为 None 时只在使用该 key 的上游中选择 (即调度器扣除了额度的 API Key)
+            没有可以发送请求的上游时抛出 OlivaChatGPTUpstreamUnavailableError
+        """
+        now = time.time()
+        with self._lock:
+            upstream_list = self._upstreams
+            if rate_limit_key is not None:
+                # 配置变化后可能没有使用该 key 的上游，此时不做限制
+                upstream_list = [item for item in self._upstreams if item.rate_limit_key == rate_limit_key] or self._upstreams
+            available = [item for item in upstream_list if item.is_available(now, self.circuit_timeout)]
+            candidate = [item for item in available if item not in exclude] or available
+            if len(candidate) == 0:
+                idle = [item for item in upstream_list if not item.flag_probing]
+                if len(idle) == 0:
+                    raise exceptions.OlivaChatGPTUpstreamUnavailableError(self.model_name)
+                upstream = min(idle, key=lambda item: item.time_open)
+            else:
+                weight = [item.weight for item in candidate]
+                if sum(weight) <= 0:
+                    weight = None
+                upstream = random.choices(candidate, weights=weight)[0]
+            if upstream.state != "closed":
+                upstream.state = "half_open"
+                upstream.flag_probing = True
+            upstream.count_request += 1
+        return upstream
+
+    def report(self, upstream: _Upstream, flag_success: bool, latency: "float|None" = None):
+        """
+            记录请求的结果，更新上游的熔断状态
+        """
+        log = utils.get_logger()
+        with self._lock:
+            upstream.flag_probing = False
+            if latency is not None:
+                upstream.latency.append(latency)
+            if flag_success:
+                if upstream.state != "closed":
+                    log.info(f"Upstream {upstream.url} of model <{self.model_name}> is back in rotation")
+                upstream.state = "closed"
+                upstream.fail_count = 0
+                return
+            upstream.count_failure += 1
+            upstream.fail_count += 1
+            if upstream.state == "half_open" or (
+                upstream.state == "closed" and self.circuit_threshold > 0 and upstream.fail_count >= self.circuit_threshold
+            ):
+                upstream.state = "open"
+                upstream.time_open = time.time()
+                upstream.count_circuit_open += 1
+                log.warn(f"Upstream {upstream.url} of model <{self.model_name}> is taken out of rotation after {upstream.fail_count} failures")
+
+    def get_stats(self):
+        """
+            get the health and latency statistics of the upstreams
+        """
+        with self._lock:
+            return [item.get_stats() for item in self._upstreams]
+
+
+gUpstreamGroup: dict[str, _UpstreamGroup] = {}
+_gUpstreamGroupLock = threading.Lock()
+
+def get_upstream_group(model_conf: confAPI.ConfigModel) -> _UpstreamGroup:
+    """
+        get the upstream servers of the model, create them if not exists or the config is changed
+    """
+    with _gUpstreamGroupLock:
+        group = gUpstreamGroup.get(model_conf.model_name, None)
+        if group is None or group.param != _UpstreamGroup.get_param(model_conf):
+            group = _UpstreamGroup(model_conf)
+            gUpstreamGroup[model_conf.model_name] = group
+            flag_new = True
+        else:
+            flag_new = False
+    if flag_new:
+        # 上游列表变化后，按新的主机数重建 HTTP 连接池
+        get_session_pool(model_conf)
+    return group
+
+def get_upstream_stats():
+    """
+        get the statistics of the upstream servers of all the models
+    """
+    with _gUpstreamGroupLock:
+        group_list = list(gUpstreamGroup.values())
+    return {group.model_name: group.get_stats() for group in group_list}
+
+
+def _is_upstream_failure(status_code: int) -> bool:
+    "该状态码是否说明上游不可用 (而不是请求本身有误)"
+    return status_code in UPSTREAM_FAILURE_STATUS_CODE
+
+
+def _is_connect_error(err: Exception) -> bool:
+    "requests 抛出的异常是否发生在建立连接阶段 (请求尚未发出，重试不会重复请求)"
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(err, requests.exceptions.ConnectionError) or len(err.args) == 0:
+        return False
+    reason = getattr(err.args[0], "reason", err.args[0])
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def _is_connect_error_async(err: Exception) -> bool:
+    "aiohttp 抛出的异常是否发生在建立连接阶段"
+    # ConnectionTimeoutError 在 aiohttp 3.10 中加入，更早的版本无法区分连接超时与读取超时
+    connect_error = (_aiohttp.ClientConnectorError, getattr(_aiohttp, "ConnectionTimeoutError", _aiohttp.ClientConnectorError))   # type: ignore
+    return isinstance(err, connect_error)
+
+
+def get_retry_delay(model_conf: confAPI.ConfigModel, attempt: int, retry_after: "str|None" = None) -> "float|None":
+    """
+        第 attempt 次重试前等待的时间 (秒)，指数退避并加入随机抖动
+        如果服务器返回了 Retry-After (秒)，则至少等待该时间；超过 retry_backoff_max 时返回 None，表示不再重试
+    """
+    delay = min(model_conf.retry_backoff * (2 ** attempt), model_conf.retry_backoff_max)
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if retry_after is not None:
+        try:
+            retry_after_sec = float(retry_after)
+        except ValueError:
+            retry_after_sec = None
+        if retry_after_sec is not None:
+            if retry_after_sec > model_conf.retry_backoff_max:
+                return None
+            delay = max(delay, retry_after_sec)
+    return max(delay, 0.0)
+
+
+class _AsyncEngine:
+    """
+        asyncio engine for the remote requests
+
+        所有使用 asyncio 传输方式 (`transport` 为 `asyncio`) 的请求都在同一个事件循环线程中进行，
+        等待远端回复（尤其是 stream mode 下较慢的 SSE 数据流）时不会占用调度器的工作线程
+        每个模型维护一个 `aiohttp.ClientSession`，连接池参数与 `_ModelSessionPool` 一致
+    """
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._sessions: dict = {}
+        self._thread = threading.Thread(target=self.__run, name="OlivaChatGPT-asyncio", daemon=True)
+        self._thread.start()
+
+    def __run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """
+            run the coroutine on the event loop, thread-safe
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def get_session(self, model_conf: confAPI.ConfigModel):
+        """
+            get the aiohttp session of the model, only called in the event loop thread
+        """
+        session = self._sessions.get(model_conf.model_name, None)
+        if session is None or session.closed:
+            if model_conf.keep_alive:
+                keepalive_timeout = model_conf.pool_idle_timeout if model_conf.pool_idle_timeout > 0 else None
+                connector = _aiohttp.TCPConnector(                                  # type: ignore
+                    limit=max(model_conf.pool_size, 1), keepalive_timeout=keepalive_timeout
+                )
+            else:
+                connector = _aiohttp.TCPConnector(limit=max(model_conf.pool_size, 1), force_close=True)    # type: ignore
+            session = _aiohttp.ClientSession(connector=connector)                   # type: ignore
+            self._sessions[model_conf.model_name] = session
+        return session
+
+    def run_in_executor(self, func, *args):
+        """
+            run the blocking function in the default executor of the event loop
+        """
+        return self._loop.run_in_executor(None, func, *args)
+
+    async def __close_sessions(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions = {}
+
+    def stop(self):
+        """
+            close all the sessions and stop the event loop
+        """
+        try:
+            self.submit(self.__close_sessions()).result(5)
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+gAsyncEngine: _AsyncEngine|None = None
+_gAsyncEngineLock = threading.Lock()
+
+def get_async_engine() -> "_AsyncEngine | None":
+    """
+        get the asyncio engine, return None if aiohttp is not installed
+    """
+    global gAsyncEngine
+    if not FLAG_AIOHTTP_INSTALLED:
+        with _gAsyncEngineLock:
+            if gAsyncEngine is None:
+                # 只警告一次
+                gAsyncEngine = False                                                # type: ignore
+                log = utils.get_logger()
+                log.warn("""第三方库 aiohttp 未安装，asyncio 传输方式不可用，将使用 requests 发送请求。请使用 "pip install aiohttp" 进行安装。""")
+        return None
+    with _gAsyncEngineLock:
+        if gAsyncEngine is None:
+            gAsyncEngine = _AsyncEngine()
+        return gAsyncEngine
 
 
 class RemoteClient:
@@ -32,208 +877,588 @@ class RemoteClient:
     """
 
     def __init__(self, session_model: databaseAPI.SessionModel):
-        global gRemoteClient
-        if session_model in gRemoteClient:
-            raise exceptions.OlivaChatGPTRuntimeError("RemoteClient has been initialized")
-        gRemoteClient[session_model] = self
         self.session_model = session_model
         self.database = databaseAPI.get_DataAPI()
         self.conf_all = confAPI.get_config()
         self.model_conf = self.conf_all.models[session_model.model]
         self.cache = {}
-        self.cache["cmd"] = None
-
-        self.header = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.model_conf.api_key}",
-            'Accept': 'application/json',
-        }
 
-        self.url = urljoin(self.model_conf.url, self.model_conf.endpoint)
-        # self.model_conf.url + self.model_conf.endpoint
+        # 请求的地址与 API key 由 get_upstream_group 按 upstreams 配置选择
         self.body = {
             "model": self.model_conf.model_type,
             "messages": [],
             "stream": self.model_conf.stream,
         }
+        self.context = _ContextWindow(self.model_conf)
+        self._token_send: "tuple[int, bool]|None" = None
+        self._token_receive: "tuple[dict|None, int, bool]|None" = None
+        self._token_admitted = 0            # 提交到调度器时预扣的 TPM 额度
+        self._rate_limit_key = None         # 扣除了 RPM / TPM 额度的上游 API Key (的摘要)
         self.get_context()
 
         self._lock = threading.Lock()
-        # self._session = requests.Session()
-        # self._session.headers.update(self.header)
+        self._queue: "collections.deque[utils.CommandConfig|None]" = collections.deque()
+        self._flag_running = False
+        self._pool = get_session_pool(self.model_conf)
+        self._engine = None
+        if self.model_conf.transport == "asyncio":
+            self._engine = get_async_engine()
 
     def get_context(self):
         """
             get the context of the session
+
+            system 消息全部读取，其余消息从最新的一条开始倒序读取，满足 `max_context` 或 `max_context_tokens` 限制后停止，
+            不会读取整个会话的历史记录
         """
-        history_context = self.database.get_message(
-            session_id=self.session_model.session_id, num=0, status_max=20000
-        )
-        for line in history_context:
-            if line.role in ["system", "user", "assistant"]:                    # 已经通过本行确保了 line.role 为 Literal['system', 'user', 'assistant']
-                self.add_message(line.role, line.message, record=False)         # type: ignore
-        return self.body["messages"]
+        session_id = self.session_model.session_id
+        token_backfill = []
+        for line in self.database.get_system_message(session_id, status_max=20000):
+            token = self.add_message("system", line.message, record=False, token_num=line.token_num)
+            if line.token_num is None and token is not None:
+                token_backfill.append((line.logline, token))
+
+        max_context = self.context.max_context
+        max_tokens = self.context.max_tokens
+        if max_context > 0 and max_tokens <= 0:
+            page_size = max(max_context - len(self.context), 1)
+        elif max_tokens > 0:
+            page_size = CONTEXT_PAGE_SIZE
+        else:
+            page_size = -1                                                  # 没有限制时一次读取全部
+        tail_list = []                                                      # 从新到旧
+        token_sum = self.context.total_tokens
+        logline_max = None
+        flag_full = False
+        while not flag_full:
+            history_context = self.database.get_message_before(session_id, page_size, logline_max=logline_max, status_max=20000)
+            for line in history_context:
+                if line.role not in ["user", "assistant"]:
+                    continue
+                if line.token_num is None:
+                    token_this = self.context.count_token({"role": line.role, "content": line.message})
+                else:
+                    token_this = (line.token_num, False)
+                # 与 _ContextWindow.trim 一致：最新的一条消息总是会被保留
+                if len(tail_list) > 0 and (
+                    (max_context > 0 and len(self.context) + len(tail_list) >= max_context)
+                    or (max_tokens > 0 and token_sum + token_this[0] > max_tokens)
+                ):
+                    flag_full = True
+                    break
+                tail_list.append((line.role, line.message, token_this))
+                token_sum += token_this[0]
+                if line.token_num is None and not token_this[1]:
+                    token_backfill.append((line.logline, token_this[0]))
+            if page_size < 0 or len(history_context) < page_size:
+                break
+            logline_max = history_context[-1].logline
+        tail_list.reverse()
+        self.context.load(tail_list)
 
-    def add_message(self, role: "Literal['system', 'user', 'assistant']", message: str, record: bool = True):
+        if len(token_backfill) > 0:
+            # 旧版本记录的消息没有 token 数量，计算后回填到数据库中
+            try:
+                self.database.update_token_num(session_id, token_backfill)
+            except Exception as err:
+                utils.get_logger().error(f"回填 token 数量失败: {err.__class__.__name__}: {err}")
+        return self.get_messages()
+
+    def add_message(self, role: "Literal['system', 'user', 'assistant']", message: str, record: bool = True, token_num: "int|None" = None, base_status: int = 10000):
         """
             add a message to the body
+
+            token_num 为已知的 token 数量 (如数据库中记录的值)，为 None 时计算
+            返回该消息的 token 数量，如果为估计值则返回 None，数据库中也记为 NULL
         """
-        self.body["messages"].append({
-            "role": role,
-            "content": message
-        })
-        if self.model_conf.max_context > 0 and len(self.body["messages"]) > self.model_conf.max_context:
-            self.body["messages"].pop(0)
+        token = self.context.append(role, message, token_num)
         if record:
-            self._record(role, message)
+            self._record(role, message, token, base_status)
+        return token
 
-    def send(self, cmd: utils.CommandConfig|None = None):
+    def send(self, cmd: utils.CommandConfig|None = None) -> int:
         """
             send a message to the API server
+
+            同一会话中的消息按顺序排队，上一条消息的回复记录到上下文之后才会发送下一条
+            返回该消息在会话队列中的位置，0 表示已直接提交发送
         """
-        if self.model_conf.timeout > 0:
-            lock = self._lock.acquire(blocking=True, timeout=self.model_conf.timeout)
-        else:
-            lock = self._lock.acquire(blocking=True)
         message = cmd.message if cmd is not None else ""
-        if message != "":
-            self.add_message("user", message)
-        else:
+        if message == "":
+            return 0
+        with self._lock:
+            if self._flag_running:
+                if self.model_conf.session_queue_size > 0 and len(self._queue) >= self.model_conf.session_queue_size:
+                    raise exceptions.OlivaChatGPTSessionQueueFullError(self.model_conf.session_queue_size)
+                self._queue.append(cmd)
+                return len(self._queue)
+            self.__submit(cmd)
+            self._flag_running = True
+        return 0
+
+    def __submit(self, cmd: utils.CommandConfig|None):
+        "将一条消息提交到调度器，需要在持有 self._lock 时调用"
+        cost = self.__estimate_cost(cmd)
+        self._token_admitted = cost
+        self._rate_limit_key = None
+        rate_limit_keys = None
+        if self.model_conf.rate_limit_rpm > 0 or self.model_conf.rate_limit_tpm > 0:
+            # 按实际选择的上游的 API Key 扣除额度，调度器选中的 key 作为最后一个参数传给 func
+            rate_limit_keys = get_upstream_group(self.model_conf).rate_limit_keys
+        func = self.__send_async if self._engine is not None else self.__send
+        schedulerAPI.get_scheduler().submit(
+            self.model_conf, func, cmd, cost=cost, on_reject=lambda err, cmd=cmd: self.__reject(cmd, err),
+            rate_limit_keys=rate_limit_keys,
+        )
+
+    def __estimate_cost(self, cmd: utils.CommandConfig|None) -> int:
+        "估计该请求的 prompt token 数量，用于调度器的 TPM 限制"
+        if self.model_conf.rate_limit_tpm <= 0:
+            return 0
+        token_send = self.context.total_tokens + 3
+        if cmd is not None:
+            token_send += self.context.count_token({"role": "user", "content": cmd.message})[0]
+        return token_send
+
+    def __adjust_rate_limit(self, token_num: int):
+        """
+            按实际用量修正提交时预扣的 TPM 额度，token_num 为 0 时全额退还
+            每个请求只修正一次
+        """
+        if self._token_admitted <= 0:
+            return
+        cost, self._token_admitted = self._token_admitted, 0
+        schedulerAPI.get_scheduler().adjust_rate_limit(self.model_conf.model_name, cost, token_num, self._rate_limit_key)
+
+    def __move_rate_limit(self, upstream: _Upstream, flag_keep: bool):
+        """
+            重试时换用了其他 API Key 的上游，改为扣除新的 key 的 RPM / TPM 额度
+            flag_keep 为 False 时 (上一次请求没有被处理) 退还原来的 key 的 TPM 额度
+        """
+        if self._rate_limit_key is None or upstream.rate_limit_key == self._rate_limit_key:
             return
-        if lock:
-            self.cache["cmd"] = cmd
-            threading.Thread(target=self.__send).start()
-            self._lock.release()
+        cost = self._token_admitted
+        if flag_keep:
+            self._token_admitted = 0
         else:
-            raise exceptions.OlivaChatGPTRuntimeError("RemoteClient is busy")
+            self.__adjust_rate_limit(0)
+        self._rate_limit_key = upstream.rate_limit_key
+        self._token_admitted = cost
+        schedulerAPI.get_scheduler().take_rate_limit(self.model_conf.model_name, cost, upstream.rate_limit_key)
 
-    def __send(self):
-        # self.add_message(message)
-        reply = replyAPI.Reply.send.response()
+    @staticmethod
+    def __is_not_sent(err: Exception) -> bool:
+        "请求是否因为没有可用的上游或无法建立连接而没有发出"
+        if isinstance(err, exceptions.OlivaChatGPTUpstreamUnavailableError):
+            return True
+        if FLAG_AIOHTTP_INSTALLED and _is_connect_error_async(err):
+            return True
+        return _is_connect_error(err)
 
-        dict_fmt = {}
-        cmd = self.cache["cmd"]
+    def __reply_fail(self, cmd: utils.CommandConfig|None, err: exceptions.OlivaChatGPTSchedulerFullError):
+        "消息没有被发送，回复失败原因"
         if cmd is not None:
-            dict_fmt = cmd.dict_format
-        flag_success = False
-        response_data = None
+            reply = replyAPI.Reply.send.fail()
+            reply.add_data(cmd.dict_format)
+            reply.add_data({"reason": str(err.msg)})
+            cmd.plugin_event.reply(reply.to_message())
+
+    def __reject(self, cmd: utils.CommandConfig|None, err: exceptions.OlivaChatGPTSchedulerFullError):
+        "消息因 RPM / TPM 限制等待超时被调度器放弃，继续发送下一条"
         try:
-            # with self._lock:
-            log = utils.get_logger()
-            log.debug(f"Sending message to {self.url}...")
-            log.debug(f"Header: {self.header}")
-            log.debug(f"Message: {self.body}")
-            timeout = None
-            if self.model_conf.timeout > 0:
-                timeout = self.model_conf.timeout
-            if self.model_conf.stream:
+            self.__reply_fail(cmd, err)
+        finally:
+            self.__send_next()
+
+    def __send_next(self):
+        """
+            上一条消息处理完成，发送会话队列中的下一条消息
+        """
+        while True:
+            with self._lock:
+                if len(self._queue) == 0:
+                    self._flag_running = False
+                    return
+                cmd = self._queue.popleft()
+                try:
+                    self.__submit(cmd)
+                    return
+                except exceptions.OlivaChatGPTSchedulerFullError as err:
+                    err_this = err
+            # 调度器队列已满，该消息发送失败，继续尝试下一条
+            self.__reply_fail(cmd, err_this)
+
+    def is_idle(self):
+        """
+            当前会话没有进行中或排队中的消息
+        """
+        with self._lock:
+            return not self._flag_running and len(self._queue) == 0
+
+    def __send(self, cmd: utils.CommandConfig|None = None, rate_limit_key: "str|None" = None):
+        """
+            send the request with `requests` in the scheduler worker thread
 
+            rate_limit_key 为调度器扣除了额度的上游 API Key (的摘要)，第一次请求只发送到使用该 key 的上游
+        """
+        self._rate_limit_key = rate_limit_key
+        reply = replyAPI.Reply.send.response()
+        try:
+            if cmd is not None:
+                self.add_message("user", cmd.message)
+        except Exception:
+            self.__send_next()
+            raise
+        self.body["messages"] = self.context.to_list()
+        self._token_send = self.context.prompt_tokens(flag_estimate=True)
+        self._token_receive = None
+        log = utils.get_logger()
+        log.debug(f"Message: {self.body}")
+        timeout = None
+        if self.model_conf.timeout > 0:
+            timeout = self.model_conf.timeout
+        flusher = self.__get_flusher(cmd)
+        try:
+            if self.model_conf.stream:
                 log.debug("using stream mode")
                 self.body["stream"] = True
-                response = requests.request(
-                    method="POST",
-                    url=self.url,
-                    headers=self.header,
-                    json=self.body,
-                    stream=True,
-                    timeout=timeout,
-                )
-                token_send = get_token_from_message_list(self.body["messages"], self.model_conf.model_type)
-                data, response_data = self.__get_stream_response(response)
-                token_receive = get_token_from_string(data, self.model_conf.model_type)
-                if token_send is not None and token_receive is not None:
-                    dict_fmt["token_num"] = f"{token_send} + {token_receive} = {token_send + token_receive}\n\tstream mode 下基于 tiktoken 估计 token 数量，请以实际账单为准"
-                else:
-                    dict_fmt["token_num"] = f"stream mode 下未安装 tiktoken 库或模型不支持，无法计算 token 数量"
+                if self.model_conf.stream_include_usage:
+                    self.body["stream_options"] = {"include_usage": True}
             else:
                 self.body["stream"] = False
+            data, response_data = self.__request(cmd, flusher, timeout)
+            if not self.model_conf.stream:
+                log.debug(f"Response: {response_data}")
+        except Exception as err:
+            self.__finish(cmd, reply, error=err, flusher=flusher)
+        else:
+            self.__finish(cmd, reply, data, response_data, flusher=flusher)
+
+    def __request(self, cmd: utils.CommandConfig|None, flusher: "_StreamFlusher | None", timeout: "float|None"):
+        """
+            send the request with `requests`, retry with another upstream on the retryable errors
 
-                response = requests.request(
+            建立连接失败或返回 retry_status_codes 中的状态码时，等待退避时间后重试
+            retry_read_error 开启时，已发出请求但尚未收到响应头的错误也会重试
+            开始读取回复内容后不再重试，stream mode 下不会重复发送已经接收到的部分
+        """
+        log = utils.get_logger()
+        group = get_upstream_group(self.model_conf)
+        tried: "set[_Upstream]" = set()
+        attempt = 0
+        flag_keep = True                # 上一次请求是否可能已被处理 (或收到 429)，换用其他 API Key 时是否保留原来的 TPM 额度
+        while True:
+            upstream = group.pick(tried, self._rate_limit_key if attempt == 0 else None)
+            tried.add(upstream)
+            if attempt > 0:
+                self.__move_rate_limit(upstream, flag_keep)
+            flag_retry = attempt < self.model_conf.retry_max
+            log.debug(f"Sending message to {upstream.url}...")
+            time_start = time.time()
+            latency = None
+            status_code = None
+            delay = None
+            try:
+                with self._pool.request(
                     method="POST",
-                    url=self.url,
-                    headers=self.header,
+                    url=upstream.url,
+                    headers=upstream.header,
                     json=self.body,
+                    stream=self.model_conf.stream,
                     timeout=timeout,
-                    # verify=None,
-                )
-                data, response_data = self.__get_post_response(response)
-                dict_fmt["token_num"] = f"""\
-{response_data["usage"]["prompt_tokens"]}+{response_data["usage"]["completion_tokens"]} = {response_data["usage"]["total_tokens"]}"""
+                ) as response:
+                    latency = time.time() - time_start
+                    status_code = response.status_code
+                    if flag_retry and response.status_code in self.model_conf.retry_status_codes:
+                        delay = get_retry_delay(self.model_conf, attempt, response.headers.get("Retry-After", None))
+                    if delay is not None:
+                        flag_keep = response.status_code != 503
+                        log.warn(f"{upstream.url} returned {response.status_code}, retrying ({attempt + 1}/{self.model_conf.retry_max})")
+                    else:
+                        if self.model_conf.stream:
+                            result = self.__get_stream_response(response, cmd, flusher)
+                        else:
+                            result = self.__get_post_response(response)
+                        group.report(upstream, True, latency)
+                        return result
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                if not flag_retry or latency is not None or not (_is_connect_error(err) or self.model_conf.retry_read_error):
+                    group.report(upstream, False, latency)
+                    raise
+                delay = get_retry_delay(self.model_conf, attempt)
+                flag_keep = not _is_connect_error(err)
+                log.warn(f"{upstream.url}: {err.__class__.__name__}: {err}, retrying ({attempt + 1}/{self.model_conf.retry_max})")
+            except exceptions.OlivaChatGPTHTTPCodeError as err:
+                group.report(upstream, not _is_upstream_failure(err.code), latency)
+                raise
+            except Exception:
+                group.report(upstream, False, latency)
+                raise
+            # 按状态码重试时，429 等不说明上游不可用的状态码不计入熔断的失败次数
+            group.report(upstream, status_code is not None and not _is_upstream_failure(status_code), latency)
+            time.sleep(delay)                                               # type: ignore
+            attempt += 1
+
+    def __send_async(self, cmd: utils.CommandConfig|None = None, rate_limit_key: "str|None" = None):
+        """
+            send the request on the event loop of the asyncio engine
+
+            返回 `concurrent.futures.Future`，调度器会在其完成后才释放该模型的并发额度
+            rate_limit_key 与 `__send` 相同
+        """
+        self._rate_limit_key = rate_limit_key
+        try:
+            if cmd is not None:
+                self.add_message("user", cmd.message)
+            self.body["messages"] = self.context.to_list()
+            self._token_send = self.context.prompt_tokens(flag_estimate=True)
+            self._token_receive = None
+            return self._engine.submit(self.__send_coroutine(cmd))         # type: ignore
+        except Exception:
+            self.__send_next()
+            raise
 
+    async def __send_coroutine(self, cmd: utils.CommandConfig|None = None):
+        reply = replyAPI.Reply.send.response()
+        log = utils.get_logger()
+        log.debug(f"Message: {self.body}")
+        engine: _AsyncEngine = self._engine                                 # type: ignore
+        error = None
+        data = response_data = None
+        flusher = self.__get_flusher(cmd)
+        try:
+            timeout = None
+            if self.model_conf.timeout > 0:
+                timeout = self.model_conf.timeout
+            self.body["stream"] = self.model_conf.stream
+            if self.model_conf.stream and self.model_conf.stream_include_usage:
+                self.body["stream_options"] = {"include_usage": True}
+            if self.model_conf.stream:
+                log.debug("using stream mode")
+            data, response_data = await self.__request_async(cmd, flusher, timeout)
+            if not self.model_conf.stream:
                 log.debug(f"Response: {response_data}")
+        except Exception as err:
+            error = err
+        # 数据库写入与回复发送是阻塞操作，不能在事件循环线程中进行
+        await engine.run_in_executor(self.__finish, cmd, reply, data, response_data, error, flusher)
 
-        except exceptions.OlivaChatGPTHTTPCodeError as err:
-            status_code = err.code + 51000
-            self.database.save_error(
-                session_id=self.session_model.session_id, error_msg=str(err.content), status=status_code-20100
-            )
+    async def __request_async(self, cmd: utils.CommandConfig|None, flusher: "_StreamFlusher | None", timeout: "float|None"):
+        """
+            send the request with `aiohttp`, retry with another upstream on the retryable errors
+
+            重试规则与 `__request` 相同
+        """
+        log = utils.get_logger()
+        engine: _AsyncEngine = self._engine                                 # type: ignore
+        session = engine.get_session(self.model_conf)
+        group = get_upstream_group(self.model_conf)
+        tried: "set[_Upstream]" = set()
+        if self.model_conf.stream:
+            client_timeout = _aiohttp.ClientTimeout(total=None, sock_read=timeout)         # type: ignore
+        else:
+            client_timeout = _aiohttp.ClientTimeout(total=timeout)                          # type: ignore
+        attempt = 0
+        flag_keep = True                # 上一次请求是否可能已被处理 (或收到 429)，换用其他 API Key 时是否保留原来的 TPM 额度
+        while True:
+            upstream = group.pick(tried, self._rate_limit_key if attempt == 0 else None)
+            tried.add(upstream)
+            if attempt > 0:
+                self.__move_rate_limit(upstream, flag_keep)
+            flag_retry = attempt < self.model_conf.retry_max
+            log.debug(f"Sending message to {upstream.url} (asyncio)...")
+            time_start = time.time()
+            latency = None
+            status_code = None
+            delay = None
+            try:
+                async with session.post(
+                    upstream.url,
+                    headers=upstream.header,
+                    json=self.body,
+                    timeout=client_timeout,
+                ) as response:
+                    latency = time.time() - time_start
+                    status_code = response.status
+                    if flag_retry and response.status in self.model_conf.retry_status_codes:
+                        delay = get_retry_delay(self.model_conf, attempt, response.headers.get("Retry-After", None))
+                    if delay is not None:
+                        flag_keep = response.status != 503
+                        log.warn(f"{upstream.url} returned {response.status}, retrying ({attempt + 1}/{self.model_conf.retry_max})")
+                    else:
+                        if self.model_conf.stream:
+                            result = await self.__get_stream_response_async(response, cmd, flusher)
+                        else:
+                            result = await self.__get_post_response_async(response)
+                        group.report(upstream, True, latency)
+                        return result
+            except (_aiohttp.ClientConnectionError, _aiohttp.ClientPayloadError, asyncio.TimeoutError) as err:    # type: ignore
+                if not flag_retry or latency is not None or not (_is_connect_error_async(err) or self.model_conf.retry_read_error):
+                    group.report(upstream, False, latency)
+                    raise
+                delay = get_retry_delay(self.model_conf, attempt)
+                flag_keep = not _is_connect_error_async(err)
+                log.warn(f"{upstream.url}: {err.__class__.__name__}: {err}, retrying ({attempt + 1}/{self.model_conf.retry_max})")
+            except exceptions.OlivaChatGPTHTTPCodeError as err:
+                group.report(upstream, not _is_upstream_failure(err.code), latency)
+                raise
+            except Exception:
+                group.report(upstream, False, latency)
+                raise
+            group.report(upstream, status_code is not None and not _is_upstream_failure(status_code), latency)
+            await asyncio.sleep(delay)                                      # type: ignore
+            attempt += 1
+
+    def __get_flusher(self, cmd: utils.CommandConfig|None) -> "_StreamFlusher | None":
+        "stream mode 下开启了 stream_flush 时，返回用于分段发送回复的 _StreamFlusher"
+        if cmd is None or not self.model_conf.stream or not self.model_conf.stream_flush:
+            return None
+        return _StreamFlusher(self.model_conf.stream_flush_chars, self.model_conf.stream_flush_interval)
+
+    def __reply_partial(self, cmd: utils.CommandConfig|None, text_list: list[str]):
+        "将已经接收到的部分回复作为单独的消息发送"
+        if cmd is None:
+            return
+        for text in text_list:
+            reply = replyAPI.Reply.send.partial()
+            reply.add_data({"reply_message": text})
+            cmd.plugin_event.reply(reply.to_message())
+
+    def __finish(self, cmd: utils.CommandConfig|None, reply, data=None, response_data=None, error: Exception|None = None, flusher: "_StreamFlusher | None" = None):
+        """
+            handle the result of the request, record it and reply to the user
+
+            如果使用了 flusher 分段发送，最终回复中只包含尚未发送的部分
+        """
+        log = utils.get_logger()
+        flag_success = False
+        try:
+            flushed_length = flusher.flushed_length if flusher is not None else 0
+            dict_fmt: "collections.ChainMap|dict" = {}
             if cmd is not None:
-                dict_fmt["reply_message"] = f"""\
+                dict_fmt = cmd.dict_format_overlay()
+            try:
+                if error is not None:
+                    raise error
+                if self.model_conf.stream and self._token_receive is not None and self._token_receive[0] is not None:
+                    usage = self._token_receive[0]
+                    token_total = usage["total_tokens"]
+                    dict_fmt["token_num"] = f"""\
+{usage["prompt_tokens"]}+{usage["completion_tokens"]} = {usage["total_tokens"]}"""
+                elif self.model_conf.stream:
+                    token_send, flag_send_estimated = self._token_send                                  # type: ignore
+                    if self._token_receive is not None:
+                        _, token_receive, flag_receive_estimated = self._token_receive
+                    else:
+                        token_receive, flag_receive_estimated = get_token_from_string(
+                            data, self.model_conf.model_type, flag_estimate=True                        # type: ignore
+                        )
+                    token_total = token_send + token_receive
+                    if flag_send_estimated or flag_receive_estimated:
+                        dict_fmt["token_num"] = f"{token_send} + {token_receive} = {token_send + token_receive}\n\tstream mode 下未安装 tiktoken 库或模型不支持，使用内置方法粗略估算 token 数量，请以实际账单为准"
+                    else:
+                        dict_fmt["token_num"] = f"{token_send} + {token_receive} = {token_send + token_receive}\n\tstream mode 下基于 tiktoken 估计 token 数量，请以实际账单为准"
+                else:
+                    token_total = response_data["usage"]["total_tokens"]                                # type: ignore
+                    dict_fmt["token_num"] = f"""\
+{response_data["usage"]["prompt_tokens"]}+{response_data["usage"]["completion_tokens"]} = {response_data["usage"]["total_tokens"]}"""     # type: ignore
+                self.__adjust_rate_limit(token_total)
+
+            except exceptions.OlivaChatGPTHTTPCodeError as err:
+                if err.code == 429:
+                    # 上游的额度已经用完，保留预扣的 TPM 额度，避免队列中的下一个请求立即发出并再次收到 429
+                    pass
+                elif 400 <= err.code < 500:
+                    # 服务器拒绝了该请求，退还预扣的 TPM 额度
+                    self.__adjust_rate_limit(0)
+                status_code = err.code + 51000
+                self.database.save_error(
+                    session_id=self.session_model.session_id, error_msg=str(err.content), status=status_code-20100
+                )
+                if cmd is not None:
+                    dict_fmt["reply_message"] = f"""\
 发送消息失败，错误码: {status_code}
 错误信息：\n
 {err.content}
 """
-                reply.add_data(dict_fmt)
-        except exceptions.OlivaChatGPTHTTPResponseInvalidError as err:
-            self.database.save_error(
-                session_id=self.session_model.session_id, error_msg=str(err.data), status=52200-20100
-            )
-            if cmd is not None:
-                dict_fmt["reply_message"] = f"""\
+                    reply.add_data(dict_fmt)
+            except exceptions.OlivaChatGPTHTTPResponseInvalidError as err:
+                self.database.save_error(
+                    session_id=self.session_model.session_id, error_msg=str(err.data), status=52200-20100
+                )
+                if cmd is not None:
+                    dict_fmt["reply_message"] = f"""\
 发送消息失败，错误码: 52200
 错误信息：\n
 {err.data}
 """
-                reply.add_data(dict_fmt)
-        except exceptions.OlivaChatGPTHTTPTimeoutError as err:
-            # 当在 steam mode 下，超过 120s 未接收到结束符时，会抛出此异常
-            # 此时， err.data 为已经接收到的数据
-            # 此条消息仍然会被记录到数据库中
-            message_this = str(err.data)
-            self.database.save_message(
-                session_id=self.session_model.session_id, message=message_this, role="assistant", base_status=11000
-            )
-            self.add_message("assistant", message_this, record=False)
-            if cmd is not None:
-                dict_fmt["reply_message"] = message_this
-            flag_success = True
-        except Exception as err:
-            self.database.save_error(
-                session_id=self.session_model.session_id, error_msg=str(err), status=50000-20100
-            )
-            if cmd is not None:
-                dict_fmt["reply_message"] = f"""\
+                    reply.add_data(dict_fmt)
+            except exceptions.OlivaChatGPTHTTPTimeoutError as err:
+                # 当在 steam mode 下，超过 120s 未接收到结束符时，会抛出此异常
+                # 此时， err.data 为已经接收到的数据
+                # 此条消息仍然会被记录到数据库中
+                message_this = str(err.data)
+                if self._token_send is not None:
+                    self.__adjust_rate_limit(
+                        self._token_send[0] + get_token_from_string(message_this, self.model_conf.model_type, flag_estimate=True)[0]      # type: ignore
+                    )
+                self.add_message("assistant", message_this, base_status=11000)
+                if cmd is not None:
+                    dict_fmt["reply_message"] = message_this[flushed_length:]
+                    reply.add_data(dict_fmt)
+                flag_success = True
+            except Exception as err:
+                if self.__is_not_sent(err):
+                    self.__adjust_rate_limit(0)
+                self.database.save_error(
+                    session_id=self.session_model.session_id, error_msg=str(err), status=50000-20100
+                )
+                if cmd is not None:
+                    dict_fmt["reply_message"] = f"""\
 发送消息失败，错误码: 50000
 错误信息：\n
 {err.__class__.__name__}: {err}
 """
-                reply.add_data(dict_fmt)
-        else:
-            self.add_message("assistant", data)
-            if cmd is not None:
-                dict_fmt["reply_message"] = f"""\
-{data}
+                    reply.add_data(dict_fmt)
+            else:
+                self.add_message("assistant", data)                             # type: ignore
+                if cmd is not None:
+                    dict_fmt["reply_message"] = f"""\
+{data[flushed_length:]}
 """
-                reply.add_data(dict_fmt)
-            flag_success = True
+                    reply.add_data(dict_fmt)
+                flag_success = True
+            finally:
+                if flag_success == False:
+                    # 撤回发送失败的用户消息 (错误信息的状态码不小于 20000，不会被计入)
+                    try:
+                        self.database.recall_messages(self.session_model.session_id, 1, target_add=20100)
+                    except Exception as err:
+                        log.error(f"Failed to recall the message of session <{self.session_model.session_id}>: {err.__class__.__name__}: {err}")
+                    try:
+                        self.context.pop()
+                    except Exception as err:
+                        log.error(f"Failed to pop the context of session <{self.session_model.session_id}>: {err.__class__.__name__}: {err}")
+                try:
+                    event_this = after_receive_message_config(
+                        self.session_model, cmd, self.model_conf.stream, flag_success, response_data            # type: ignore
+                    )
+                except Exception as err:
+                    log.error(f"Failed to build the remote.recv event: {err.__class__.__name__}: {err}")
+                    event_this = None
+                try:
+                    # 用于处理 remote.recv hook，可以用于处理 tocken 数量计算减少等
+                    if event_this is not None:
+                        crossHook.run_hook("remote.recv", event_this)
+                except Exception as err:
+                    log.error(f"Error in remote.recv hook: {err}")
+                    reply.append(f"Error in remote.recv hook: {err}")
+                if cmd is not None:
+                    for message_obj in reply.to_message_list():
+                        cmd.plugin_event.reply(message_obj)
         finally:
-            if flag_success == False:
-                self.database.recall_messages(self.session_model.session_id, 2, target_add=20100)
-                self.body["messages"].pop(-1)
-            
-            event_this = after_receive_message_config(
-                self.session_model, cmd, self.model_conf.stream, flag_success, response_data
-            )
-            try:
-                # 用于处理 remote.recv hook，可以用于处理 tocken 数量计算减少等
-                crossHook.run_hook("remote.recv", event_this)
-            except Exception as err:
-                log = utils.get_logger()
-                log.error(f"Error in remote.recv hook: {err}")
-                reply.append(f"Error in remote.recv hook: {err}")
-            if cmd is not None:
-                cmd.plugin_event.reply(reply.to_message())
-            self.cache["cmd"] = None
+            # 无论上面哪一步出错，都要释放运行标记并处理队列中的下一条消息，否则该会话会一直处于忙碌状态
+            self.__send_next()
     
     def recall(self, num: int, target_add: int = 20100, status_max: int = 20000):
         """
@@ -241,16 +1466,22 @@ class RemoteClient:
         """
         self.database.recall_messages(self.session_model.session_id, num, target_add=target_add, status_max=status_max)
         for _ in range(num):
-            self.body["messages"].pop(-1)
+            self.context.pop()
+
+    def get_messages(self) -> list[dict]:
+        """
+            get the context messages which will be sent to the API server
+        """
+        return self.context.to_list()
 
-    def _record(self, role: "Literal['unknown', 'system', 'user', 'assistant']", content: str):
+    def _record(self, role: "Literal['unknown', 'system', 'user', 'assistant']", content: str, token_num: "int|None" = None, base_status: int = 10000):
         """
             record the message to the database
         """
         log = utils.get_logger()
         log.debug(f"Recording message <role: {role}>: \n{content}")
         self.database.save_message(
-            session_id=self.session_model.session_id, message=content, role=role
+            session_id=self.session_model.session_id, message=content, role=role, base_status=base_status, token_num=token_num
         )
 
     def __get_post_response(self, response: requests.Response):
@@ -266,83 +1497,247 @@ class RemoteClient:
             raise exceptions.OlivaChatGPTHTTPResponseInvalidError(response_json, str(err))
         return data, response_json
 
-    def __get_stream_response(self, response: requests.Response):
+    def __stream_result(self, stream: _StreamResponse):
+        "stream mode 接收完成，记录回复的 token 数量"
+        self._token_receive = stream.token_usage()
+        return stream.result()
+
+    def __get_stream_response(self, response: requests.Response, cmd: utils.CommandConfig|None = None, flusher: "_StreamFlusher | None" = None):
         """
             get the response in stream mode
         """
-        # 遍历所有的数据块并打印出来
-        log = utils.get_logger()
-        completion_text = ""
-        event_list = []
-        time_start = time.time()
-        if (response.status_code == 200):
-            err_time = 0
-            while time.time() - time_start < STREAM_TIME_OUT:
-                tmp_data = b""
-                # flag_data_start = False
-                try:
-                    for chunk in response.iter_lines(chunk_size=1024):
-                        if chunk:
-                            log.trace(f"chunk: {chunk}")
-                            if chunk.startswith(b"data: "):
-                                # the chunk is the start of a new chunk
-                                chunk = chunk[6:]
-                                tmp_data = chunk
-                            else:
-                                # the chunk is part of the last chunk
-                                tmp_data += chunk
-                            try:
-                                event_this = json.loads(tmp_data)
-                                event_list.append(event_this)
-                                # tmp_data = tmp_data[end_index + 5:]
-                            except json.JSONDecodeError:
-                                if tmp_data == b"[DONE]":
-                                    # break
-                                    log.trace("chunk [DONE]")
-                                    return completion_text, event_list
-                                log.error(f"JSONDecodeError: {chunk}")
-                                # tmp_data = tmp_data[end_index + 5:]
-                            else:
-                                if len(event_this["choices"]) == 0 or "delta" not in event_this["choices"][0]:
-                                    # log.debug("an empty chunk")
-                                    continue
-                                if "content" in event_this["choices"][0]["delta"]:
-                                    completion_text += event_this["choices"][0]["delta"]["content"]
-                                if "finish_reason" in event_this["choices"][0] and event_this["choices"][0]["finish_reason"] is not None:
-                                    if event_this["choices"][0]["finish_reason"] == "stop":
-                                        log.trace("stopped!")
-                                        return completion_text, event_list
-                                    else:
-                                        log.warn(f"gpt returns with stop reason: {event_this['choices'][0]['finish_reason']}")
-                                        return completion_text, event_list
-
-                except requests.exceptions.ReadTimeout as err:
-                    log.error(f"ReadTimeout: {err}")
-                    err_time += 1
-                    if err_time > 5:
-                        return completion_text, event_list
-                    time.sleep(1)
-
-                except requests.exceptions.StreamConsumedError as err:
-                    log.error(f"StreamConsumedError: {err}")
-                    err_time += 1
-                    if err_time > 5:
-                        return completion_text, event_list
-                    time.sleep(1)
-                time.sleep(0.01)
-            raise exceptions.OlivaChatGPTHTTPTimeoutError(completion_text)
-        else:
+        if response.status_code != 200:
             raise exceptions.OlivaChatGPTHTTPCodeError(response.status_code, response.content.decode(encoding="utf-8"))
+        parser = SSEParser()
+        stream = _StreamResponse(flusher, self.model_conf.model_type)
+        time_start = time.time()
+        try:
+            for chunk in response.iter_content(chunk_size=None):
+                for data in parser.feed(chunk):
+                    if stream.feed(data):
+                        return self.__stream_result(stream)
+                if flusher is not None and flusher.has_output():
+                    self.__reply_partial(cmd, flusher.pop_output())
+                if time.time() - time_start > STREAM_TIME_OUT:
+                    raise exceptions.OlivaChatGPTHTTPTimeoutError(stream.text())
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+            # 读取超时或连接中断，已经接收到的数据仍然作为回复
+            utils.get_logger().error(f"{err.__class__.__name__}: {err}")
+            raise exceptions.OlivaChatGPTHTTPTimeoutError(stream.text())
+        for data in parser.finish():
+            if stream.feed(data):
+                break
+        return self.__stream_result(stream)
+
+    async def __get_post_response_async(self, response: "_aiohttp.ClientResponse"):      # type: ignore
+        """
+            the callback function for the request (asyncio)
+        """
+        if response.status != 200:
+            raise exceptions.OlivaChatGPTHTTPCodeError(response.status, await response.text(encoding="utf-8"))
+        response_json = await response.json(content_type=None)
+        try:
+            data = response_json["choices"][0]["message"]["content"]
+        except Exception as err:
+            raise exceptions.OlivaChatGPTHTTPResponseInvalidError(response_json, str(err))
+        return data, response_json
+
+    async def __get_stream_response_async(self, response: "_aiohttp.ClientResponse", cmd: utils.CommandConfig|None = None, flusher: "_StreamFlusher | None" = None):    # type: ignore
+        """
+            get the response in stream mode (asyncio)
+        """
+        if response.status != 200:
+            raise exceptions.OlivaChatGPTHTTPCodeError(response.status, await response.text(encoding="utf-8"))
+        parser = SSEParser()
+        stream = _StreamResponse(flusher, self.model_conf.model_type)
+        time_start = time.time()
+        try:
+            async for chunk in response.content.iter_any():
+                for data in parser.feed(chunk):
+                    if stream.feed(data):
+                        return self.__stream_result(stream)
+                if flusher is not None and flusher.has_output():
+                    await self._engine.run_in_executor(self.__reply_partial, cmd, flusher.pop_output())    # type: ignore
+                if time.time() - time_start > STREAM_TIME_OUT:
+                    raise exceptions.OlivaChatGPTHTTPTimeoutError(stream.text())
+        except (asyncio.TimeoutError, _aiohttp.ClientPayloadError) as err:                  # type: ignore
+            # 读取超时或连接中断，已经接收到的数据仍然作为回复
+            utils.get_logger().error(f"{err.__class__.__name__}: {err}")
+            raise exceptions.OlivaChatGPTHTTPTimeoutError(stream.text())
+        for data in parser.finish():
+            if stream.feed(data):
+                break
+        return self.__stream_result(stream)
+
+class _RemoteClientRegistry:
+    """
+        the registry of `RemoteClient`
+
+        以 SessionModel 为键保存 `RemoteClient`，按最近使用顺序 (LRU) 淘汰空闲的客户端：
+        - 客户端数量超过 `max_num`
+        - 所有客户端上下文的总字节数超过 `max_bytes` (上下文字节数在每次获取客户端时更新)
+        - 客户端超过 `idle_timeout` 秒未被使用
+        只有没有进行中或排队中消息的客户端才会被淘汰，被淘汰的会话再次使用时从数据库重建
+        通过 `use` 获取的客户端在 with 语句内被固定，不会被淘汰，避免同一会话同时存在两个客户端
+    """
+    def __init__(self, max_num: int = 1024, max_bytes: int = -1, idle_timeout: float = -1):
+        self.max_num = max_num
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # 值为 (客户端, 最后使用时间, 上下文字节数)
+        self._clients: "collections.OrderedDict[databaseAPI.SessionModel, tuple[RemoteClient, float, int]]" = collections.OrderedDict()
+        # 被固定的客户端的引用计数
+        self._pinned: dict[databaseAPI.SessionModel, int] = {}
+        self.total_bytes = 0
+        self._count_hit = 0
+        self._count_miss = 0
+        self._count_evict = 0
+
+    def get(self, session_model: databaseAPI.SessionModel, flag_pin: bool = False) -> RemoteClient:
+        """
+            获取会话对应的客户端，不存在时从数据库重建
+
+            flag_pin 为 True 时固定该客户端，使用完毕后需要调用 `release`
+        """
+        with self._lock:
+            client = self.__touch(session_model)
+            if client is not None:
+                self._count_hit += 1
+                if flag_pin:
+                    self._pinned[session_model] = self._pinned.get(session_model, 0) + 1
+                self.__evict(session_model)
+                return client
+            self._count_miss += 1
+        # 在锁外读取数据库重建上下文，同一会话被同时重建时只保留先完成的一个
+        client_new = RemoteClient(session_model)
+        with self._lock:
+            client = self.__touch(session_model)
+            if client is None:
+                client = client_new
+                size = client.context.total_bytes
+                self._clients[session_model] = (client, time.monotonic(), size)
+                self.total_bytes += size
+            if flag_pin:
+                self._pinned[session_model] = self._pinned.get(session_model, 0) + 1
+            self.__evict(session_model)
+            return client
+
+    def release(self, session_model: databaseAPI.SessionModel):
+        """
+            取消一次 `get(..., flag_pin=True)` 的固定
+        """
+        with self._lock:
+            count = self._pinned.get(session_model, 0) - 1
+            if count > 0:
+                self._pinned[session_model] = count
+            else:
+                self._pinned.pop(session_model, None)
+
+    @contextlib.contextmanager
+    def use(self, session_model: databaseAPI.SessionModel):
+        """
+            获取会话对应的客户端，并在 with 语句内将其固定
+
+            用法:
+                with registry.use(session_model) as client:
+                    client.send(cmd)
+        """
+        client = self.get(session_model, flag_pin=True)
+        try:
+            yield client
+        finally:
+            self.release(session_model)
+
+    def __touch(self, session_model: databaseAPI.SessionModel) -> "RemoteClient|None":
+        "更新客户端的最后使用时间与上下文字节数，需要在持有 self._lock 时调用"
+        item = self._clients.get(session_model, None)
+        if item is None:
+            return None
+        client, _, size = item
+        size_new = client.context.total_bytes
+        self.total_bytes += size_new - size
+        self._clients[session_model] = (client, time.monotonic(), size_new)
+        self._clients.move_to_end(session_model)
+        return client
+
+    def __evict(self, session_model_keep: databaseAPI.SessionModel):
+        "从最久未使用的客户端开始淘汰 (正在获取的客户端除外)，需要在持有 self._lock 时调用"
+        time_now = time.monotonic()
+        for key in list(self._clients.keys()):
+            client, time_last, size = self._clients[key]
+            flag_over = (
+                (self.max_num > 0 and len(self._clients) > self.max_num)
+                or (self.max_bytes > 0 and self.total_bytes > self.max_bytes)
+            )
+            flag_expired = self.idle_timeout > 0 and time_now - time_last > self.idle_timeout
+            if not flag_over and not flag_expired:
+                # 之后的客户端使用时间更近，不会过期
+                break
+            if key == session_model_keep or key in self._pinned or not client.is_idle():
+                continue
+            del self._clients[key]
+            self.total_bytes -= size
+            self._count_evict += 1
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+            self.total_bytes = 0
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __contains__(self, session_model: databaseAPI.SessionModel):
+        return session_model in self._clients
+
+    def get_stats(self):
+        """
+            get the statistics of the registry
+        """
+        with self._lock:
+            return {
+                "num": len(self._clients),
+                "max_num": self.max_num,
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hit": self._count_hit,
+                "miss": self._count_miss,
+                "evict": self._count_evict,
+            }
 
-gRemoteClient: dict[databaseAPI.SessionModel, RemoteClient] = {}
+
+gRemoteClient: _RemoteClientRegistry|None = None
+_gRemoteClientLock = threading.Lock()
+
+def get_remote_client_registry() -> _RemoteClientRegistry:
+    """
+        get the registry of `RemoteClient`, create one with the basic config if not exists
+    """
+    global gRemoteClient
+    with _gRemoteClientLock:
+        if gRemoteClient is None:
+            conf = confAPI.get_config()
+            gRemoteClient = _RemoteClientRegistry(
+                conf.basic.client_cache_size, conf.basic.client_cache_bytes, conf.basic.client_idle_timeout
+            )
+        return gRemoteClient
 
 
 def get_remote_client(session_model: databaseAPI.SessionModel):
     """
         get the remote client by session_model
+
+        获取后到使用前，空闲的客户端可能被淘汰，发送消息等操作请使用 `use_remote_client`
     """
-    global gRemoteClient
-    if session_model in gRemoteClient:
-        return gRemoteClient[session_model]
-    else:
-        return RemoteClient(session_model)
+    return get_remote_client_registry().get(session_model)
+
+def use_remote_client(session_model: databaseAPI.SessionModel):
+    """
+        get the remote client by session_model, pinned in the with statement
+
+        用法:
+            with use_remote_client(session_model) as client:
+                client.send(cmd)
+    """
+    return get_remote_client_registry().use(session_model)
@@ -1,10 +1,15 @@
 
+import io
 import time
-import textwrap
 import os
+import hashlib
+import collections
+import threading
+import unicodedata
+import multiprocessing
+import concurrent.futures
 
 from enum import Enum
-from tempfile import NamedTemporaryFile
 from typing import Any
 
 import OlivOS.messageAPI as _OlvMsgAPI
@@ -23,6 +28,446 @@ class PIC_CONFIG:
     MARGIN = 10
     WIDTH = 40
     IMAGE_WIDTH = MARGIN * 2 + WIDTH * FONT_STZE
+    # 用于渲染长文本图片的进程数，为 0 时在当前线程中渲染
+    # 默认不启用：打包后的 OlivOS 等环境无法以 spawn 启动渲染进程，启用后首次渲染失败会自动改回当前线程
+    RENDER_PROCESS_NUM = 0
+    # 等待图片渲染的超时时间 (秒)，超时或渲染失败时改为分段发送文本
+    RENDER_TIMEOUT = 30
+    # 分段发送文本时每条消息的最大长度
+    SPLIT_LENGTH = 2000
+    # 渲染后的图片按文本内容缓存在该目录下
+    CACHE_PATH = os.path.abspath("./plugin/data/OlivaChatGPT/data/image_cache")
+    # 图片缓存占用的最大磁盘空间 (字节)，超出后删除最久未使用的图片
+    CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+
+class _TextImageRender:
+    """
+        render the text into an image
+
+        字体只在第一次使用时加载一次，每个字符的宽度计算后缓存
+        按像素宽度换行：英文单词在空格处换行，中日韩等全角字符之间可以任意换行，原文中的换行会被保留
+        画布宽度为 `PIC_CONFIG.IMAGE_WIDTH`，高度按行数精确计算
+    """
+    def __init__(self, font_path: str, font_size: int, spacing: int, margin: int, image_width: int):
+        self.font_path = font_path
+        self.font_size = font_size
+        self.spacing = spacing
+        self.margin = margin
+        self.image_width = image_width
+        self.line_width = image_width - margin * 2
+        self.render_args = (font_path, font_size, spacing, margin, image_width)
+        self._font = None
+        self._char_width: dict[str, float] = {}
+        # FreeType 字体对象不是线程安全的
+        self._lock = threading.Lock()
+
+    def __get_font(self):
+        "加载字体，需要在持有 self._lock 时调用"
+        if self._font is None:
+            self._font = _PILImageFont.truetype(self.font_path, self.font_size)
+        return self._font
+
+    def __get_char_width(self, char: str) -> float:
+        "获取字符宽度，需要在持有 self._lock 时调用"
+        width = self._char_width.get(char, None)
+        if width is None:
+            width = self.__get_font().getlength(char)
+            self._char_width[char] = width
+        return width
+
+    @staticmethod
+    def _is_wide(char: str) -> bool:
+        return unicodedata.east_asian_width(char) in ("W", "F")
+
+    def __wrap_paragraph(self, paragraph: str, line_list: list[str]):
+        "将不含换行的一段文本按像素宽度切分，需要在持有 self._lock 时调用"
+        length = len(paragraph)
+        width_sum = [0.0]
+        for char in paragraph:
+            width_sum.append(width_sum[-1] + self.__get_char_width(char))
+        start = 0
+        idx_break = -1          # 当前行中最后一个可以换行的位置 (下一行的开头)
+        idx = 0
+        while idx < length:
+            char = paragraph[idx]
+            if idx > start:
+                char_prev = paragraph[idx - 1]
+                if char == " " or char_prev == " " or self._is_wide(char) or self._is_wide(char_prev):
+                    idx_break = idx
+            if idx > start and width_sum[idx + 1] - width_sum[start] > self.line_width:
+                end = idx_break if idx_break > start else idx
+                line_list.append(paragraph[start:end].rstrip())
+                start = end
+                while start < length and paragraph[start] == " ":
+                    start += 1
+                idx_break = -1
+                idx = start
+                continue
+            idx += 1
+        if start < length or length == 0:
+            line_list.append(paragraph[start:].rstrip())
+
+    def wrap(self, text: str) -> list[str]:
+        """
+            将文本按像素宽度切分为多行
+        """
+        line_list: list[str] = []
+        with self._lock:
+            for paragraph in text.expandtabs(4).split("\n"):
+                self.__wrap_paragraph(paragraph.rstrip(), line_list)
+        return line_list
+
+    def render(self, text: str) -> "_PILImage.Image":
+        """
+            将文本渲染为白底黑字的图片
+        """
+        line_list = self.wrap(text)
+        with self._lock:
+            font = self.__get_font()
+            ascent, descent = font.getmetrics()
+            line_height = ascent + descent + self.spacing
+            image_height = self.margin * 2 + max(len(line_list) * line_height - self.spacing, 0)
+            # 白底黑字只需要灰度，比 RGB 少三分之二的数据量，保存为 PNG 时更快、文件更小
+            image = _PILImage.new("L", (self.image_width, image_height), 255)
+            draw = _PILImageDraw.Draw(image)
+            for idx, line in enumerate(line_list):
+                if line != "":
+                    draw.text((self.margin, self.margin + idx * line_height), line, font=font, fill=0)
+        return image
+
+    def render_png(self, text: str) -> bytes:
+        """
+            将文本渲染为 PNG 图片，返回编码后的数据
+        """
+        image = self.render(text)
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        return buffer.getvalue()
+
+
+gTextImageRender: _TextImageRender|None = None
+
+def get_text_image_render() -> _TextImageRender:
+    """
+        get the text-to-image render engine, create one with `PIC_CONFIG` if not exists
+    """
+    global gTextImageRender
+    if gTextImageRender is None:
+        gTextImageRender = _TextImageRender(
+            PIC_CONFIG.FONT_PATH, PIC_CONFIG.FONT_STZE, PIC_CONFIG.FONT_SPACING, PIC_CONFIG.MARGIN, PIC_CONFIG.IMAGE_WIDTH
+        )
+    return gTextImageRender
+
+
+# 渲染进程中的渲染引擎，按参数缓存
+_gProcessRender: dict[tuple, _TextImageRender] = {}
+
+def _render_png_in_process(render_args: tuple, text: str) -> bytes:
+    "在渲染进程中运行"
+    render = _gProcessRender.get(render_args, None)
+    if render is None:
+        render = _TextImageRender(*render_args)
+        _gProcessRender[render_args] = render
+    return render.render_png(text)
+
+
+class _TextImageRenderPool:
+    """
+        render the text images in a process pool
+
+        Pillow 渲染会长时间占用 GIL，放在独立的进程中进行，不影响其他会话的流式解析
+        进程池在第一次使用时创建，渲染进程异常退出后会重新创建
+        如果进程池在成功渲染任何图片之前就无法创建或已损坏，认为当前环境无法使用渲染进程，
+        此后 process_num 置为 0，改为在当前线程中渲染
+        process_num 为 0 时在当前线程中渲染
+    """
+    def __init__(self, process_num: int, timeout: float):
+        self.process_num = max(process_num, 0)
+        self.timeout = timeout
+        self._pool: concurrent.futures.ProcessPoolExecutor|None = None
+        self._lock = threading.Lock()
+        # 进程池是否成功渲染过图片
+        self._flag_verified = False
+
+    def __render_in_thread(self, text_list: "list[str]") -> "list[bytes|None]":
+        log = utils.get_logger()
+        render = get_text_image_render()
+        result_list = []
+        for text in text_list:
+            try:
+                result_list.append(render.render_png(text))
+            except Exception as err:
+                log.error(f"Error in rendering text image: {err.__class__.__name__}: {err}")
+                result_list.append(None)
+        return result_list
+
+    def __disable_pool(self, pool: "concurrent.futures.ProcessPoolExecutor|None", err: Exception):
+        "进程池从未成功渲染过图片就无法使用，之后改为在当前线程中渲染"
+        log = utils.get_logger()
+        log.error(
+            f"Text image render process is not available, render in the current thread instead: "
+            f"{err.__class__.__name__}: {err}"
+        )
+        with self._lock:
+            self.process_num = 0
+            if self._pool is pool:
+                self._pool = None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def __get_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # 插件运行在多线程的进程中，fork 可能复制其他线程持有的锁，统一使用 spawn
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.process_num, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._pool
+
+    def __reset_pool(self, pool: concurrent.futures.ProcessPoolExecutor):
+        "渲染进程异常退出后，丢弃该进程池"
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def render_png_list(self, text_list: list[str]) -> "list[bytes|None]":
+        """
+            将多段文本并行渲染为 PNG 图片
+
+            返回与 text_list 一一对应的 PNG 数据，渲染失败或超时的位置为 None
+        """
+        log = utils.get_logger()
+        if self.process_num <= 0:
+            return self.__render_in_thread(text_list)
+
+        render_args = get_text_image_render().render_args
+        try:
+            pool = self.__get_pool()
+        except Exception as err:
+            self.__disable_pool(None, err)
+            return self.__render_in_thread(text_list)
+        flag_broken: "Exception|None" = None
+        future_list = []
+        for text in text_list:
+            try:
+                future_list.append(pool.submit(_render_png_in_process, render_args, text))
+            except Exception as err:
+                log.error(f"Error in submitting text image: {err.__class__.__name__}: {err}")
+                future_list.append(None)
+                if isinstance(err, concurrent.futures.BrokenExecutor):
+                    flag_broken = err
+        time_end = time.time() + self.timeout if self.timeout > 0 else None
+        result_list = []
+        for future in future_list:
+            if future is None:
+                result_list.append(None)
+                continue
+            try:
+                timeout = max(time_end - time.time(), 0) if time_end is not None else None
+                result_list.append(future.result(timeout=timeout))
+                self._flag_verified = True
+            except concurrent.futures.TimeoutError:
+                log.warn(f"Rendering text image timed out after {self.timeout} s")
+                future.cancel()
+                result_list.append(None)
+            except Exception as err:
+                log.error(f"Error in rendering text image: {err.__class__.__name__}: {err}")
+                result_list.append(None)
+                if isinstance(err, concurrent.futures.BrokenExecutor):
+                    flag_broken = err
+        if flag_broken is not None:
+            if not self._flag_verified:
+                self.__disable_pool(pool, flag_broken)
+                index_list = [i for i, result in enumerate(result_list) if result is None]
+                for i, result in zip(index_list, self.__render_in_thread([text_list[i] for i in index_list])):
+                    result_list[i] = result
+            else:
+                self.__reset_pool(pool)
+        return result_list
+
+    def stop(self):
+        """
+            shutdown the process pool
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+gTextImageRenderPool: _TextImageRenderPool|None = None
+_gTextImageRenderPoolLock = threading.Lock()
+
+def get_text_image_render_pool() -> _TextImageRenderPool:
+    """
+        get the text image render pool, create one with `PIC_CONFIG` if not exists
+    """
+    global gTextImageRenderPool
+    with _gTextImageRenderPoolLock:
+        if gTextImageRenderPool is None:
+            gTextImageRenderPool = _TextImageRenderPool(PIC_CONFIG.RENDER_PROCESS_NUM, PIC_CONFIG.RENDER_TIMEOUT)
+        return gTextImageRenderPool
+
+
+class _TextImageCache:
+    """
+        content-addressed on-disk cache of the rendered images
+
+        图片以 sha256(渲染参数 + 文本) 命名，相同的文本直接返回已有的图片路径
+        文件的 mtime 记录最近一次使用的时间，总大小超过 max_size 时按 mtime 删除最久未使用的图片
+        图片只存在于缓存目录中，不再依赖回复对象被回收时删除临时文件
+    """
+    def __init__(self, cache_path: str, max_size: int):
+        self.cache_path = cache_path
+        self.max_size = max_size
+        # 文件名 -> 文件大小，按最近使用的顺序排列
+        self._index: "collections.OrderedDict[str, int] | None" = None
+        self._size = 0
+        self._count_hit = 0
+        self._count_miss = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(text: str) -> str:
+        "图片的文件名，包含渲染参数，修改字体等设置后不会命中旧的图片"
+        hasher = hashlib.sha256(repr(get_text_image_render().render_args).encode("utf-8"))
+        hasher.update(b"\0")
+        hasher.update(text.encode("utf-8"))
+        return f"{hasher.hexdigest()}.png"
+
+    def __load_index(self) -> "collections.OrderedDict[str, int]":
+        "第一次使用时扫描缓存目录，需要在持有 self._lock 时调用"
+        if self._index is None:
+            os.makedirs(self.cache_path, exist_ok=True)
+            file_list = []
+            for entry in os.scandir(self.cache_path):
+                if not entry.is_file():
+                    continue
+                if not entry.name.endswith(".png"):
+                    # 上次运行时没有写完的文件
+                    self.__remove(entry.name)
+                    continue
+                stat = entry.stat()
+                file_list.append((stat.st_mtime, entry.name, stat.st_size))
+            file_list.sort()
+            self._index = collections.OrderedDict((name, size) for _, name, size in file_list)
+            self._size = sum(self._index.values())
+        return self._index
+
+    def __remove(self, name: str):
+        try:
+            os.remove(os.path.join(self.cache_path, name))
+        except FileNotFoundError:
+            pass
+
+    def __evict(self, name_keep: str):
+        "删除最久未使用的图片直到总大小不超过 max_size，需要在持有 self._lock 时调用"
+        index = self.__load_index()
+        while self._size > self.max_size and len(index) > 1:
+            name, size = next(iter(index.items()))
+            if name == name_keep:
+                index.move_to_end(name)
+                continue
+            del index[name]
+            self._size -= size
+            self.__remove(name)
+
+    def get(self, text: str) -> "str|None":
+        """
+            get the path of the cached image of the text, return None if not cached
+        """
+        name = self.get_key(text)
+        path = os.path.join(self.cache_path, name)
+        with self._lock:
+            index = self.__load_index()
+            if name in index:
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    # 图片在缓存目录外被删除
+                    self._size -= index.pop(name)
+                else:
+                    index.move_to_end(name)
+                    self._count_hit += 1
+                    return path
+            self._count_miss += 1
+        return None
+
+    def put(self, text: str, png: bytes) -> str:
+        """
+            save the image of the text into the cache, return the path of the image
+        """
+        name = self.get_key(text)
+        path = os.path.join(self.cache_path, name)
+        with self._lock:
+            index = self.__load_index()
+        # 先写入临时文件再替换，其他线程不会读到写了一半的图片
+        path_tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(path_tmp, "wb") as file:
+                file.write(png)
+            os.replace(path_tmp, path)
+        except OSError:
+            with self._lock:
+                self.__remove(os.path.basename(path_tmp))
+            raise
+        with self._lock:
+            self._size += len(png) - index.pop(name, 0)
+            index[name] = len(png)
+            self.__evict(name)
+        return path
+
+    def get_stats(self):
+        """
+            get the statistics of the image cache
+        """
+        with self._lock:
+            index = self.__load_index()
+            return {
+                "count": len(index),
+                "size": self._size,
+                "max_size": self.max_size,
+                "hit": self._count_hit,
+                "miss": self._count_miss,
+            }
+
+
+gTextImageCache: _TextImageCache|None = None
+_gTextImageCacheLock = threading.Lock()
+
+def get_text_image_cache() -> _TextImageCache:
+    """
+        get the image cache, create one with `PIC_CONFIG` if not exists
+    """
+    global gTextImageCache
+    with _gTextImageCacheLock:
+        if gTextImageCache is None:
+            gTextImageCache = _TextImageCache(PIC_CONFIG.CACHE_PATH, PIC_CONFIG.CACHE_MAX_SIZE)
+        return gTextImageCache
+
+
+def split_text(text: str, length: int) -> list[str]:
+    """
+        将文本切分为长度不超过 length 的多段，尽量在换行处切分
+    """
+    if length <= 0 or len(text) <= length:
+        return [text]
+    text_list = []
+    start = 0
+    while len(text) - start > length:
+        end = text.rfind("\n", start, start + length)
+        if end <= start:
+            end = start + length
+        else:
+            end += 1
+        text_list.append(text[start:end])
+        start = end
+    if start < len(text):
+        text_list.append(text[start:])
+    return text_list
+
 class _BaseMessage:
     """
         the base class for all the message types
@@ -31,6 +476,12 @@ class _BaseMessage:
     def to_message(self) -> _OlvMsgAPI.Message_templet:
         raise NotImplementedError
 
+    def to_message_list(self) -> list[_OlvMsgAPI.Message_templet]:
+        """
+            the messages to send, one reply may be split into several messages
+        """
+        return [self.to_message()]
+
     def __str__(self) -> str:
         raise NotImplementedError
 
@@ -99,7 +550,6 @@ class _Message:
             else:
                 self.text_list = self._template.copy()
             self.data = data
-            self.cache = {}
         
         def add_data(self, data: dict[str, Any]) -> None:
             self.data.update(data)
@@ -107,56 +557,77 @@ class _Message:
         def append(self, text: str) -> None:
             self.text_list.append(text)
 
-        def generate_image(self, text: str, file_path: str|None = None):
+        def generate_image(self, text: str, file_path: str|None = None) -> str:
             """
                 generate an image from the text
-                return the binary data of the image
-                if file_path is None, the file will be deleted after it is closed
+                return the path of the image
+                if file_path is None, the image is saved into the image cache
             """
             log = utils.get_logger()
             log.debug(f"文本内容转图片：\n{text}")
-            text_list = textwrap.wrap(text, width=PIC_CONFIG.WIDTH)
-            image_height = max(PIC_CONFIG.MARGIN * 2 + len(text_list) * (PIC_CONFIG.FONT_STZE + PIC_CONFIG.FONT_SPACING), 800)
-            text_print = "\n".join(text_list)
-
-            image = _PILImage.new(
-                "RGB", (image_height, PIC_CONFIG.IMAGE_WIDTH), (255, 255, 255)
-            )
-            draw = _PILImageDraw.Draw(image)
-            print(PIC_CONFIG.FONT_PATH)
-            font = _PILImageFont.truetype(PIC_CONFIG.FONT_PATH, PIC_CONFIG.FONT_STZE)
-            draw.text((PIC_CONFIG.MARGIN, PIC_CONFIG.MARGIN), text_print, font=font, fill=(0, 0, 0))
             if file_path is None:
-                temp_file = NamedTemporaryFile(suffix=".png", delete=False)
-            else:
-                temp_file = open(file_path, "w+b")
-            image.save(temp_file, "PNG")
-            return temp_file
+                image_cache = get_text_image_cache()
+                path = image_cache.get(text)
+                if path is None:
+                    path = image_cache.put(text, get_text_image_render().render_png(text))
+                return path
+            with open(file_path, "wb") as file:
+                file.write(get_text_image_render().render_png(text))
+            return file_path
+
+        def to_message_list(self) -> list[_OlvMsgAPI.Message_templet]:
+            """
+                超过 _MAX_LENGTH 的文本转为图片，已经渲染过的文本直接使用缓存中的图片，其余的在渲染进程中渲染
+                渲染失败或超时的文本按 `PIC_CONFIG.SPLIT_LENGTH` 切分，分为多条消息发送
+            """
+            log = utils.get_logger()
+            text_list = [msg_template.format(**self.data) for msg_template in self._template]
+            image_cache = get_text_image_cache()
+            path_dict: dict[int, str] = {}
+            idx_render = []
+            for idx, text in enumerate(text_list):
+                if self._MAX_LENGTH > 0 and len(text) > self._MAX_LENGTH:
+                    path = image_cache.get(text)
+                    if path is None:
+                        idx_render.append(idx)
+                    else:
+                        path_dict[idx] = path
+            if len(idx_render) > 0:
+                png_list = get_text_image_render_pool().render_png_list([text_list[idx] for idx in idx_render])
+                for idx, png in zip(idx_render, png_list):
+                    if png is None:
+                        continue
+                    try:
+                        path_dict[idx] = image_cache.put(text_list[idx], png)
+                    except OSError as err:
+                        log.error(f"Error in saving text image: {err.__class__.__name__}: {err}")
+
+            message_list = []
+            send_list = []
+            for idx, text in enumerate(text_list):
+                if idx in path_dict:
+                    send_list.append(_OlvMsgAPI.PARA.image(f"file:///{path_dict[idx]}"))
+                elif self._MAX_LENGTH > 0 and len(text) > self._MAX_LENGTH:
+                    for text_part in split_text(text, PIC_CONFIG.SPLIT_LENGTH):
+                        send_list.append(_OlvMsgAPI.PARA.text(text_part))
+                        message_list.append(_OlvMsgAPI.Message_templet("olivos_para", send_list))
+                        send_list = []
+                else:
+                    send_list.append(_OlvMsgAPI.PARA.text(text))
+            if len(send_list) > 0 or len(message_list) == 0:
+                message_list.append(_OlvMsgAPI.Message_templet("olivos_para", send_list))
+            return message_list
 
         def to_message(self) -> _OlvMsgAPI.Message_templet:
             send_list = []
-            for msg_template in self._template:
-                msg_this = msg_template.format(**self.data)
-                if self._MAX_LENGTH > 0 and len(msg_this) > self._MAX_LENGTH:
-                    img_obj = self.generate_image(msg_this)
-                    self.cache[img_obj.name] = img_obj
-                    send_list.append(_OlvMsgAPI.PARA.image(f"file:///{img_obj.name}"))
-                else:
-                    send_list.append(_OlvMsgAPI.PARA.text(msg_this))
+            for message_obj in self.to_message_list():
+                send_list.extend(message_obj.data)
             message_obj = _OlvMsgAPI.Message_templet("olivos_para", send_list)
             return message_obj
 
         def __str__(self) -> str:
             return "\n".join(self._template)
 
-        def close(self):
-            for i in self.cache.values():
-                if hasattr(i, "close"):
-                    i.close()
-        
-        def __del__(self):
-            self.close()
-
     class ImageMessage(_BaseMessage):
         """
             the image message
@@ -189,6 +660,7 @@ OlivaChatGPT help:
 .chat show: show all the sessions
 .chat switch <session id>: 切换到另一个会话
 .chat recall: 撤回当前会话中最后一轮的对话
+.chat stats: 查看请求队列、上游服务器等运行统计
 
 .chat <xxx>: 向API服务器发送消息
 .chat send <xxx>: 同上，用于发送含有指令前缀的消息
@@ -270,6 +742,11 @@ model: 模型名称，可选
         class success(_Message.SingleTextMessage):
             _template = """\
 已发送消息，等待回复中 √
+"""
+        class queued(_Message.SingleTextMessage):
+            _template = """\
+已加入会话队列，等待之前的消息回复后发送 √
+当前排队位置: {queue_position}
 """
         class fail(_Message.SingleTextMessage):
             _template = """\
@@ -277,6 +754,9 @@ model: 模型名称，可选
 失败原因:
 {reason}
 """
+        class partial(_Message.SingleTextMessage):
+            _template = """\
+{reply_message}"""
         class response(_Message.TextImageMessage):
             _template = [
 """\
@@ -298,9 +778,9 @@ ChatGPT 回复消息:
             def add_data(self, data: dict[str, Any]) -> None:
                 super().add_data(data)
             
-            def to_message(self) -> _OlvMsgAPI.Message_templet:
+            def to_message_list(self) -> list[_OlvMsgAPI.Message_templet]:
                 self.data["time"] = time.time() - self.time_start
-                return super().to_message()
+                return super().to_message_list()
 
 
     class show(_baseReply):
@@ -353,4 +833,119 @@ ChatGPT 回复消息:
 导出会话数据失败 X
 会话名称: {session_name}
 失败原因: {reason}
-"""
\ No newline at end of file
+"""
+    class stats(_baseReply):
+        class default(_Message.SingleTextMessage):
+            _template = """\
+OlivaChatGPT 运行统计:
+{scheduler}
+
+{upstream}
+
+{session_pool}
+
+{session_cache}
+{client_cache}
+"""
+            _upstream_state = {"closed": "正常", "open": "停用", "half_open": "探测中"}
+
+            def format_scheduler(self, stats: dict) -> str:
+                """
+                    format the statistics of `schedulerAPI.RequestScheduler` for the stats message
+                """
+                running = "  ".join(f"{k}: {v}" for k, v in stats["running"].items())
+                line_list = [
+                    "请求调度器:",
+                    f"    工作线程: {stats['worker_num']}  排队中: {stats['queue_depth']}/{stats['queue_size']}",
+                    f"    进行中: {running if running != '' else '无'}",
+                    f"    已提交: {stats['submit']}  已完成: {stats['done']}  队列已满拒绝: {stats['reject']}  限流放弃: {stats['rate_limited']}",
+                    f"    等待时间 (最近 {stats['wait_time_sample']} 个请求): 平均 {stats['wait_time_avg']:.2f} s  "
+                    f"p50 {stats['wait_time_p50']:.2f} s  p99 {stats['wait_time_p99']:.2f} s  最大 {stats['wait_time_max']:.2f} s",
+                ]
+                for name, limit in stats["rate_limit"].items():
+                    rpm = f"{limit['rpm_available']:.0f}" if limit["rpm_available"] >= 0 else "不限"
+                    tpm = f"{limit['tpm_available']:.0f}" if limit["tpm_available"] >= 0 else "不限"
+                    line_list.append(f"    速率限制 {name}: RPM 余量 {rpm}  TPM 余量 {tpm}")
+                self.data["scheduler"] = "\n".join(line_list)
+                return self.data["scheduler"]
+
+            def format_upstream(self, stats: "dict[str, list[dict]]") -> str:
+                """
+                    format the statistics of `remoteAPI.get_upstream_stats` for the stats message
+                    只显示上游的主机名，不显示完整的 URL
+                """
+                line_list = []
+                for name, upstream_list in stats.items():
+                    line_list.append(f"上游服务器 {name}:")
+                    for item in upstream_list:
+                        line_list.append(
+                            f"    {item['host']}: {self._upstream_state.get(item['state'], item['state'])}  "
+                            f"权重 {item['weight']:g}  连续失败 {item['fail_count']}  "
+                            f"请求 {item['requests']}  失败 {item['failures']}  停用 {item['circuit_open']} 次"
+                        )
+                        line_list.append(
+                            f"        延迟: 平均 {item['latency_avg']:.2f} s  p50 {item['latency_p50']:.2f} s  p99 {item['latency_p99']:.2f} s"
+                        )
+                if len(line_list) == 0:
+                    line_list.append("上游服务器: 尚未发送过请求")
+                self.data["upstream"] = "\n".join(line_list)
+                return self.data["upstream"]
+
+            def format_session_pool(self, stats: "dict[str, dict]") -> str:
+                """
+                    format the statistics of `remoteAPI.get_session_pool_stats` for the stats message
+                """
+                line_list = ["HTTP 连接池 (requests 传输方式):"]
+                for name, item in stats.items():
+                    line_list.append(
+                        f"    {name}: 连接池 {item['pool_size']}  主机 {item['hosts']}  进行中 {item['in_flight']}  "
+                        f"新建连接 {item['connections']}  请求 {item['requests']}  复用连接 {item['reused']}  "
+                        f"空闲关闭 {item['session_evicted']} 次"
+                    )
+                if len(stats) == 0:
+                    line_list.append("    尚未创建")
+                self.data["session_pool"] = "\n".join(line_list)
+                return self.data["session_pool"]
+
+            @staticmethod
+            def _format_hit_rate(hit: int, miss: int) -> str:
+                if hit + miss == 0:
+                    return "N/A"
+                return f"{hit / (hit + miss):.1%}"
+
+            def format_session_cache(self, stats: dict) -> str:
+                """
+                    format the statistics of `databaseAPI.DataAPI.get_session_cache_stats` for the stats message
+                """
+                self.data["session_cache"] = (
+                    f"激活会话缓存: 已缓存 {stats['cached']}/{stats['size']}  "
+                    f"命中 {stats['hit']}  未命中 {stats['miss']}  命中率 {self._format_hit_rate(stats['hit'], stats['miss'])}"
+                )
+                return self.data["session_cache"]
+
+            @staticmethod
+            def _format_bytes(num: float) -> str:
+                for unit in ("B", "KiB", "MiB"):
+                    if num < 1024:
+                        return f"{num:.1f} {unit}" if unit != "B" else f"{num:.0f} B"
+                    num /= 1024
+                return f"{num:.1f} GiB"
+
+            def format_client_cache(self, stats: dict) -> str:
+                """
+                    format the statistics of `remoteAPI._RemoteClientRegistry.get_stats` for the stats message
+                """
+                max_num = stats["max_num"] if stats["max_num"] > 0 else "不限"
+                max_bytes = self._format_bytes(stats["max_bytes"]) if stats["max_bytes"] > 0 else "不限"
+                self.data["client_cache"] = (
+                    f"会话上下文缓存: 已缓存 {stats['num']}/{max_num}  占用 {self._format_bytes(stats['total_bytes'])}/{max_bytes}  "
+                    f"命中 {stats['hit']}  未命中 {stats['miss']}  命中率 {self._format_hit_rate(stats['hit'], stats['miss'])}  "
+                    f"淘汰 {stats['evict']}"
+                )
+                return self.data["client_cache"]
+
+        class fail(_Message.SingleTextMessage):
+            _template = """\
+查看运行统计失败 X
+失败原因: {reason}
+"""
@@ -0,0 +1,386 @@
+# -*- encoding: utf-8 -*-
+"""
+the scheduler API is used to limit the requests sent to the API servers
+
+all the requests of `RemoteClient` are put into a bounded queue and run by a fixed number of worker threads,
+the number of in-flight requests of each model is limited by `max_concurrency` in `confAPI.ConfigModel`,
+the requests and tokens per minute of each model and API key are limited by `rate_limit_rpm` / `rate_limit_tpm`
+"""
+
+import threading
+import collections
+import dataclasses
+import time
+import concurrent.futures
+
+from typing import Callable, Any
+
+from . import utils, confAPI, exceptions
+
+# 用于统计等待时间的最近样本数
+WAIT_TIME_SAMPLE = 1000
+
+
+@dataclasses.dataclass
+class _Job:
+    model_name: str
+    func: Callable
+    args: tuple
+    cost: int = 0
+    on_reject: "Callable|None" = None
+    rate_limit_keys: "Callable[[], list]|None" = None
+    time_submit: float = dataclasses.field(default_factory=time.time)
+
+
+class _TokenBucket:
+    """
+        token bucket refilled continuously at `rate_per_minute / 60` per second
+
+        桶的容量为每分钟的上限，余量可以为负数 (实际用量超过预扣的数量时)
+    """
+    def __init__(self, rate_per_minute: int):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60
+        self.available = self.capacity
+        self.time_last = time.monotonic()
+
+    def __refill(self, now: float):
+        self.available = min(self.capacity, self.available + (now - self.time_last) * self.rate)
+        self.time_last = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        "还需要等待多久 (秒) 才能取出 amount，超过容量的请求在桶满时即可取出"
+        self.__refill(now)
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.rate
+
+    def take(self, amount: float):
+        self.available -= amount
+
+    def adjust(self, amount: float):
+        "按实际用量修正，amount 为实际用量与预扣数量的差值"
+        self.available = min(self.capacity, self.available - amount)
+
+
+class _RateLimiter:
+    """
+        the RPM / TPM limits of a model and an API key
+    """
+    def __init__(self, rpm: int, tpm: int, max_wait: float):
+        self.param = (rpm, tpm, max_wait)
+        self.max_wait = max_wait
+        self._rpm = _TokenBucket(rpm) if rpm > 0 else None
+        self._tpm = _TokenBucket(tpm) if tpm > 0 else None
+
+    def wait_time(self, cost: int, now: float) -> float:
+        wait_time = 0.0
+        if self._rpm is not None:
+            wait_time = max(wait_time, self._rpm.wait_time(1, now))
+        if self._tpm is not None:
+            wait_time = max(wait_time, self._tpm.wait_time(cost, now))
+        return wait_time
+
+    def take(self, cost: int):
+        if self._rpm is not None:
+            self._rpm.take(1)
+        if self._tpm is not None:
+            self._tpm.take(cost)
+
+    def adjust(self, amount: int):
+        if self._tpm is not None:
+            self._tpm.adjust(amount)
+
+    def get_stats(self):
+        return {
+            "rpm_available": self._rpm.available if self._rpm is not None else -1,
+            "tpm_available": self._tpm.available if self._tpm is not None else -1,
+        }
+
+
+class RequestScheduler:
+    """
+        Request Scheduler
+
+        固定数量的工作线程从有界队列中取出请求并执行
+        当队列已满时，`submit` 会抛出 `OlivaChatGPTSchedulerFullError`，而不是继续创建线程
+        每个模型同时进行中的请求数受 `max_concurrency` 限制，超出限制的请求会留在队列中等待
+        每个模型每分钟的请求数与 token 数受 `rate_limit_rpm` / `rate_limit_tpm` 限制，
+        超出限制的请求同样留在队列中等待，等待超过 `rate_limit_wait` 秒后被放弃
+        RPM / TPM 按 (模型, rate limit key) 分别计算，请求可以提供多个 key (如各个上游的 API Key)，
+        调度器按给出的顺序选择第一个仍有余量的 key
+    """
+    def __init__(self, worker_num: int = 8, queue_size: int = 64):
+        self.worker_num = max(worker_num, 1)
+        self.queue_size = max(queue_size, 1)
+        self._cond = threading.Condition()
+        self._queue: "collections.deque[_Job]" = collections.deque()
+        self._running: dict[str, int] = {}
+        self._limit: dict[str, int] = {}
+        self._rate_limit_param: dict[str, tuple] = {}
+        self._rate_limiter: "dict[tuple[str, Any], _RateLimiter]" = {}
+        self._flag_stop = False
+
+        self._wait_time: "collections.deque[float]" = collections.deque(maxlen=WAIT_TIME_SAMPLE)
+        self._count_submit = 0
+        self._count_reject = 0
+        self._count_done = 0
+        self._count_rate_limited = 0
+
+        self._workers = []
+        for idx in range(self.worker_num):
+            thread = threading.Thread(
+                target=self.__run_worker, name=f"OlivaChatGPT-scheduler-{idx}", daemon=True
+            )
+            thread.start()
+            self._workers.append(thread)
+
+    def submit(
+        self, model_conf: confAPI.ConfigModel, func: Callable, *args: Any,
+        cost: int = 0, on_reject: "Callable|None" = None, rate_limit_keys: "Callable[[], list]|None" = None
+    ) -> int:
+        """
+            submit a request to the scheduler
+
+            如果 func 返回 `concurrent.futures.Future`，工作线程会立即返回，
+            该模型的并发额度在 Future 完成后才会释放
+
+            cost 为该请求估计的 token 数量，用于 TPM 限制
+            请求因 RPM / TPM 限制等待超时后不会被执行，而是以 `OlivaChatGPTRateLimitError` 调用 on_reject
+            rate_limit_keys 返回该请求可以使用的 key 列表 (按优先顺序)，在请求被取出时调用，
+            选中的 key 作为最后一个参数传给 func，列表为空时不扣除额度，传入 None
+            未提供 rate_limit_keys 时使用该模型的 None key，func 只接收 args
+
+            返回该请求提交时在队列中的位置 (从 1 开始)
+            队列已满时抛出 `OlivaChatGPTSchedulerFullError`
+        """
+        with self._cond:
+            if self._flag_stop:
+                raise exceptions.OlivaChatGPTRuntimeError("RequestScheduler has been stopped")
+            if len(self._queue) >= self.queue_size:
+                self._count_reject += 1
+                raise exceptions.OlivaChatGPTSchedulerFullError(self.queue_size)
+            self._limit[model_conf.model_name] = model_conf.max_concurrency
+            self.__update_rate_limiter(model_conf)
+            self._queue.append(_Job(model_conf.model_name, func, args, cost, on_reject, rate_limit_keys))
+            self._count_submit += 1
+            position = len(self._queue)
+            self._cond.notify()
+        return position
+
+    def __update_rate_limiter(self, model_conf: confAPI.ConfigModel):
+        "配置变化时移除该模型所有 key 的 RPM / TPM 限制，之后按新的配置重新创建，需要在持有 self._cond 时调用"
+        model_name = model_conf.model_name
+        param = (model_conf.rate_limit_rpm, model_conf.rate_limit_tpm, model_conf.rate_limit_wait)
+        if self._rate_limit_param.get(model_name, None) == param:
+            return
+        for key in [key for key in self._rate_limiter if key[0] == model_name]:
+            del self._rate_limiter[key]
+        if model_conf.rate_limit_rpm > 0 or model_conf.rate_limit_tpm > 0:
+            self._rate_limit_param[model_name] = param
+        else:
+            self._rate_limit_param.pop(model_name, None)
+
+    def __get_rate_limiter(self, model_name: str, key: Any) -> "_RateLimiter|None":
+        "获取 (模型, key) 的 RPM / TPM 限制，该模型没有限制时返回 None，需要在持有 self._cond 时调用"
+        param = self._rate_limit_param.get(model_name, None)
+        if param is None:
+            return None
+        limiter = self._rate_limiter.get((model_name, key), None)
+        if limiter is None:
+            limiter = _RateLimiter(*param)
+            self._rate_limiter[(model_name, key)] = limiter
+        return limiter
+
+    def __pick(self, expired_list: "list[tuple[_Job, float]]") -> "tuple[_Job | None, Any, float | None]":
+        """
+            取出队列中第一个所属模型仍有空闲并发额度且未超出 RPM / TPM 限制的请求，需要在持有 self._cond 时调用
+            返回 (请求, 选中的 rate limit key, 等待时间)
+
+            在等待时间上限内无法执行的请求从队列中移除，与等待时间上限一起加入 expired_list
+            没有可执行的请求时，返回最近一个受限请求还需等待的时间，用于定时唤醒
+        """
+        now = time.monotonic()
+        time_now = time.time()
+        wait_min = None
+        blocked = set()             # 已有请求受限的模型，其后的请求也不能越过它先执行
+        idx = 0
+        while idx < len(self._queue):
+            job = self._queue[idx]
+            if job.model_name in blocked:
+                idx += 1
+                continue
+            limit = self._limit.get(job.model_name, -1)
+            if limit > 0 and self._running.get(job.model_name, 0) >= limit:
+                idx += 1
+                continue
+            key_this = None
+            param = self._rate_limit_param.get(job.model_name, None)
+            if param is not None:
+                key_list = job.rate_limit_keys() if job.rate_limit_keys is not None else [None]
+                wait_time = None
+                for key in key_list:
+                    limiter: _RateLimiter = self.__get_rate_limiter(job.model_name, key)       # type: ignore
+                    wait_key = limiter.wait_time(job.cost, now)
+                    if wait_key <= 0:
+                        limiter.take(job.cost)
+                        key_this = key
+                        wait_time = None
+                        break
+                    wait_time = wait_key if wait_time is None else min(wait_time, wait_key)
+                if wait_time is not None:
+                    max_wait = param[2]
+                    if max_wait >= 0 and time_now - job.time_submit + wait_time > max_wait:
+                        # 在等待时间上限内无法发送，直接放弃，不再占用队列
+                        del self._queue[idx]
+                        expired_list.append((job, max_wait))
+                        continue
+                    blocked.add(job.model_name)
+                    wait_min = wait_time if wait_min is None else min(wait_min, wait_time)
+                    idx += 1
+                    continue
+            del self._queue[idx]
+            return job, key_this, None
+        return None, None, wait_min
+
+    def __reject(self, job: _Job, max_wait: float):
+        "请求因 RPM / TPM 限制被放弃"
+        log = utils.get_logger()
+        wait_time = time.time() - job.time_submit
+        log.warn(f"Request of model <{job.model_name}> dropped by the rate limit after waiting {wait_time:.1f} s")
+        if job.on_reject is None:
+            return
+        try:
+            job.on_reject(exceptions.OlivaChatGPTRateLimitError(job.model_name, max_wait))
+        except Exception as err:
+            log.error(f"Error in rejecting request of model <{job.model_name}>: {err.__class__.__name__}: {err}")
+
+    def __run_worker(self):
+        log = utils.get_logger()
+        while True:
+            expired_list: "list[tuple[_Job, float]]" = []
+            with self._cond:
+                job = None
+                key = None
+                while not self._flag_stop:
+                    job, key, wait_time = self.__pick(expired_list)
+                    if job is not None or len(expired_list) > 0:
+                        break
+                    self._cond.wait(wait_time)
+                self._count_rate_limited += len(expired_list)
+                if job is None and len(expired_list) == 0:
+                    return
+                if job is not None:
+                    self._running[job.model_name] = self._running.get(job.model_name, 0) + 1
+                    self._wait_time.append(time.time() - job.time_submit)
+            for job_expired, max_wait in expired_list:
+                self.__reject(job_expired, max_wait)
+            if job is None:
+                continue
+            result = None
+            args = job.args if job.rate_limit_keys is None else job.args + (key,)
+            try:
+                result = job.func(*args)
+            except Exception as err:
+                log.error(f"Error in scheduled request of model <{job.model_name}>: {err.__class__.__name__}: {err}")
+            if isinstance(result, concurrent.futures.Future):
+                # 请求在其他线程（如 asyncio 事件循环）中继续进行，完成后再释放并发额度
+                result.add_done_callback(lambda future, job=job: self.__release(job, future))
+            else:
+                self.__release(job)
+
+    def __release(self, job: _Job, future: "concurrent.futures.Future | None" = None):
+        "请求完成，释放所属模型的并发额度"
+        if future is not None and not future.cancelled() and future.exception() is not None:
+            err = future.exception()
+            log = utils.get_logger()
+            log.error(f"Error in scheduled request of model <{job.model_name}>: {err.__class__.__name__}: {err}")
+        with self._cond:
+            self._running[job.model_name] -= 1
+            self._count_done += 1
+            # 释放了并发额度，唤醒所有线程重新检查队列
+            self._cond.notify_all()
+
+    def adjust_rate_limit(self, model_name: str, cost: int, token_num: int, key: Any = None):
+        """
+            请求完成后，按实际使用的 token 数量修正该模型 (与 key) 的 TPM 余量
+
+            cost 为提交时预扣的估计值，token_num 为实际用量 (prompt + completion)
+            请求没有被上游接受时 token_num 为 0，退还全部预扣的额度 (429 除外，此时上游的额度已经用完)
+        """
+        with self._cond:
+            limiter = self._rate_limiter.get((model_name, key), None)
+            if limiter is not None:
+                limiter.adjust(token_num - cost)
+                # 余量可能增加，唤醒等待中的线程重新检查
+                self._cond.notify_all()
+
+    def take_rate_limit(self, model_name: str, cost: int, key: Any = None):
+        """
+            不经等待直接扣除 (模型, key) 的一个请求与 cost 个 token 的额度，余量可以变为负数
+            用于请求重试时换用了其他 key 的上游
+        """
+        with self._cond:
+            limiter = self.__get_rate_limiter(model_name, key)
+            if limiter is not None:
+                limiter.take(cost)
+
+    def get_stats(self):
+        """
+            get the statistics of the scheduler
+
+            queue_depth: 当前队列中等待的请求数
+            running: 各个模型进行中的请求数
+            rate_limit: 各个 (模型, key) 的 RPM / TPM 余量，key 为 None 时名称只包含模型名
+            wait_time_*: 最近 wait_time_sample (不超过 WAIT_TIME_SAMPLE) 个请求从提交到开始执行的等待时间 (秒)
+        """
+        with self._cond:
+            wait_time = sorted(self._wait_time)
+            stats = {
+                "worker_num": self.worker_num,
+                "queue_size": self.queue_size,
+                "queue_depth": len(self._queue),
+                "running": {k: v for k, v in self._running.items() if v > 0},
+                "submit": self._count_submit,
+                "reject": self._count_reject,
+                "done": self._count_done,
+                "rate_limited": self._count_rate_limited,
+                "rate_limit": {
+                    (model_name if key is None else f"{model_name} ({key})"): limiter.get_stats()
+                    for (model_name, key), limiter in self._rate_limiter.items()
+                },
+                "wait_time_sample": len(wait_time),
+            }
+        if len(wait_time) > 0:
+            stats["wait_time_avg"] = sum(wait_time) / len(wait_time)
+            stats["wait_time_p50"] = wait_time[len(wait_time) // 2]
+            stats["wait_time_p99"] = wait_time[min(int(len(wait_time) * 0.99), len(wait_time) - 1)]
+            stats["wait_time_max"] = wait_time[-1]
+        else:
+            stats["wait_time_avg"] = stats["wait_time_p50"] = stats["wait_time_p99"] = stats["wait_time_max"] = 0.0
+        return stats
+
+    def stop(self):
+        """
+            stop all the workers, the requests still in the queue will be dropped
+        """
+        with self._cond:
+            self._flag_stop = True
+            self._queue.clear()
+            self._cond.notify_all()
+
+
+gScheduler: RequestScheduler|None = None
+_gSchedulerLock = threading.Lock()
+
+def get_scheduler() -> RequestScheduler:
+    """
+        get the request scheduler, create one with the basic config if not exists
+    """
+    global gScheduler
+    with _gSchedulerLock:
+        if gScheduler is None:
+            conf = confAPI.get_config()
+            gScheduler = RequestScheduler(conf.basic.scheduler_workers, conf.basic.scheduler_queue_size)
+        return gScheduler
@@ -1,4 +1,9 @@
-from .. import utils
+import os
+import re
+import time
+import threading
+
+from .. import utils, confAPI
 
 FLAG_TIKTOKEN_INSTALLED = False
 try:
@@ -11,6 +16,54 @@ except ImportError:
 
 _warn_once = []                         # 对于未知模型，只警告一次
 
+# tiktoken 的 BPE 文件缓存目录，离线部署时可以将其他机器上的缓存文件复制到该目录下
+TIKTOKEN_CACHE_PATH = os.path.abspath(os.path.join(confAPI.DATA_PATH_ROOT, "data", "tiktoken"))
+# 加载编码器失败 (如无法下载 BPE 文件) 后，间隔多久再次尝试 (秒)
+ENCODER_RETRY_INTERVAL = 600
+
+# 各个固定版本模型的 (tokens_per_message, tokens_per_name)
+_MESSAGE_PARAM = {
+    "gpt-3.5-turbo-0613": (3, 1),
+    "gpt-3.5-turbo-16k-0613": (3, 1),
+    "gpt-4-0314": (3, 1),
+    "gpt-4-32k-0314": (3, 1),
+    "gpt-4-0613": (3, 1),
+    "gpt-4-32k-0613": (3, 1),
+    # every message follows <|start|>{role/name}\n{content}<|end|>\n
+    # if there's a name, the role is omitted
+    "gpt-3.5-turbo-0301": (4, -1),
+}
+# gpt-3.5-turbo 和 gpt-4 会随时间更新，按固定版本计算
+_MODEL_ALIAS = (
+    ("gpt-3.5-turbo", "gpt-3.5-turbo-0613"),
+    ("gpt-4", "gpt-4-0613"),
+)
+
+# 内置估算：不依赖 tiktoken，按 cl100k_base 的预分词规则近似，每个匹配计为 1 个 token
+# 只用于 tiktoken 不可用时的预算与统计，以 gpt-3.5-turbo / gpt-4 使用的 cl100k_base 为准
+# 在 bench/check_token_estimate.py 的语料上实测的相对误差 (正数为高估)：
+#   cl100k_base: 英文 +8%，中文 -2%，日文 +7%，韩文 -5%，俄文 +6%，法/德文 +3%，中英混合 +6%，代码 +16%，JSON +1%
+#   o200k_base:  英文 +11%，中文 +45%，日文 +58%，韩文 +83%，俄文 +110%，法/德文 +37%，中英混合 +27%，代码 +15%，JSON +2%
+# o200k_base 对非英文文本的编码更紧凑，估算值只会偏高 (裁剪上下文时更保守)
+# 估计值不会写入数据库 (token_num 记为 NULL)，编码器可用后重建上下文时会重新计算并回填
+_RE_ESTIMATE = re.compile(
+    r"[A-Za-z]{1,8}"            # 英文单词，每 8 个字母计 1 个
+    r"|\d{1,3}"                 # 数字每 3 位计 1 个 (与 tiktoken 的预分词一致)
+    r"|\n+"                     # 连续的换行计 1 个
+    r"| {2,}"                   # 缩进等连续的空格计 1 个，单个空格与后面的单词合并
+    r"|[!-/:-@\[-`{-~]{1,2}"    # 标点符号每 2 个计 1 个
+    r"|[\u0080-\u024f\u0370-\u052f]{1,2}"   # 带重音的拉丁字母、希腊字母与西里尔字母每 2 个计 1 个
+    r"|[^\x00-\x7f]"            # 中日韩文字及其他非 ASCII 字符每个计 1 个
+)
+# cl100k_base 中不常用的汉字与谚文音节占 2~3 个 token，平均每个字约 1.2 个，每 5 个字额外计 1 个
+_RE_ESTIMATE_EXTRA = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]")
+# 估算时的消息格式开销，与 gpt-3.5-turbo-0613 / gpt-4-0613 相同
+_ESTIMATE_MESSAGE_PARAM = (3, 1)
+
+_gEncoder: dict = {}                    # model_type -> encoding，未知模型为 None
+_gEncoderFail: dict[str, float] = {}    # model_type -> 加载失败的时间
+_gEncoderLock = threading.Lock()
+
 def get_tiktoken():
     """返回 tiktoken 模块，如果未安装则返回 None 并打印警告。"""
     global _warn_once
@@ -23,85 +76,202 @@ def get_tiktoken():
             log.warn("""第三方库 tiktoken 未安装，无法使用部分功能。请在源码状态下运行 OlivOS 并使用 "pip install tiktoken" 进行安装。""")
         return None
 
-def get_token_from_string(message: str, model="gpt-3.5-turbo-0613") -> "int|None":
+def set_cache_dir(path: str = TIKTOKEN_CACHE_PATH):
     """
-        计算单条消息的 token 数量，如果未安装 tiktoken 模块则返回 None。
-        需要使用 tiktoken 模块
+        设置 tiktoken 的 BPE 文件缓存目录，需要在第一次加载编码器之前调用
+        如果已经通过环境变量 TIKTOKEN_CACHE_DIR 指定了目录，则不做修改
     """
-    global _warn_once
+    if "TIKTOKEN_CACHE_DIR" not in os.environ:
+        os.makedirs(path, exist_ok=True)
+        os.environ["TIKTOKEN_CACHE_DIR"] = path
+
+
+def get_encoder(model="gpt-3.5-turbo-0613"):
+    """
+        获取模型的编码器，如果未安装 tiktoken 模块或模型未知则返回 None
+
+        每个模型只加载一次编码器，之后直接从 _gEncoder 中读取
+        加载失败 (如离线环境无法下载 BPE 文件) 时返回 None，ENCODER_RETRY_INTERVAL 秒内不再重试
+    """
+    encoding = _gEncoder.get(model, False)
+    if encoding is not False:
+        return encoding
     tiktoken = get_tiktoken()
-    log = utils.get_logger()
     if tiktoken is None:
         return None
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        if model not in _warn_once:
+    with _gEncoderLock:
+        encoding = _gEncoder.get(model, False)
+        if encoding is not False:
+            return encoding
+        time_fail = _gEncoderFail.get(model, None)
+        if time_fail is not None and time.time() - time_fail < ENCODER_RETRY_INTERVAL:
+            return None
+        set_cache_dir()
+        log = utils.get_logger()
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
             log.warn(f"未知模型 {model}，无法计算 token 数量")
-            _warn_once.append(model)
-        # encoding = tiktoken.get_encoding("cl100k_base")
+            encoding = None
+        except Exception as err:
+            log.error(f"加载模型 {model} 的 tiktoken 编码器失败: {err.__class__.__name__}: {err}")
+            _gEncoderFail[model] = time.time()
+            return None
+        _gEncoder[model] = encoding
+        _gEncoderFail.pop(model, None)
+        return encoding
+
+
+def _resolve_model(model: str) -> "str|None":
+    "将会随时间更新的模型名称解析为固定版本，未知模型返回 None"
+    if model in _MESSAGE_PARAM:
+        return model
+    for prefix, model_base in _MODEL_ALIAS:
+        if prefix in model:
+            if model not in _warn_once:
+                _warn_once.append(model)
+                log = utils.get_logger()
+                log.warn(f"{prefix} 会随时间更新，返回的 token 数量基于 {model_base} 计算")
+            return model_base
+    if model not in _warn_once:
+        _warn_once.append(model)
+        log = utils.get_logger()
+        log.warn(f"未知模型 {model}，无法计算消息的 token 数量")
+    return None
+
+
+def _get_message_param(model="gpt-3.5-turbo-0613"):
+    """
+        获取计算消息 token 数量所需的参数 (encoding, tokens_per_message, tokens_per_name)
+        如果未安装 tiktoken 模块或模型未知则返回 None
+    """
+    model_base = _resolve_model(model)
+    if model_base is None:
+        return None
+    encoding = get_encoder(model_base)
+    if encoding is None:
+        return None
+    tokens_per_message, tokens_per_name = _MESSAGE_PARAM[model_base]
+    return encoding, tokens_per_message, tokens_per_name
+
+
+def warm_up(model_list: "list[str]", flag_block: bool = False) -> "threading.Thread|None":
+    """
+        预先加载各个模型的编码器，避免第一次计算 token 数量时在回复线程中加载或下载 BPE 文件
+        flag_block 为 False 时在后台线程中加载，返回该线程
+    """
+    if not FLAG_TIKTOKEN_INSTALLED:
+        return None
+
+    def run():
+        for model in dict.fromkeys(model_list):
+            get_encoder(model)
+            _get_message_param(model)
+
+    if flag_block:
+        run()
+        return None
+    thread = threading.Thread(target=run, name="OlivaChatGPT-tiktoken-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def _estimate(text: str) -> int:
+    "内置估算的 token 数量，见 _RE_ESTIMATE"
+    return len(_RE_ESTIMATE.findall(text)) + (len(_RE_ESTIMATE_EXTRA.findall(text)) + 4) // 5
+
+
+def estimate_token_from_string(message: str) -> int:
+    """
+        不使用 tiktoken，估算字符串的 token 数量
+    """
+    return _estimate(message)
+
+
+def estimate_token_from_message_list(messages) -> int:
+    """
+        不使用 tiktoken，估算消息列表的 token 数量
+        所有消息的内容以 \\0 连接后一次匹配，\\0 不会被计入
+    """
+    if isinstance(messages, dict):
+        messages = [messages]
+    tokens_per_message, tokens_per_name = _ESTIMATE_MESSAGE_PARAM
+    num_tokens = 3
+    value_list = []
+    for message in messages:
+        num_tokens += tokens_per_message
+        if "name" in message:
+            num_tokens += tokens_per_name
+        value_list.extend(message.values())
+    return num_tokens + _estimate("\0".join(value_list))
+
+
+def get_token_from_string(message: str, model="gpt-3.5-turbo-0613", flag_estimate: bool = False):
+    """
+        计算单条消息的 token 数量，如果未安装 tiktoken 模块则返回 None。
+        需要使用 tiktoken 模块
+
+        flag_estimate 为 True 时返回 (token 数量, 是否为估计值)，无法使用 tiktoken 时使用内置估算
+    """
+    encoding = get_encoder(model)
+    if encoding is None:
+        if flag_estimate:
+            return estimate_token_from_string(message), True
+        return None
+    num_tokens = len(encoding.encode(message, disallowed_special=()))
+    if flag_estimate:
+        return num_tokens, False
+    return num_tokens
+
+def get_token_from_message(message: dict, model="gpt-3.5-turbo-0613", flag_estimate: bool = False):
+    """
+        计算单条消息（含角色等格式开销）的 token 数量，如果未安装 tiktoken 模块则返回 None。
+        消息列表的 token 数量为各条消息的 token 数量之和再加上 3 (回复的起始标记)
+        需要使用 tiktoken 模块
+
+        flag_estimate 为 True 时返回 (token 数量, 是否为估计值)，无法使用 tiktoken 时使用内置估算
+    """
+    param = _get_message_param(model)
+    if param is None:
+        if flag_estimate:
+            return estimate_token_from_message_list([message]) - 3, True
         return None
-    token = 0
-    token += len(encoding.encode(message, disallowed_special=()))
-    return token
-    
+    encoding, tokens_per_message, tokens_per_name = param
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value, disallowed_special=()))
+        if key == "name":
+            num_tokens += tokens_per_name
+    if flag_estimate:
+        return num_tokens, False
+    return num_tokens
 
-def get_token_from_message_list(messages, model="gpt-3.5-turbo-0613") -> "int|None":
+def get_token_from_message_list(messages, model="gpt-3.5-turbo-0613", flag_estimate: bool = False):
     """
         计算消息列表的 token 数量，如果未安装 tiktoken 模块则返回 None。
         需要使用 tiktoken 模块
         修改自: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+
+        flag_estimate 为 True 时返回 (token 数量, 是否为估计值)，无法使用 tiktoken 时使用内置估算
     """
-    global _warn_once
-    tiktoken = get_tiktoken()
-    log = utils.get_logger()
-    if tiktoken is None:
-        return None
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        if model not in _warn_once:
-            log.warn(f"未知模型 {model}，无法计算 token 数量")
-            _warn_once.append(model)
-        # encoding = tiktoken.get_encoding("cl100k_base")
+    param = _get_message_param(model)
+    if param is None:
+        if flag_estimate:
+            return estimate_token_from_message_list(messages), True
         return None
-    if model in {
-        "gpt-3.5-turbo-0613",
-        "gpt-3.5-turbo-16k-0613",
-        "gpt-4-0314",
-        "gpt-4-32k-0314",
-        "gpt-4-0613",
-        "gpt-4-32k-0613",
-        }:
-        tokens_per_message = 3
-        tokens_per_name = 1
-    elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif "gpt-3.5-turbo" in model:
-        if model not in _warn_once:
-            _warn_once.append(model)
-            log.warn(f"gpt-3.5-turbo 会随时间更新，返回的 token 数量基于 gpt-3.5-turbo-0613 计算")
-        return get_token_from_message_list(messages, model="gpt-3.5-turbo-0613")
-    elif "gpt-4" in model:
-        if model not in _warn_once:
-            _warn_once.append(model)
-            log.warn(f"gpt-4 会随时间更新，返回的 token 数量基于 gpt-4-0613 计算")
-        return get_token_from_message_list(messages, model="gpt-4-0613")
-    else:
-        raise NotImplementedError(
-            f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
-        )
+    encoding, tokens_per_message, tokens_per_name = param
     num_tokens = 0
     if isinstance(messages, dict):
         messages = [messages]
     for message in messages:
         num_tokens += tokens_per_message
         for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
+            num_tokens += len(encoding.encode(value, disallowed_special=()))
             if key == "name":
                 num_tokens += tokens_per_name
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+    if flag_estimate:
+        return num_tokens, False
     return num_tokens
 
 
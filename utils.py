@@ -22,6 +22,9 @@ r"""
 """
 
 import dataclasses as _dataclasses
+import functools as _functools
+import collections as _collections
+import types as _types
 
 import OlivOS
 
@@ -114,10 +117,11 @@ def set_logger(proc_log: _Callable):
     else:
         raise RuntimeError("LogProcWrapper can only be initialized once")
 
-def format_dict_factory(plugin_event, proc):
+def format_dict_factory(plugin_event, proc, user_info: "UserInfo|None" = None):
     dict_format = {}
 
-    user_info = UserInfo.from_event(plugin_event)
+    if user_info is None:
+        user_info = UserInfo.from_event(plugin_event)
 
     dict_format["user_id"] = user_info.user_id
     dict_format["platform"] = user_info.platform
@@ -148,6 +152,16 @@ class CommandConfig:
     user_info: UserInfo
     data: databaseAPI.DataAPI
     
-    @property
-    def dict_format(self):
-        return format_dict_factory(self.plugin_event, self.Proc)
\ No newline at end of file
+    @_functools.cached_property
+    def dict_format(self) -> "_types.MappingProxyType[str, object]":
+        """
+            the format context of the event, computed once and shared read-only by the reply templates
+            use `dict_format_overlay()` if the context needs to be modified
+        """
+        return _types.MappingProxyType(format_dict_factory(self.plugin_event, self.Proc, self.user_info))
+
+    def dict_format_overlay(self) -> "_collections.ChainMap[str, object]":
+        """
+            a copy-on-write view of `dict_format`, the modifications are only written to the overlay
+        """
+        return _collections.ChainMap({}, self.dict_format)      # type: ignore
\ No newline at end of file